@@ -9,6 +9,7 @@ from uthread import *
 from sx127x import *
 from machine import SPI, Pin
 from urandom import randrange
+from loraframe import FRAME_NONCE_MASK
 
 _SX127x_DIO0  = const(26)   # DIO0 interrupt pin
 _SX127x_DIO1  = const(35)   # DIO1 interrupt pin
@@ -28,8 +29,8 @@ class LoRaHandler(SX127x_driver):
         SX127x_driver.__init__(self, domain, **kwargs)
 
         self._loralock = rlock()
-        self._transmit_queue = queue()
-        self._receive_queue = queue()
+        self._transmit_queue = queue(32, OVERFLOW_DROP_NEWEST)
+        self._receive_queue = queue(16, OVERFLOW_DROP_OLDEST)
         self._display = display if display else lambda text,line=0,clear=False : None
 
     def init(self):
@@ -42,7 +43,7 @@ class LoRaHandler(SX127x_driver):
         self._reset = Pin(_SX127x_RESET, Pin.OUT)
         self._dio_table = [ Pin(_SX127x_DIO0, Pin.IN), Pin(_SX127x_DIO1, Pin.IN), Pin(_SX127x_DIO2, Pin.IN) ]
         self._button = Pin(_BUTTON_PIN, Pin.IN)
-        self._button_flag = lock(True)
+        self._button_queue = queue(4, OVERFLOW_DROP_NEWEST)
         self._ping_count = 0
         self._led_pin = Pin(_LED_PIN, Pin.OUT)
         self._power = None # not True nor False
@@ -53,59 +54,59 @@ class LoRaHandler(SX127x_driver):
         self._display("Ready")
 
 
-        # Start the worker thread
+        # One thread serves both received packets and button presses
         self._worker_thread = thread(run=self._worker_run, name="worker_thread", stack=8192)
         self._worker_thread.start()
-        
-        self._button_thread = thread(run=self._button_run, name="button_thread", stack=8192)
-        self._button_thread.start()
 
         # Set power state for button and control
         self.set_power()
 
     # Interrupt comes here
     def _button_pressed(self, event=None):
-        try:
-            self._button_flag.release()
-        except:
-            pass
-
-    def _button_run(self, t):
-        while self._button_flag.acquire() and t.running:
-            # print("Button pressed")
-            self._ping_count += 1
-            self._display("ping %d" % (self._ping_count))
-            # Launch a ping message
-            self.send_packet(b'ping %d' % self._ping_count)
+        self._button_queue.put_isr(True)
+
+    def _button_run(self):
+        # print("Button pressed")
+        self._ping_count += 1
+        self._display("ping %d" % (self._ping_count))
+        # Launch a ping message
+        self.send_packet(b'ping %d' % self._ping_count)
 
     def _worker_run(self, t):
         # print("Worker running")
         while t.running:
-            packet = self.receive_packet()
-            if packet:
-                rssi = packet['rssi']
-                data = packet['data'].decode()
-                toaddr = data[0] << 8 + data[1]
-                randbyte = data[2]
-                fromaddr = data[3] << 8 + data[4]
-                data = data[5:]
-
-                # print("Received: rssi %d to %04x from %04x '%s'" % (rssi, fromaddr, toaddr, data[5:]))
-                gc.collect()
-                self._led_pin.on()
-                sleep(0.1)
-                self._led_pin.off()
-                if data[0:5] == b'ping ':
-                    # Send answer
-                    header = bytearray(((toaddr >> 8) % 256, toaddr % 256, randrange(0, 256), (fromaddr >> 8) % 256, fromaddr % 256))
-                    self.send_packet(header + bytearray('reply %s (%d)' % (data[5:], rssi)))
+            for ready in select([ self._receive_queue, self._button_queue ], 1000):
+                if ready is self._button_queue:
+                    self._button_queue.get(wait=0)
+                    self._button_run()
                 else:
-                    self._display("(%d) %s" % (rssi, data), line=2, clear=False)
-                del(packet)
+                    self._receive_run(self._receive_queue.get(wait=0))
 
         # print("Worker exit")
         return 0
 
+    def _receive_run(self, packet):
+        if packet:
+            rssi = packet['rssi']
+            data = packet['data'].decode()
+            toaddr = data[0] << 8 + data[1]
+            randbyte = data[2]
+            fromaddr = data[3] << 8 + data[4]
+            data = data[5:]
+
+            # print("Received: rssi %d to %04x from %04x '%s'" % (rssi, fromaddr, toaddr, data[5:]))
+            gc.collect()
+            self._led_pin.on()
+            sleep(0.1)
+            self._led_pin.off()
+            if data[0:5] == b'ping ':
+                # Send answer
+                header = bytearray(((toaddr >> 8) % 256, toaddr % 256, randrange(0, FRAME_NONCE_MASK + 1), (fromaddr >> 8) % 256, fromaddr % 256))
+                self.send_packet(header + bytearray('reply %s (%d)' % (data[5:], rssi)))
+            else:
+                self._display("(%d) %s" % (rssi, data), line=2, clear=False)
+            del(packet)
+
     # Reset device
     def reset(self):
         self._reset.value(0)
@@ -129,13 +130,13 @@ class LoRaHandler(SX127x_driver):
         return response
 
     # Read block of data from SPI port
-    def read_buffer(self, address, length):
-        response = bytearray(length)
+    def read_buffer(self, address, length, buffer=None):
+        response = bytearray(length) if buffer == None else memoryview(buffer)[0:length]
         self._ss.value(0)
         self._spi.write(bytes([address & 0x7F]))
         self._spi.readinto(response)
         self._ss.value(1)
-        return response
+        return buffer if buffer != None else response
 
     # Write block of data to SPI port
     def write_buffer(self, address, buffer, size):
@@ -154,7 +155,8 @@ class LoRaHandler(SX127x_driver):
         # print("onReceive: crc_ok %s packet %s rssi %d" % (crc_ok, packet, rssi))
         if crc_ok:
             # Check addresses etc
-            self._receive_queue.put({'rssi': rssi, 'data': packet })
+            self._receive_queue.put({'rssi': rssi, 'data': bytes(packet.data()) })
+        packet.release()
 
     def receive_packet(self):
         return self._receive_queue.get()
@@ -197,14 +199,6 @@ class LoRaHandler(SX127x_driver):
             print("Exit %s rc %d" % (self._worker_thread.name(), rc))
             self._worker_thread = None
 
-        if self._button_thread:
-            self._button_thread.stop()
-            try:
-                self._button_flag.release()
-            except:
-                pass
-            self._button_thread.wait()
-            self._button_thread = None
 
     def set_power(self, power=True):
         # print("set_power %s" % power)
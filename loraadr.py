@@ -0,0 +1,118 @@
+#
+# Adaptive data rate: per-link signal history and rate/power selection.
+#
+# SNR and RSSI of frames heard from each source address are kept in a short
+# history.  The link is assumed to be symmetric, so the best recent SNR from an
+# address is taken as what that address will see from us.  The link margin at
+# a spreading factor is that SNR less the SF's demodulation floor and an
+# installation margin.  select() picks the fastest allowed data rate with a
+# non-negative margin and spends what is left on lowering transmit power.
+#
+
+try:
+    _UNUSED_=const(1)
+except:
+    const = lambda x: x
+
+# Demodulation floor (dB SNR) for SF6..SF12 (SX1276 datasheet table 13)
+_REQUIRED_SNR = (-5.0, -7.5, -10.0, -12.5, -15.0, -17.5, -20.0)
+
+def required_snr(spreading_factor):
+    return _REQUIRED_SNR[min(max(spreading_factor, 6), 12) - 6]
+
+# Parameters
+#     margin         - installation margin in dB kept in reserve on every link
+#     history        - frames remembered per source address
+#     links          - source addresses tracked (least recently heard is dropped)
+#     min_power      - lowest transmit power in dBm
+#     power_step     - dBm per power reduction step
+#
+class LinkAdaptation():
+    def __init__(self, domain, **kwargs):
+        self._data_rates = domain['data_rates']
+        self._channels   = domain['channels']
+        self._margin     = kwargs['margin']     if 'margin'     in kwargs else 10
+        self._history    = kwargs['history']    if 'history'    in kwargs else 8
+        self._max_links  = kwargs['links']      if 'links'      in kwargs else 32
+        self._min_power  = kwargs['min_power']  if 'min_power'  in kwargs else 2
+        self._power_step = kwargs['power_step'] if 'power_step' in kwargs else 2
+
+        # address -> [ <snr list>, <rssi list>, <next slot>, <samples>, <last heard> ]
+        self._links = {}
+        self._clock = 0
+
+    # Note the signal of a frame heard from address
+    def record(self, address, rssi, snr):
+        self._clock += 1
+        if address in self._links:
+            link = self._links[address]
+        else:
+            if len(self._links) >= self._max_links:
+                oldest = None
+                for key in self._links:
+                    if oldest == None or self._links[key][4] < self._links[oldest][4]:
+                        oldest = key
+                del self._links[oldest]
+            link = [ [ 0.0 ] * self._history, [ 0 ] * self._history, 0, 0, 0 ]
+            self._links[address] = link
+
+        slot = link[2]
+        link[0][slot] = snr
+        link[1][slot] = rssi
+        link[2] = (slot + 1) % self._history
+        link[3] = min(link[3] + 1, self._history)
+        link[4] = self._clock
+
+    # Best recent SNR from address or None if never heard
+    def snr(self, address):
+        if address not in self._links:
+            return None
+        link = self._links[address]
+        return max(link[0][0:link[3]])
+
+    # Margin in dB to address at spreading_factor or None if never heard
+    def margin(self, address, spreading_factor):
+        snr = self.snr(address)
+        return None if snr == None else snr - required_snr(spreading_factor) - self._margin
+
+    # Data rates usable on channel, fastest (smallest spreading factor) first
+    def _candidates(self, channel, direction):
+        for group in self._channels:
+            if group['type'] == direction and group['chan'][0] <= channel <= group['chan'][1]:
+                rates = [ rate for rate in range(group['dr'][0], group['dr'][1] + 1) if rate in self._data_rates ]
+                rates.sort(key=lambda rate: self._data_rates[rate]['sf'])
+                return rates
+        return []
+
+    # (data_rate, tx_power) to use towards address.  data_rate is returned
+    # unchanged unless adapt_rate; the receiver must be able to hear the rate chosen.
+    def select(self, address, channel, direction, data_rate, adapt_rate=False):
+        if data_rate not in self._data_rates:
+            return (data_rate, None)
+
+        chosen = data_rate
+        if self.snr(address) != None and adapt_rate:
+            for rate in self._candidates(channel, direction):
+                if self.margin(address, self._data_rates[rate]['sf']) >= 0:
+                    chosen = rate
+                    break
+
+        limit = self._data_rates[chosen]['tx']
+        margin = self.margin(address, self._data_rates[chosen]['sf'])
+        if margin == None or margin <= 0:
+            return (chosen, limit)
+
+        steps = int(margin / self._power_step)
+        return (chosen, max(self._min_power, limit - steps * self._power_step))
+
+    def stats(self):
+        stats = {}
+        for address in self._links:
+            link = self._links[address]
+            samples = link[3]
+            stats[address] = {
+                'samples': samples,
+                'snr':     max(link[0][0:samples]),
+                'rssi':    sum(link[1][0:samples]) / samples,
+            }
+        return stats
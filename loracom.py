@@ -5,7 +5,13 @@
 from time import sleep
 from ulock import *
 from uqueue import *
-from sx127x import SX127x_driver
+from usemaphore import semaphore
+from sx127x import *
+from loraschedule import TransmitScheduler
+from loraframe import *
+from loraadr import LinkAdaptation
+from lorareliable import ReliableLink
+from loradedup import DuplicateFilter
 from machine import SPI, Pin
 
 
@@ -18,15 +24,86 @@ _SX127x_MISO  = const(19)
 _SX127x_SS    = const(18)
 _SX127x_RESET = const(14)
 _SX127x_WANTED_VERSION = const(0x12)
+_LORA_MAX_FRAME = const(255)
+
+# Transmit queue entry: [ <frame>, <credits it holds> ]
+_TX_FRAME       = const(0)
+_TX_CREDITS     = const(1)
 
 class LoRaHandler(SX127x_driver):
 
     def __init__(self, domain, **kwargs):
         SX127x_driver.__init__(self, domain, **kwargs)
 
-        self._loralock = rlock()
-        self._transmit_queue = queue()
-        self._receive_queue = queue()
+        # Every received packet is a pool buffer, so the receive queue never needs more
+        # room than the pool has.  The transmit queue holds up to tx_queue entries (see
+        # _TX_FRAME); a frame sent when it is full is dropped (and a reliable one reported
+        # undelivered).
+        # Neither put() ever waits, as the service thread does both.
+        self._receive_queue = queue(len(self._rx_pool), OVERFLOW_DROP_NEWEST, lambda packet: packet.release())
+        self._transmit_queue = queue(kwargs['tx_queue'] if 'tx_queue' in kwargs else 32, OVERFLOW_DROP_NEWEST)
+
+        # Flow control for a host feeding us frames: it may have 'credits' frames waiting
+        # to go at once.  Each send_packet(credit=True) spends one taken by take_credit(),
+        # and it comes back when the frame carrying the message has been sent (or dropped).
+        # credit(available) is called from the service thread as they come back.
+        credits = kwargs['credits'] if 'credits' in kwargs else 0
+        self._credits = semaphore(credits) if credits else None
+        self._credit = kwargs['credit'] if 'credit' in kwargs else None
+
+        # Transmit pacing for the domain airtime limits (service thread only)
+        self._scheduler = TransmitScheduler(domain)
+        self._transmitting = False
+        self._tx_airtime = 0
+        self._tx_waiting = False
+        self._tx_deferred = 0
+        self._tx_rejected = 0
+
+        # Frame types (see loraframe) in byte 2.  Units without them put a random byte
+        # there, which would be taken for aggregates, reliable frames and ACKs, so every
+        # unit on the network must have the same setting.  With frame_types off byte 2 is
+        # left alone: frames are not aggregated, sent reliably or acknowledged.
+        self._frame_types = kwargs['frame_types'] if 'frame_types' in kwargs else False
+
+        # Messages sent while the tail frame waits are folded into it.  The tail is held
+        # open for up to aggregate_hold ms after its first message (-1 disables aggregation).
+        self._aggregate_hold = kwargs['aggregate_hold'] if 'aggregate_hold' in kwargs else 0
+        if not self._frame_types:
+            self._aggregate_hold = -1
+        self._txlock = lock()
+        self._open_entry = None             # Transmit queue entry of the tail, while open
+        self._open_time = 0
+        self._tx_aggregated = 0
+        self._rx_aggregates = 0
+        self._rx_split_dropped = 0
+
+        # Adaptive data rate: transmit power (and with adr_data_rate, data rate) per destination
+        # from the signal heard from it.  adr_margin is the installation margin in dB.
+        self._adr = LinkAdaptation(domain, margin=kwargs['adr_margin'] if 'adr_margin' in kwargs else 10) \
+                        if 'adr' in kwargs and kwargs['adr'] else None
+        self._adr_data_rate = kwargs['adr_data_rate'] if 'adr_data_rate' in kwargs else False
+        self._listen_rate = None        # Data rate to go back to after sending at another
+
+        # Reliable delivery.  address is this node's address; frames to it that ask for
+        # it are acknowledged.  With reliable, unicast frames are sent to be acknowledged
+        # and retried unless send_packet() says otherwise.  delivery(destination, sequence,
+        # delivered) is called from the service thread with the outcome of each.
+        self._address = kwargs['address'] if 'address' in kwargs else None
+        self._reliable_default = kwargs['reliable'] if 'reliable' in kwargs else False
+        self._reliable = ReliableLink(window=kwargs['reliable_window'] if 'reliable_window' in kwargs else 4,
+                                      retries=kwargs['reliable_retries'] if 'reliable_retries' in kwargs else 3)
+        self._ack_guard = kwargs['reliable_timeout'] if 'reliable_timeout' in kwargs else 250
+        self._delivery = kwargs['delivery'] if 'delivery' in kwargs else None
+
+        # Plain and aggregate frames heard again within dedup_lifetime ms are dropped
+        # (reliable frames have their own duplicate check).  dedup_size 0 disables it.
+        self._dedup = DuplicateFilter(size=kwargs['dedup_size'] if 'dedup_size' in kwargs else 16,
+                                      lifetime=kwargs['dedup_lifetime'] if 'dedup_lifetime' in kwargs else 2000)
+
+        # Preallocated SPI transfer buffers so the register path never touches the heap
+        self._spi_tx = bytearray(2)
+        self._spi_rx = bytearray(2)
+        self._spi_address = bytearray(1)
 
     def init(self):
         self._spi = SPI(baudrate=10000000, polarity=0, phase=0, bits=8, firstbit = SPI.MSB,
@@ -52,38 +129,50 @@ class LoRaHandler(SX127x_driver):
         sleep(0.1)
         self._reset.value(1)
 
-    # Read register from SPI port
+    # Read register from SPI port: address and data byte in one full-duplex transfer
     def read_register(self, address):
-        return int.from_bytes(self._spi_transfer(address & 0x7F), 'big')
+        self._spi_tx[0] = address & 0x7F
+        self._spi_tx[1] = 0
+        self._ss.value(0)
+        self._spi.write_readinto(self._spi_tx, self._spi_rx)
+        self._ss.value(1)
+        return self._spi_rx[1]
 
     # Write register to SPI port
     def write_register(self, address, value):
-        self._spi_transfer(address | 0x80, value)
-
-    def _spi_transfer(self, address, value = 0):
-        response = bytearray(1)
+        self._spi_tx[0] = address | 0x80
+        self._spi_tx[1] = value
         self._ss.value(0)
-        self._spi.write(bytes([address]))
-        self._spi.write_readinto(bytes([value]), response)
+        self._spi.write(self._spi_tx)
         self._ss.value(1)
-        return response
 
-    # Read block of data from SPI port
-    def read_buffer(self, address, length):
-        response = bytearray(length)
+    # Read block of data from SPI port into buffer (allocated if not supplied)
+    def read_buffer(self, address, length, buffer=None):
+        if buffer == None:
+            buffer = bytearray(length)
+        self._spi_address[0] = address & 0x7F
         self._ss.value(0)
-        self._spi.write(bytes([address & 0x7F]))
-        self._spi.readinto(response)
+        self._spi.write(self._spi_address)
+        self._spi.readinto(buffer if length == len(buffer) else memoryview(buffer)[0:length])
         self._ss.value(1)
-        return response
+        return buffer
 
     # Write block of data to SPI port
     def write_buffer(self, address, buffer, size):
+        self._spi_address[0] = address | 0x80
         self._ss.value(0)
-        self._spi.write(bytes([address | 0x80]))
-        self._spi.write(memoryview(buffer)[0:size])
+        self._spi.write(self._spi_address)
+        self._spi.write(buffer if size == len(buffer) else memoryview(buffer)[0:size])
         self._ss.value(1)
 
+    # Read contiguous registers in one transfer (device auto-increments the address)
+    def read_registers(self, start, length, buffer=None):
+        return self.read_buffer(start, length, buffer)
+
+    # Write contiguous registers in one transfer
+    def write_registers(self, start, data):
+        self.write_buffer(start, data, len(data))
+
     def attach_interrupt(self, dio, callback):
         if dio < 0 or dio >= len(self._dio_table):
             raise Exception("DIO %d out of range (0..%d)" % (dio, len(self._dio_table) - 1))
@@ -91,44 +180,407 @@ class LoRaHandler(SX127x_driver):
         self._dio_table[dio].irq(handler=callback, trigger=Pin.IRQ_RISING if callback else 0)
 
     def onReceive(self, packet, crc_ok, rssi):
-        print("onReceive: crc_ok %s packet %s rssi %d" % (crc_ok, packet, rssi))
-        if crc_ok:
-            # Check addresses etc
-            self._receive_queue.put({'rssi': rssi, 'data': packet })
+        # print("onReceive: crc_ok %s packet %s rssi %d" % (crc_ok, bytes(packet.data()), rssi))
+        if not crc_ok:
+            packet.release()
+            return
 
-    def receive_packet(self):
-        return self._receive_queue.get()
+        if self._adr != None and packet.length >= FRAME_HEADER_SIZE:
+            self._adr.record((packet.buffer[FRAME_SOURCE] << 8) | packet.buffer[FRAME_SOURCE + 1], packet.rssi, packet.snr)
 
-    # Finished transmitting - see if we can transmit another
-    # If we have another packet, return it to caller.
-    def onTransmit(self):
-        # Delete top packet in queue
-        packet = self._transmit_queue.get(wait=0)
-        del packet
+        kind = frame_type(packet.buffer, packet.length) if self._frame_types else FRAME_PLAIN
+        if (kind == FRAME_PLAIN or kind == FRAME_AGGREGATE) and self._dedup.seen(packet.buffer, packet.length):
+            packet.release()
+
+        elif kind == FRAME_AGGREGATE and packet.length > FRAME_HEADER_SIZE:
+            self._split_packet(packet)
 
-        # Return head of queue.
-        return self._transmit_queue.head()
+        elif kind == FRAME_ACK:
+            self._receive_ack(packet)
+            packet.release()
 
-    # Put packet into transmit queue.  If queue was empty, start transmitting
-    def send_packet(self, packet):
-        with self._loralock:
-            # print("Appending to queue: %s" % packet.decode())
-            self._transmit_queue.put(packet)
-            if len(self._transmit_queue) == 1:
-                self.transmit_packet(packet)
+        elif kind == FRAME_RELIABLE and not self._receive_reliable(packet):
+            # Already delivered
+            packet.release()
+
+        else:
+            # Check addresses etc
+            self._receive_queue.put(packet)
+
+    # Destination address of a frame
+    def _destination(self, frame):
+        return (frame[FRAME_DESTINATION] << 8) | frame[FRAME_DESTINATION + 1]
+
+    # Source address of a frame
+    def _source(self, frame):
+        return (frame[FRAME_SOURCE] << 8) | frame[FRAME_SOURCE + 1]
+
+    # Acknowledge a reliable frame addressed to us.  Returns False if it was seen before.
+    def _receive_reliable(self, packet):
+        buffer = packet.buffer
+        if self._address == None or self._destination(buffer) != self._address:
+            return True
+
+        source = self._source(buffer)
+        fresh, newest, bitmap = self._reliable.receive(source, buffer[FRAME_FLAGS] & FRAME_SEQUENCE_MASK)
+        self.send_packet(bytearray((source >> 8, source & 0xFF, FRAME_ACK | newest,
+                                    self._address >> 8, self._address & 0xFF, bitmap)), reliable=False)
+        return fresh
+
+    # Retire the frames an ACK to us covers and let held ones go
+    def _receive_ack(self, packet):
+        buffer = packet.buffer
+        if self._address == None or self._destination(buffer) != self._address or packet.length < FRAME_ACK_SIZE:
+            return
+
+        with self._txlock:
+            delivered = self._reliable.acknowledge(self._source(buffer), buffer[FRAME_FLAGS] & FRAME_SEQUENCE_MASK,
+                                                   buffer[FRAME_HEADER_SIZE])
+            failed = self._queue_reliable(self._reliable.release(), [])
+
+        for destination, sequence in delivered:
+            self._report(destination, sequence, True)
+        for destination, sequence in failed:
+            self._report(destination, sequence, False)
+
+    # Queue the transmit queue entries of reliable frames to go (again); one the queue has
+    # no room for is given up on and its [ destination, sequence ] added to failed.
+    # Caller holds _txlock.
+    def _queue_reliable(self, entries, failed):
+        for entry in entries:
+            if not self._transmit_queue.put(entry):
+                lost = self._reliable.cancel(entry)
+                if lost != None:
+                    failed.append(lost)
+                self._return_credits(entry, locked=True)
+        return failed
+
+    # Host flow control: a credit to send one frame with send_packet(credit=True).
+    # Waits up to timeout ms for one (0 does not wait).  Always True without flow control.
+    def take_credit(self, timeout=0):
+        return self._credits == None or self._credits.acquire(1, timeout != 0, timeout)
+
+    # Give back a credit taken with take_credit() for a message that will not be sent
+    def return_credit(self):
+        if self._credits != None:
+            self._credits.release()
+
+    # Credits free now (None without flow control)
+    def credits(self):
+        return self._credits.available() if self._credits != None else None
+
+    # Charge a credit to the transmit queue entry of the frame that carries a message
+    # (caller holds _txlock)
+    def _charge_credit(self, entry):
+        if self._credits != None:
+            entry[_TX_CREDITS] += 1
+
+    # Give back the credits of an entry whose frame has gone or never will (locked if the
+    # caller holds _txlock).  A reliable frame sent again holds none.
+    def _return_credits(self, entry, locked=False):
+        if self._credits == None or entry == None:
+            return
+
+        if not locked:
+            self._txlock.acquire()
+        count = entry[_TX_CREDITS]
+        entry[_TX_CREDITS] = 0
+        if not locked:
+            self._txlock.release()
+
+        if count != 0:
+            self._credits.release(count)
+            if self._credit != None:
+                self._credit(self._credits.available())
+
+    def _report(self, destination, sequence, delivered):
+        if self._delivery != None:
+            self._delivery(destination, sequence, delivered)
+
+    # Send again what has not been acknowledged in time.  Returns ms until the next timer (-1 none).
+    def _service_reliable(self):
+        with self._txlock:
+            resend, failed = self._reliable.expired()
+            self._queue_reliable(resend, failed)
+            if len(failed) != 0:
+                self._queue_reliable(self._reliable.release(), failed)
+
+        for destination, sequence in failed:
+            self._report(destination, sequence, False)
+
+        return self._reliable.next_deadline()
+
+    # Queue each message of an aggregate frame as a frame of its own.  The last
+    # message is moved down in the aggregate's own buffer, so n messages take n-1
+    # extra buffers.
+    def _split_packet(self, packet):
+        self._rx_aggregates += 1
+        last = None
+        for start, length in parts(packet.buffer, packet.length):
+            if last != None:
+                self._queue_part(packet, last[0], last[1])
+            last = (start, length)
+
+        if last == None:
+            packet.release()
+            return
+
+        buffer = packet.buffer
+        buffer[FRAME_FLAGS] &= ~FRAME_AGGREGATE
+        for index in range(last[1]):
+            buffer[FRAME_HEADER_SIZE + index] = buffer[last[0] + index]
+        packet.length = FRAME_HEADER_SIZE + last[1]
+        self._receive_queue.put(packet)
+
+    # Copy one message of an aggregate into a pool buffer of its own and queue it
+    def _queue_part(self, packet, start, length):
+        part = self._rx_pool.get()
+        if part == None:
+            self._rx_split_dropped += 1
+            return
+
+        view = packet._view
+        part.buffer[0:FRAME_HEADER_SIZE] = view[0:FRAME_HEADER_SIZE]
+        part.buffer[FRAME_FLAGS] &= ~FRAME_AGGREGATE
+        part.buffer[FRAME_HEADER_SIZE:FRAME_HEADER_SIZE + length] = view[start:start + length]
+        part.length = FRAME_HEADER_SIZE + length
+        part.crc_ok = packet.crc_ok
+        part.rssi = packet.rssi
+        part.snr = packet.snr
+        self._receive_queue.put(part)
+
+    # Returns an SX127x_packet; caller must release() it when finished.
+    # Waits forever, or up to timeout ms and returns None.
+    def receive_packet(self, timeout=-1):
+        return self._receive_queue.get(timeout=timeout)
+
+    # Head of the transmit queue if the channel's airtime budget lets it go now.
+    # Otherwise None and how long to wait (-1 if empty).
+    # Packets longer than the channel ever allows are dropped.
+    def _next_packet(self):
+        while True:
+            entry = self._transmit_queue.head()
+            if entry == None:
+                self._restore_link()
+                return None, -1
+            packet = entry[_TX_FRAME]
+
+            # Leave the tail open to more messages until its hold time is up
+            with self._txlock:
+                if entry is self._open_entry:
+                    hold = ticks_diff(ticks_add(self._open_time, self._aggregate_hold), ticks_ms())
+                    if hold > 0:
+                        return None, hold
+                    self._open_entry = None
+
+            self._select_link(packet)
+
+            channel = self._channel
+            airtime = self.time_on_air(len(packet))
+            wait = self._scheduler.delay(channel[0], channel[1], airtime)
+            if wait == 0:
+                self._tx_airtime = airtime
+                self._tx_waiting = False
+                return packet, 0
+
+            if wait > 0:
+                if not self._tx_waiting:
+                    self._tx_waiting = True
+                    self._tx_deferred += 1
+                self._restore_link()
+                return None, wait
+
+            self._log("LoRaHandler: %d byte packet exceeds channel dwell time; dropped" % len(packet))
+            self._transmit_queue.get(wait=0)
+            self._tx_rejected += 1
+            self._return_credits(entry)
+            if frame_type(packet, len(packet)) == FRAME_RELIABLE:
+                with self._txlock:
+                    lost = self._reliable.cancel(entry)
+                if lost != None:
+                    self._report(lost[0], lost[1], False)
+
+    # Set transmit power (and data rate) for the frame's destination.  Under the driver
+    # lock, as start_scan(), stop_scan() and close() change the same registers.
+    def _select_link(self, packet):
+        if self._adr == None or len(packet) < FRAME_HEADER_SIZE:
+            return
+
+        with self._lock:
+            channel = self._channel
+            data_rate = self._listen_rate if self._listen_rate != None else channel[2]
+            data_rate, power = self._adr.select((packet[FRAME_DESTINATION] << 8) | packet[FRAME_DESTINATION + 1],
+                                                channel[0], channel[1], data_rate, self._adr_data_rate)
+            if data_rate != channel[2]:
+                if self._listen_rate == None:
+                    self._listen_rate = channel[2]
+                elif data_rate == self._listen_rate:
+                    self._listen_rate = None
+                self.set_channel(channel[0], channel[1], data_rate)
+
+            if power != None and power != self._tx_power[0]:
+                self.set_tx_power(power)
+
+    # Back to the data rate we listen on
+    def _restore_link(self):
+        if self._listen_rate != None:
+            with self._lock:
+                if self._listen_rate != None:
+                    channel = self._channel
+                    self.set_channel(channel[0], channel[1], self._listen_rate)
+                    self._listen_rate = None
+
+    def link_stats(self):
+        return self._adr.stats() if self._adr != None else {}
 
+    # Finished transmitting - see if we can transmit another
+    # If we have another packet it may go now, return it to caller.
+    def onTransmit(self):
+        # Delete top packet in queue; a reliable one waits for its ACK
+        entry = self._transmit_queue.get(wait=0)
+        if entry != None and frame_type(entry[_TX_FRAME], len(entry[_TX_FRAME])) == FRAME_RELIABLE:
+            with self._txlock:
+                self._reliable.transmitted(entry)
+        self._return_credits(entry)
+        del entry
+
+        # Charged now it is done, as listen before talk may have delayed the start
+        channel = self._channel
+        self._scheduler.charge(channel[0], channel[1], self._tx_airtime, ticks_add(ticks_ms(), -int(self._tx_airtime)))
+
+        packet, wait = self._next_packet()
+        self._transmitting = packet != None
+        return packet
+
+    # Start the head of the transmit queue when the airtime budget allows
+    def onPoll(self):
+        timer = self._service_reliable()
+        if self._transmitting:
+            return timer
+
+        packet, wait = self._next_packet()
+        if packet != None:
+            self._transmitting = True
+            self.transmit_packet(packet)
+            return timer
+
+        return timer if wait < 0 or (timer >= 0 and timer < wait) else wait
+
+    # Largest frame the current data rate carries
+    def _max_frame(self):
+        data_rate = self._channel[2]
+        return self._data_rates[data_rate]['n'] if data_rate in self._data_rates else _LORA_MAX_FRAME
+
+    # Retransmission timeout for a frame: its own airtime and the ACK's plus a guard for
+    # the receiver to get a turn on the channel.  Doubles with each retry.
+    def _ack_timeout(self, frame):
+        return int(self.time_on_air(len(frame)) + self.time_on_air(FRAME_ACK_SIZE)) + self._ack_guard
+
+    # Put packet into transmit queue; the service thread sends it when the channel allows.
+    # A packet for the same route as a tail frame that has not gone yet is added to it.
+    # A unicast packet sent reliably (reliable None takes the handler's default; needs
+    # frame_types) is numbered and retried until acknowledged; its sequence number is returned (None if
+    # the transmit queue was full and it was dropped).  With credit, the caller has taken a
+    # credit for it with take_credit().
+    def send_packet(self, packet, reliable=None, credit=False):
+        # print("Appending to queue: %s" % packet.decode())
+        reliable = self._reliable_default if reliable == None else reliable
+        if reliable and self._frame_types and len(packet) >= FRAME_HEADER_SIZE and packet[FRAME_DESTINATION + 1] & FRAME_UNIT_MASK != FRAME_BROADCAST_UNIT:
+            if type(packet) != bytearray:
+                packet = bytearray(packet)
+            # The entry goes with the frame while it is held for the window and when sent again
+            entry = [ packet, 0 ]
+            with self._txlock:
+                sequence, now = self._reliable.add(self._destination(packet), entry, self._ack_timeout(packet))
+                packet[FRAME_FLAGS] = FRAME_RELIABLE | sequence
+                if credit:
+                    self._charge_credit(entry)
+                if now:
+                    self._open_entry = None
+                    if not self._transmit_queue.put(entry):
+                        self._reliable.cancel(entry)
+                        self._return_credits(entry, locked=True)
+                        return None
+            self.wake()
+            return sequence
+
+        with self._txlock:
+            if self._open_entry != None and aggregate(self._open_entry[_TX_FRAME], packet, self._max_frame()):
+                self._tx_aggregated += 1
+                if credit:
+                    self._charge_credit(self._open_entry)
+                return None
+
+            self._open_entry = None
+            if self._aggregate_hold >= 0 and frame_type(packet, len(packet)) == FRAME_PLAIN and len(packet) >= FRAME_HEADER_SIZE:
+                if type(packet) != bytearray:
+                    packet = bytearray(packet)
+                entry = [ packet, 0 ]
+                if self._transmit_queue.put(entry):
+                    self._open_entry = entry
+                    self._open_time = ticks_ms()
+                else:
+                    entry = None
+            else:
+                entry = [ packet, 0 ]
+                if not self._transmit_queue.put(entry):
+                    entry = None
+
+            if credit:
+                if entry != None:
+                    self._charge_credit(entry)
+                else:
+                    # Dropped: the credit was never spent
+                    self.return_credit()
+
+        self.wake()
+        return None
+
+    # Projected milliseconds until everything queued now has been sent
+    def drain_time(self):
+        channel = self._channel
+        return self._scheduler.drain_time(channel[0], channel[1],
+                                          [ self.time_on_air(len(entry[_TX_FRAME])) for entry in self._transmit_queue.items() ])
+
+    def receive_stats(self):
+        return {
+            'queued':        len(self._receive_queue),
+            'queue':         self._receive_queue.stats(),
+            'aggregates':    self._rx_aggregates,
+            'split_dropped': self._rx_split_dropped,
+            'duplicates':    self._dedup.stats(),
+            'pool':          self.rx_pool_stats(),
+        }
+
+    def transmit_stats(self):
+        return {
+            'queued':     len(self._transmit_queue),
+            'queue':      self._transmit_queue.stats(),
+            'deferred':   self._tx_deferred,
+            'rejected':   self._tx_rejected,
+            'aggregated': self._tx_aggregated,
+            'drain_ms':   self.drain_time(),
+            'airtime_ms': self._scheduler.stats(),
+            'reliable':   self._reliable.stats(),
+            'credits':    self.credits(),
+        }
+
+    # Does nothing if not open, so the call from __del__ after close() cannot
+    # detach the interrupts of whatever handler owns the pins now
     def close(self):
-        print("LoRa handler close called")
+        if getattr(self, '_spi', None) == None:
+            return
+
+        self._log("LoRa handler close called")
         # Close DIO interrupts
         for dio in self._dio_table:
             dio.irq(handler=None, trigger=0)
 
         super().close()
-        if self._spi:
-            self._spi.deinit()
-            self._spi = None
-
+        # Power down while the SPI port is still available
         self.set_power(False)
+        self._spi.deinit()
+        self._spi = None
 
     def set_power(self, power=True):
         # print("set_power %s" % power)
@@ -1,5 +1,5 @@
 import gc
-from uthread import thread
+from uthread import thread, executor
 from urandom import randrange
 from time import sleep
 import machine
@@ -59,6 +59,16 @@ CONFIG_DATA = ConfigData(read = storage,
                                 'direction': 'up',
                                 '%direction%options': ( 'up', 'down' ),
                                 'datarate': '4',
+                                'hop_period': '0',
+                                'scan': '',
+                                'frame_types': '0',
+                                '%frame_types%options': ( '0', '1' ),
+                                'reliable': '0',
+                                '%reliable%options': ( '0', '1' ),
+                                'mesh': '0',
+                                '%mesh%options': ( '0', '1' ),
+                                'mesh_ttl': '4',
+                                'credits': '8',
                             },
                          })
 
@@ -74,17 +84,53 @@ _UNIT = int(CONFIG_DATA.get("lora.unit", "1"))
 
 from loradomains import US902_928 as domain
 from loracom import LoRaHandler
+from loraframe import FRAME_NONCE_MASK
+# Frame types in byte 2 (aggregation, reliable delivery and mesh).  Every unit on the
+# network must have the same setting: see README.
+_FRAME_TYPES = CONFIG_DATA.get("lora.frame_types", default='0') == '1'
 lora=LoRaHandler(
         domain,
+        frame_types=_FRAME_TYPES,
+        address=(_NETWORK << 6) + _UNIT,
+        # Frames for other networks and units are dropped as they arrive
+        address_filter=(_NETWORK, (_UNIT,)),
+        # Acknowledged delivery (needs lora.frame_types)
+        reliable=CONFIG_DATA.get("lora.reliable", default='0') == '1',
+        # Defined with the serial link below
+        delivery=lambda destination, sequence, delivered: delivery_to_host(destination, sequence, delivered),
+        # Host frames waiting to go at once (0 for no flow control); freed credits are advertised to the host
+        credits=int(CONFIG_DATA.get("lora.credits", default='8')),
+        credit=lambda available: credits_to_host(available),
+        log=lambda text: log_to_host(text),
         enable_crc=False,
+        aggregate_hold=50,
+        listen_before_talk=True,
+        adr=True,
+        hop_period=int(CONFIG_DATA.get("lora.hop_period", default='0')),
+        # Comma separated channels to scan (gateway); empty to stay on 'channel'
+        scan_channels=[ int(c) for c in CONFIG_DATA.get("lora.scan", default='').split(',') if c.strip() ] or None,
+        rx_buffers=8,
         channel=(int(CONFIG_DATA.get("lora.channel", default='64')), CONFIG_DATA.get("lora.direction", default='up'), int(CONFIG_DATA.get("lora.datarate", default='4'))),
 )
 lora.init()
 
+# With mesh on, frames reach units out of range through the others; 'link' is what to send and receive on.
+# Mesh frames are marked in byte 2, so mesh needs frame types.
+if _FRAME_TYPES and CONFIG_DATA.get("lora.mesh", default='0') == '1':
+    from loramesh import MeshRouter
+    link = MeshRouter(lora, (_NETWORK << 6) + _UNIT, ttl=int(CONFIG_DATA.get("lora.mesh_ttl", default='4')))
+else:
+    link = lora
+
+# Pooled threads for short and timed jobs
+jobs = executor(workers=1, stack=4096, log=lambda text: log_to_host(text))
+jobs.start()
+
 # Start web server
 from lorawebserver import *
 webserver = LoRaWebserver(
         config=CONFIG_DATA,
+        executor=jobs,
         display=lambda text, line=4, clear=False : display.show_text_wrap(text, start_line=line, clear_first=clear),
 )
 webserver.start()
@@ -92,132 +138,195 @@ webserver.start()
 led = machine.Pin(25, machine.Pin.OUT)
 
 import sys
-
-# Input is a byte array of data.  Output is bytes with escape chars and returned checksum of array
-def escape_data(data, sum=0):
-    out = bytearray()
-    for i in range(len(data)):
-        ch = data[i]
-        sum += ch
-        if ch < 32 or ch > 127 or ch in [ ord('$'), ord('%'), ord(':') ]:
-            out.append(ord('%'))
-            hexval = "%02x" % ch
-            out.append(ord(hexval[0]))
-            out.append(ord(hexval[1]))
-        else:
-            out.append(ch)
-            
-    # return out.decode(), sum
-    return bytes(out), sum
+from ulock import lock
+from loraserial import *
+
+# Host link starts in ASCII mode; the host may switch it to binary (see loraserial)
+serial_mode = SERIAL_ASCII
+framing = BinaryFraming()
+ascii_framing = AsciiFraming()
+serial_lock = lock()
+serial_out = sys.stdout.buffer if hasattr(sys.stdout, 'buffer') else sys.stdout
+serial_in = sys.stdin.buffer if hasattr(sys.stdin, 'buffer') else sys.stdin
+# Where console reads return whatever is waiting they are taken 64 bytes at a time.
+# MicroPython's console read blocks until the buffer is full, so a short line
+# (e.g. '+BINARY') would stall there: it is read a byte at a time, as each poll allows.
+serial_reader = SerialReader(serial_in, chunk=64 if sys.implementation.name != 'micropython' else 1)
+
+# Write bytes to the host without interleaving with the other thread
+def serial_write(data):
+    with serial_lock:
+        serial_out.write(data)
+
+# Driver and executor diagnostics.  In binary mode they would corrupt the frame
+# stream, so they are only written in ASCII mode.
+def log_to_host(text):
+    if serial_mode == SERIAL_ASCII:
+        serial_write((text + "\n").encode())
+
+# Encode and write a frame; the encoders' buffers are shared by both threads
+def serial_frame(encode, *args):
+    with serial_lock:
+        serial_out.write(encode(*args))
 
 def handle_lora_receive(t):
     global _NETWORK, _UNIT
 
     while t.running:
-        packet = lora.receive_packet()
-        if 'data' in packet:
+        packet = link.receive_packet()
+        if packet:
             led.on()
-            data = packet['data']
-            print("Rcv: %s" % data)
-            # The address is the first two bytes of the message
-            address = data[0] * 256 + data[1]
-            net = address >> 6
-            unit = address % 64
-            # If to our network and either broadcast or our unit, process it.
-            if (net == _NETWORK and (unit == _BROADCAST_UNIT or unit == _UNIT)):
-                ##########################
-                # Decrypt packet here...
-                ##########################
-                fromaddr = data[3] * 256 + data[4]
-                display.show_text_wrap("from %x %d" % (fromaddr, packet['rssi']), start_line=1, clear_first=False)
-                display.show_text_wrap(data[5:].decode(), start_line=2, clear_first=False)
-                # Send packet to output stream
-                output, sum = escape_data(data)
-                sys.stdout.write("$")
-                sys.stdout.write(output)
-                sys.stdout.write(":%d:%d\r\n" % (sum % 0x10000, packet['rssi']))
-
-                # if a PING packet, reply with 'reply' packet
-                if data[5:10] == b'ping ':
-                    # Send reponse to the originating address
-                    send_packet_to(fromaddr, "reply %s (%d)" % (data[10:].decode(), packet['rssi']))
+            try:
+                data = packet.data()
+                if serial_mode == SERIAL_ASCII:
+                    print("Rcv: %s" % bytes(data))
+                # The address is the first two bytes of the message
+                address = data[0] * 256 + data[1]
+                net = address >> 6
+                unit = address % 64
+                # If to our network and either broadcast or our unit, process it.
+                if (net == _NETWORK and (unit == _BROADCAST_UNIT or unit == _UNIT)):
+                    ##########################
+                    # Decrypt packet here...
+                    ##########################
+                    fromaddr = data[3] * 256 + data[4]
+                    display.show_text_wrap("from %x %d" % (fromaddr, packet.rssi), start_line=1, clear_first=False)
+                    display.show_text_wrap(bytes(data[5:]).decode(), start_line=2, clear_first=False)
+                    # Send packet to output stream
+                    if serial_mode == SERIAL_BINARY:
+                        serial_frame(framing.encode_receive, data, packet.rssi, packet.snr, packet.channel, ticks_ms())
+                    else:
+                        serial_frame(ascii_framing.encode_receive, data, packet.rssi)
+
+                    # if a PING packet, reply with 'reply' packet
+                    if bytes(data[5:10]) == b'ping ':
+                        # Send reponse to the originating address
+                        send_packet_to(fromaddr, "reply %s (%d)" % (bytes(data[10:]).decode(), packet.rssi))
+            finally:
+                # Hand the buffer back to the driver's pool
+                packet.release()
             led.off()
 
     return 0
 
 
-# Remove #xx escapes from message and return message cksum
-def unescape_data(buffer):
-    # print("escape_process in: %s" % buffer)
-    out = bytearray()
-    sum = 0
-    index = 0
-    while index < len(buffer):
-        ch = buffer[index]
-        sum += ch
-        if ch == ord('%'):
-            # Accept two hex values as a character
-            out.append(int("0x%c%c" % (buffer[index + 1], buffer[index+2])) % 256)
-            index += 2
-        else:
-            out.append(ch)
-        index += 1
-
-    # print("escape_process out: %s, sum %d" % (out, sum))
-    return bytes(out), sum
-
+# Act on one decoded binary frame from the host
+def handle_binary_frame(type, payload):
+    global serial_mode
+
+    if type == FRAME_SEND and len(payload) >= 2 and not lora.take_credit():
+        serial_frame(framing.encode_status, STATUS_BUSY, bytes((payload[0], payload[1])))
+
+    elif type == FRAME_SEND and len(payload) >= 2:
+        sequence = send_packet_to((payload[0] << 8) + payload[1], bytearray(payload[2:]), credit=True)
+        serial_frame(framing.encode_status, STATUS_OK, b'' if sequence == None else bytes((payload[0], payload[1], sequence)))
+
+    elif type == FRAME_MODE and len(payload) == 1 and payload[0] == SERIAL_ASCII:
+        serial_mode = SERIAL_ASCII
+        serial_write(ASCII_REPLY)
+        if lora.credits() != None:
+            credits_to_host(lora.credits())
+
+    else:
+        serial_frame(framing.encode_status, STATUS_UNKNOWN_TYPE, bytes((type,)))
+
+# Tell the host whether a reliable frame got through
+def delivery_to_host(destination, sequence, delivered):
+    if serial_mode == SERIAL_BINARY:
+        serial_frame(framing.encode_status, STATUS_DELIVERED if delivered else STATUS_UNDELIVERED,
+                     bytes((destination >> 8, destination & 0xFF, sequence)))
+    else:
+        serial_write(('+%s %04x %d\r\n' % ('DELIVERED' if delivered else 'UNDELIVERED', destination, sequence)).encode())
+
+# Tell the host how many frames it may have waiting to go
+def credits_to_host(available):
+    if serial_mode == SERIAL_BINARY:
+        serial_frame(framing.encode_status, STATUS_CREDITS, bytes((min(available, 255),)))
+    else:
+        serial_write(('+CREDITS %d\r\n' % available).encode())
+
+# Handle one ASCII mode line from the host
+def handle_ascii_line(line):
+    global serial_mode
+
+    if len(line) != 0 and line[0] == 0x2B:      # '+'
+        # Mode negotiation line
+        if bytes(line).strip() == BINARY_REQUEST:
+            serial_write(BINARY_REQUEST + (' %d\r\n' % PROTOCOL_VERSION).encode())
+            serial_mode = SERIAL_BINARY
+            if lora.credits() != None:
+                credits_to_host(lora.credits())
+        return
+
+    errors = ascii_framing.crc_errors + ascii_framing.framing_errors
+    buffer = ascii_framing.decode(line, len(line))
+    if buffer != None and len(buffer) >= 2:
+        # The destination address is taken from the first two bytes
+        # The source address along with the random byte will be generated...
+        address = (buffer[0] << 8) + buffer[1]
+        if not lora.take_credit():
+            serial_write(('+BUSY %04x\r\n' % address).encode())
+            return
+        sequence = send_packet_to(address, bytearray(buffer[2:]), credit=True)
+        if sequence != None:
+            serial_write(('+SENT %04x %d\r\n' % (address, sequence)).encode())
+    elif ascii_framing.crc_errors + ascii_framing.framing_errors != errors:
+        print("-ERROR: bad frame")
+
+# Handle one COBS block from the host
+def handle_binary_block(block):
+    if len(block) == 0:
+        return
+
+    crc_errors = framing.crc_errors
+    frame = framing.decode(block, len(block))
+    if frame:
+        handle_binary_frame(frame[0], frame[1])
+    else:
+        serial_frame(framing.encode_status, STATUS_CRC_ERROR if framing.crc_errors != crc_errors else STATUS_FRAME_ERROR)
+
+# Split host input into lines or COBS blocks as it arrives and act on each
 def handle_lora_send(t):
-    state = 'start'
-
     while t.running:
-        ch = sys.stdin.read(1)
-        if state == 'start':
-            if ch == '$':
-                # Start over if $
-                state = 'data'
-                buffer = bytearray()
-
-        elif state == 'data':
-            if ch == ':':
-                # End of data
-                state = 'cksum'
-                value = bytearray()
-
+        serial_reader.fill(1000)
+        while True:
+            # The mode may change part way through what has been read
+            binary = serial_mode == SERIAL_BINARY
+            frame = serial_reader.frame(BINARY_DELIMITER if binary else ASCII_DELIMITER)
+            if frame == None:
+                break
+            if binary:
+                handle_binary_block(frame)
             else:
-                buffer.extend(ch)
-
-        elif state == 'cksum':
-            if ch == '\n':
-                try:
-                    value, dummy = unescape_data(value)
-                    cksum = int(value, 16)
-                    buffer, found = unescape_data(buffer)
-                    if found == cksum:
-                        # The destination address is taken from the first two bytes
-                        # The source address along with the random byte will be generated...
-                        address = (buffer[0] << 8) + buffer[1]
-                        send_packet_to(address, buffer[2:])
-                    else:
-                        print("-ERROR: wanted %04x found %04x" % (found, cksum))
-
-                except Exception as e:
-                    print("-ERROR: %s" % str(e))
+                handle_ascii_line(frame)
 
-                state = 'start'
+# Host link statistics
+def serial_stats():
+    stats = serial_reader.stats()
+    stats['framing_errors'] = framing.framing_errors + ascii_framing.framing_errors
+    stats['crc_errors'] = framing.crc_errors + ascii_framing.crc_errors
+    return stats
 
-            else:
-                value.extend(ch)
 
+# Nonce of the last frame sent.  It counts up rather than being drawn at random, so
+# two frames from here only share one after 32 others (256 without frame types)
+# and a message sent twice is never dropped by the receiver as a duplicate.
+_nonce = randrange(0, 256)
 
-def send_packet_to(address, buffer):
-    global _NETWORK, _UNIT
+# Returns the sequence number if sent reliably, else None.  credit: the caller has
+# taken a flow control credit for it (see LoRaHandler.take_credit())
+def send_packet_to(address, buffer, credit=False):
+    global _NETWORK, _UNIT, _nonce
 
     # print("send_packet_to: %04x: %s" % (address, buffer))
 
     address = bytearray(((address >> 8) % 256, address % 256))
 
     fromaddr = (_NETWORK << 6) + _UNIT
-    header = bytearray((randrange(0, 256), (fromaddr >> 8) % 256, fromaddr % 256))
+    # With frame types the type bits of the nonce byte are left clear; LoRaHandler sets them
+    # when aggregating or sending reliably
+    _nonce = (_nonce + 1) & (FRAME_NONCE_MASK if _FRAME_TYPES else 0xFF)
+    header = bytearray((_nonce, (fromaddr >> 8) % 256, fromaddr % 256))
 
     if type(buffer) == str:
         buffer = bytearray(buffer)
@@ -228,10 +337,11 @@ def send_packet_to(address, buffer):
     # Encrypt buffer here
     ######################
 
-    lora.send_packet(address + buffer)
+    sequence = link.send_packet(address + buffer, credit=credit)
     # print("sent %s" % bytes(address + buffer))
 
     gc.collect()
+    return sequence
 
 from time import ticks_ms, ticks_diff
 ping_counter = 0
@@ -250,9 +360,16 @@ def send_button_packet(event):
         send_packet_to(address, "ping %d" % ping_counter)
         last_time = now
 
+# Button interrupt hands the broadcast to the job pool rather than sending from the handler.
+# The job is made here as the handler must not allocate.
+button_job = jobs.job(send_button_packet, None)
+
+def button_pressed(event):
+    jobs.submit_isr(button_job)
+
 # Set up interrupt on a pin to send a broadcast packet
 button = machine.Pin(0)
-button.irq(handler=send_button_packet, trigger=machine.Pin.IRQ_FALLING)
+button.irq(handler=button_pressed, trigger=machine.Pin.IRQ_FALLING)
 
 # Start thread to handle input from LORA
 input_thread = thread(run=handle_lora_receive, stack=8192)
@@ -270,4 +387,6 @@ while True:
     gc.collect()
     display.show_text_wrap("Mem: %d" % gc.mem_free(), start_line=6, clear_first=False)
     display.show_text_wrap("Tx %d Rx %d" % (lora._tx_interrupts, lora._rx_interrupts), start_line=7, clear_first=False)
+    stats = serial_stats()
+    display.show_text_wrap("Ser %.1f/s err %d" % (stats['frames_per_sec'], stats['framing_errors'] + stats['crc_errors']), start_line=5, clear_first=False)
 
@@ -0,0 +1,99 @@
+#
+# Seen-frame cache for dropping frames heard more than once.
+#
+# A frame is known by its source address, its type/nonce byte and a hash of
+# its destination, payload and length (or whatever key seen_key() is given).
+# The cache is a fixed ring of entries in arrays (times in a list, as ticks
+# are wider than any array type on some ports), so checking a frame
+# allocates nothing; an entry older than 'lifetime' ms no longer matches and
+# the oldest entry is overwritten when the ring is full.
+#
+# The nonce in the type byte is all that tells a message sent twice from a
+# repeat of the first, so senders count it up (see loracom_main) rather than
+# drawing it at random: with frame types it is only five bits.
+#
+# Times are in milliseconds and 'now' is a ticks_ms() value.
+#
+from array import array
+from sx127x import ticks_ms, ticks_diff
+from loraframe import FRAME_DESTINATION, FRAME_FLAGS, FRAME_SOURCE, FRAME_HEADER_SIZE
+
+try:
+    _UNUSED_=const(1)
+except:
+    const = lambda x: x
+
+_HASH_MASK              = const(0xFFFFF)    # 20 bits keeps the arithmetic in small ints
+
+# Hash of bytes start..end-1 of frame, continuing from hash
+def frame_hash(frame, start, end, hash=5381):
+    for index in range(start, end):
+        hash = ((hash << 5) + hash + frame[index]) & _HASH_MASK
+    return hash
+
+# Parameters
+#     size           - frames remembered
+#     lifetime       - ms a frame is remembered for
+#
+class DuplicateFilter():
+    def __init__(self, **kwargs):
+        self._size     = kwargs['size']     if 'size'     in kwargs else 16
+        self._lifetime = kwargs['lifetime'] if 'lifetime' in kwargs else 2000
+
+        self._source = array('H', [ 0 ] * self._size)
+        self._tag    = bytearray(self._size)
+        self._hash   = array('L', [ 0 ] * self._size)
+        self._length = bytearray(self._size)
+        self._time   = [ 0 ] * self._size
+        self._used   = bytearray(self._size)
+        self._next   = 0
+
+        self._hits = 0
+        self._misses = 0
+
+    # True if the first length bytes of frame were seen within the lifetime.
+    # Otherwise remembers it and returns False.
+    def seen(self, frame, length, now=None):
+        if self._size == 0 or length < FRAME_HEADER_SIZE:
+            return False
+
+        return self.seen_key((frame[FRAME_SOURCE] << 8) | frame[FRAME_SOURCE + 1], frame[FRAME_FLAGS],
+                             frame_hash(frame, FRAME_HEADER_SIZE, length, frame_hash(frame, FRAME_DESTINATION, FRAME_DESTINATION + 2)),
+                             length, now)
+
+    # As seen() for a frame already reduced to its source, tag byte, hash and length
+    def seen_key(self, source, tag, hash, length, now=None):
+        if self._size == 0:
+            return False
+
+        now = ticks_ms() if now == None else now
+        size = length & 0xFF
+
+        for index in range(self._size):
+            if (self._used[index] and self._source[index] == source and self._tag[index] == tag and
+                    self._hash[index] == hash and self._length[index] == size):
+                if ticks_diff(now, self._time[index]) < self._lifetime:
+                    self._hits += 1
+                    return True
+                # Stale: refresh in place
+                self._time[index] = now
+                self._misses += 1
+                return False
+
+        index = self._next
+        self._next = (index + 1) % self._size
+        self._used[index] = 1
+        self._source[index] = source
+        self._tag[index] = tag
+        self._hash[index] = hash
+        self._length[index] = size
+        self._time[index] = now
+        self._misses += 1
+        return False
+
+    def stats(self):
+        return {
+            'size':   self._size,
+            'hits':   self._hits,
+            'misses': self._misses,
+        }
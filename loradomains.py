@@ -42,8 +42,12 @@ US902_928 = {
     # 'chan': ( <low inclusive channel>, <high inclusive channel>),
     # 'dr': (<low inclusive datarate>, <high inclusive datarate>),
     # 'freq': (<starting freq>, <step>),
+    # Optional airtime limits, per channel:
+    # 'dwell': (<max ms on air>, <in any window of ms>),
+    # 'duty': <max fraction of time on air>,
     'channels': (
-        { 'type': 'up',   'chan': (0, 63),  'dr': (0, 3), 'freq': (902300000,  200000), },
+        # FCC 15.247 hybrid mode: 400 mS dwell in any 20 S on the narrow-band channels
+        { 'type': 'up',   'chan': (0, 63),  'dr': (0, 3), 'freq': (902300000,  200000), 'dwell': (400, 20000), },
         { 'type': 'up',   'chan': (64, 71), 'dr': (4, 4), 'freq': (903000000, 1600000), },
         # { 'type': 'down', 'chan': (0, 7),   'dr': (4, 4), 'freq': (923300000,  600000), },
         { 'type': 'down', 'chan': (0, 7),   'dr': (8, 13), 'freq': (923300000,  600000), },
@@ -0,0 +1,101 @@
+#
+# LoRa frame layout used by the serial bridge
+#
+#    0..1    destination address (network << 6 | unit)
+#    2       type | nonce or sequence
+#    3..4    source address
+#    5..     payload
+#
+# Frame types (top two bits of byte 2):
+#
+#    FRAME_PLAIN      one message; low bits are a random nonce, with FRAME_MESH
+#                     set if the payload starts with a mesh header (see loramesh)
+#    FRAME_AGGREGATE  several messages between the same two addresses.  The
+#                     payload is a sequence of <length byte> <length bytes of message>.
+#    FRAME_RELIABLE   one message the destination acknowledges; low bits are
+#                     the sequence number
+#    FRAME_ACK        acknowledgement; low bits are the newest sequence number
+#                     received from the destination, the one byte payload has
+#                     bit n set if sequence number - 1 - n was received too
+#
+
+try:
+    _UNUSED_=const(1)
+except:
+    const = lambda x: x
+
+FRAME_DESTINATION       = const(0)
+FRAME_FLAGS             = const(2)
+FRAME_SOURCE            = const(3)
+FRAME_HEADER_SIZE       = const(5)
+
+FRAME_TYPE_MASK         = const(0xC0)
+FRAME_PLAIN             = const(0x00)
+FRAME_AGGREGATE         = const(0x80)      # Payload is a list of messages
+FRAME_RELIABLE          = const(0x40)      # Sequenced, to be acknowledged
+FRAME_ACK               = const(0xC0)      # Acknowledgement bitmap
+FRAME_MESH              = const(0x20)      # Plain frame carrying a mesh header
+FRAME_NONCE_MASK        = const(0x1F)      # Random part of a plain frame's type byte
+FRAME_SEQUENCE_MASK     = const(0x3F)      # Sequence number of a reliable frame or ACK
+FRAME_ACK_SIZE          = const(FRAME_HEADER_SIZE + 1)
+
+FRAME_UNIT_MASK         = const(0x3F)
+FRAME_BROADCAST_UNIT    = const(0x3F)      # Unit that every unit of a network accepts
+
+# Type of a frame of length bytes (FRAME_PLAIN if too short to have one)
+def frame_type(frame, length):
+    return frame[FRAME_FLAGS] & FRAME_TYPE_MASK if length >= FRAME_HEADER_SIZE else FRAME_PLAIN
+
+# Maximum size of one message inside an aggregate
+_MAX_PART               = const(255)
+
+# True if frames a and b go between the same two addresses
+def same_route(a, b):
+    return (a[FRAME_DESTINATION] == b[FRAME_DESTINATION] and a[FRAME_DESTINATION + 1] == b[FRAME_DESTINATION + 1] and
+            a[FRAME_SOURCE] == b[FRAME_SOURCE] and a[FRAME_SOURCE + 1] == b[FRAME_SOURCE + 1])
+
+# Add the payload of single-message frame to the bytearray target (converting
+# target to the aggregate layout first if needed).  Returns False, leaving
+# target untouched, if the frames cannot be combined within size bytes.
+def aggregate(target, frame, size):
+    if len(target) < FRAME_HEADER_SIZE or len(frame) < FRAME_HEADER_SIZE:
+        return False
+
+    if frame[FRAME_FLAGS] & (FRAME_TYPE_MASK | FRAME_MESH) != FRAME_PLAIN or not same_route(target, frame):
+        return False
+
+    if target[FRAME_FLAGS] & FRAME_MESH:
+        return False
+
+    if target[FRAME_FLAGS] & FRAME_TYPE_MASK not in (FRAME_PLAIN, FRAME_AGGREGATE):
+        return False
+
+    part = len(frame) - FRAME_HEADER_SIZE
+    if part > _MAX_PART:
+        return False
+
+    if target[FRAME_FLAGS] & FRAME_TYPE_MASK == FRAME_AGGREGATE:
+        if len(target) + 1 + part > size:
+            return False
+    else:
+        first = len(target) - FRAME_HEADER_SIZE
+        if first > _MAX_PART or len(target) + 2 + part > size:
+            return False
+        target[FRAME_HEADER_SIZE:FRAME_HEADER_SIZE] = bytes((first,))
+        target[FRAME_FLAGS] |= FRAME_AGGREGATE
+
+    target.append(part)
+    target.extend(memoryview(frame)[FRAME_HEADER_SIZE:])
+    return True
+
+# Yield (start, length) of each message in the first length bytes of an aggregate frame.
+# Stops at the first part that runs past the end.
+def parts(frame, length):
+    index = FRAME_HEADER_SIZE
+    while index < length:
+        part = frame[index]
+        index += 1
+        if index + part > length:
+            return
+        yield index, part
+        index += part
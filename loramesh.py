@@ -0,0 +1,247 @@
+#
+# Multi-hop forwarding on top of LoRaHandler.
+#
+# A mesh frame is a plain frame with FRAME_MESH set whose payload starts with
+# a mesh header:
+#
+#    0..1    next hop (broadcast unit of our network when flooding)
+#    2       FRAME_PLAIN | FRAME_MESH | nonce
+#    3..4    this hop
+#    5       ttl: hops it may still take
+#    6       hops taken so far
+#    7..8    origin address
+#    9..10   final destination address
+#    11      origin's mesh sequence number
+#    12..    payload
+#
+# Every frame heard teaches a route to the hop it came from (one hop), and a
+# mesh frame a route to its origin through that hop.  Routes prefer fewer
+# hops, then the stronger signal from the next hop, and lapse after
+# 'lifetime' ms.  A frame with a route to its destination is passed to the
+# next hop only; without one it is flooded to every neighbour.  Each node
+# forwards a given (origin, sequence, payload) once, and not after its ttl
+# runs out.
+#
+# The router hands the application frames in the ordinary layout (destination,
+# type byte, source = origin, payload), so code above it sees no difference.
+# Mesh frames go hop by hop without link acknowledgements.
+#
+from sx127x import ticks_ms, ticks_diff, randrange
+from loraframe import *
+from loradedup import DuplicateFilter, frame_hash
+
+try:
+    _UNUSED_=const(1)
+except:
+    const = lambda x: x
+
+MESH_TTL                = const(5)
+MESH_HOPS               = const(6)
+MESH_ORIGIN             = const(7)
+MESH_TARGET             = const(9)
+MESH_SEQUENCE           = const(11)
+MESH_HEADER_SIZE        = const(12)
+
+# Route entry
+_ROUTE_NEXT_HOP         = const(0)
+_ROUTE_HOPS             = const(1)
+_ROUTE_RSSI             = const(2)
+_ROUTE_TIME             = const(3)
+
+def _address(frame, offset):
+    return (frame[offset] << 8) | frame[offset + 1]
+
+def _put_address(frame, offset, address):
+    frame[offset] = address >> 8
+    frame[offset + 1] = address & 0xFF
+
+# Parameters
+#     ttl            - hops a frame this node originates may take
+#     routes         - destinations remembered (least recently refreshed is dropped)
+#     lifetime       - ms a route is trusted without being heard again
+#     seen           - (origin, sequence) pairs remembered to forward each frame once
+#
+class MeshRouter():
+    def __init__(self, handler, address, **kwargs):
+        self._handler  = handler
+        self._address  = address
+        self._ttl      = kwargs['ttl']      if 'ttl'      in kwargs else 4
+        self._max_routes = kwargs['routes'] if 'routes'   in kwargs else 32
+        self._lifetime = kwargs['lifetime'] if 'lifetime' in kwargs else 600000
+        self._seen = DuplicateFilter(size=kwargs['seen'] if 'seen' in kwargs else 32, lifetime=30000)
+
+        # Floods go to every unit of our network
+        self._broadcast = (address & ~FRAME_UNIT_MASK) | FRAME_BROADCAST_UNIT
+
+        # destination -> [ <next hop>, <hops>, <rssi of next hop>, <last heard> ]
+        self._routes = {}
+        self._sequence = randrange(0, 256)
+
+        self._originated = 0
+        self._delivered = 0
+        self._forwarded = 0
+        self._flooded = 0
+        self._expired = 0
+        self._duplicates = 0
+
+    # Route to destination or None
+    def route(self, destination, now=None):
+        now = ticks_ms() if now == None else now
+        if destination in self._routes:
+            route = self._routes[destination]
+            if ticks_diff(now, route[_ROUTE_TIME]) < self._lifetime:
+                return route
+            del self._routes[destination]
+        return None
+
+    # Note that destination is hops away through next_hop
+    def _learn(self, destination, next_hop, hops, rssi, now):
+        if destination == self._address:
+            return
+
+        route = self.route(destination, now)
+        if route != None and route[_ROUTE_NEXT_HOP] != next_hop:
+            # Keep the old route unless the new one is shorter, or as short and louder
+            if hops > route[_ROUTE_HOPS] or (hops == route[_ROUTE_HOPS] and rssi <= route[_ROUTE_RSSI]):
+                return
+
+        if route == None and len(self._routes) >= self._max_routes:
+            oldest = None
+            for key in self._routes:
+                if oldest == None or ticks_diff(self._routes[key][_ROUTE_TIME], self._routes[oldest][_ROUTE_TIME]) < 0:
+                    oldest = key
+            del self._routes[oldest]
+
+        self._routes[destination] = [ next_hop, hops, rssi, now ]
+
+    # Send a frame in the ordinary layout (destination, type byte, source, payload)
+    # to its destination by way of the mesh.  credit is passed on to the handler.
+    def send_packet(self, frame, credit=False):
+        if len(frame) < FRAME_HEADER_SIZE:
+            if credit:
+                self._handler.return_credit()
+            return
+
+        self._sequence = (self._sequence + 1) & 0xFF
+        mesh = bytearray(MESH_HEADER_SIZE + len(frame) - FRAME_HEADER_SIZE)
+        mesh[FRAME_FLAGS] = FRAME_PLAIN | FRAME_MESH | (frame[FRAME_FLAGS] & FRAME_NONCE_MASK)
+        _put_address(mesh, FRAME_SOURCE, self._address)
+        mesh[MESH_TTL] = self._ttl
+        mesh[MESH_HOPS] = 0
+        _put_address(mesh, MESH_ORIGIN, _address(frame, FRAME_SOURCE))
+        _put_address(mesh, MESH_TARGET, _address(frame, FRAME_DESTINATION))
+        mesh[MESH_SEQUENCE] = self._sequence
+        mesh[MESH_HEADER_SIZE:] = memoryview(frame)[FRAME_HEADER_SIZE:]
+
+        # Our own frame must not come back to us as new
+        self._seen.seen_key(self._address, self._sequence, frame_hash(mesh, MESH_HEADER_SIZE, len(mesh)), len(mesh))
+        self._originated += 1
+        self._dispatch(mesh, credit)
+
+    # Address the mesh frame to its next hop, or flood it, and queue it
+    def _dispatch(self, mesh, credit=False):
+        target = _address(mesh, MESH_TARGET)
+        route = self.route(target) if target & FRAME_UNIT_MASK != FRAME_BROADCAST_UNIT else None
+        if route != None:
+            _put_address(mesh, FRAME_DESTINATION, route[_ROUTE_NEXT_HOP])
+        else:
+            _put_address(mesh, FRAME_DESTINATION, self._broadcast)
+            self._flooded += 1
+        self._handler.send_packet(mesh, reliable=False, credit=credit)
+
+    # Next frame for this node from the handler, in the ordinary layout; caller must
+    # release() it.  Mesh frames for others are forwarded on the way.  Waits forever,
+    # or up to timeout ms for each frame heard and returns None.
+    def receive_packet(self, timeout=-1):
+        while True:
+            packet = self._handler.receive_packet(timeout)
+            if packet == None:
+                return None
+            packet = self._receive(packet)
+            if packet != None:
+                return packet
+
+    # Learn from, forward and unwrap one received packet.  Returns it if it is for
+    # the application, else releases it and returns None.
+    def _receive(self, packet):
+        buffer = packet.buffer
+        length = packet.length
+        if length < FRAME_HEADER_SIZE:
+            return packet
+
+        # Whoever we hear is a neighbour
+        now = ticks_ms()
+        hop = _address(buffer, FRAME_SOURCE)
+        self._learn(hop, hop, 1, packet.rssi, now)
+
+        if buffer[FRAME_FLAGS] & (FRAME_TYPE_MASK | FRAME_MESH) != FRAME_PLAIN | FRAME_MESH:
+            return packet
+
+        if length < MESH_HEADER_SIZE:
+            packet.release()
+            return None
+
+        origin = _address(buffer, MESH_ORIGIN)
+        self._learn(origin, hop, buffer[MESH_HOPS] + 1, packet.rssi, now)
+
+        # Only frames sent to us or flooded are ours to act on
+        next_hop = _address(buffer, FRAME_DESTINATION)
+        if next_hop != self._address and next_hop != self._broadcast:
+            packet.release()
+            return None
+
+        if origin == self._address or self._seen.seen_key(origin, buffer[MESH_SEQUENCE],
+                                                          frame_hash(buffer, MESH_HEADER_SIZE, length), length, now):
+            self._duplicates += 1
+            packet.release()
+            return None
+
+        target = _address(buffer, MESH_TARGET)
+        broadcast = target & FRAME_UNIT_MASK == FRAME_BROADCAST_UNIT
+        if target != self._address:
+            if buffer[MESH_TTL] > 1:
+                forward = bytearray(packet.data())
+                forward[MESH_TTL] -= 1
+                forward[MESH_HOPS] += 1
+                _put_address(forward, FRAME_SOURCE, self._address)
+                self._forwarded += 1
+                self._dispatch(forward)
+            else:
+                self._expired += 1
+
+            if not broadcast:
+                packet.release()
+                return None
+
+        # Unwrap in place: destination, type byte, origin, payload
+        nonce = buffer[FRAME_FLAGS] & FRAME_NONCE_MASK
+        _put_address(buffer, FRAME_DESTINATION, target)
+        buffer[FRAME_FLAGS] = FRAME_PLAIN | nonce
+        _put_address(buffer, FRAME_SOURCE, origin)
+        size = length - MESH_HEADER_SIZE
+        for index in range(size):
+            buffer[FRAME_HEADER_SIZE + index] = buffer[MESH_HEADER_SIZE + index]
+        packet.length = FRAME_HEADER_SIZE + size
+        self._delivered += 1
+        return packet
+
+    # Current routes as destination -> (next hop, hops, rssi)
+    def routes(self):
+        now = ticks_ms()
+        routes = {}
+        for destination in list(self._routes):
+            route = self.route(destination, now)
+            if route != None:
+                routes[destination] = (route[_ROUTE_NEXT_HOP], route[_ROUTE_HOPS], route[_ROUTE_RSSI])
+        return routes
+
+    def stats(self):
+        return {
+            'routes':     len(self._routes),
+            'originated': self._originated,
+            'delivered':  self._delivered,
+            'forwarded':  self._forwarded,
+            'flooded':    self._flooded,
+            'expired':    self._expired,
+            'duplicates': self._duplicates,
+        }
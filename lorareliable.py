@@ -0,0 +1,214 @@
+#
+# Reliable delivery: per-destination sequence numbers, acknowledgement bitmaps
+# and retransmission.
+#
+# Sender: each reliable frame gets the next sequence number for its destination.
+# At most 'window' frames per destination are in flight; later ones wait their
+# turn.  A frame's retransmission timer starts when it has finished going out and
+# doubles with each retry.  After 'retries' retries it is given up on.
+#
+# Receiver: the newest sequence number heard from each source and a bitmap of
+# the eight before it are kept, which is what an ACK carries back.  The window
+# is limited to eight so one ACK covers every frame that can be in flight.
+#
+# Sequence numbers are 6 bits (see loraframe) and compared modulo 64.  They
+# start at a random value so a restarted sender is not taken for a duplicate.
+#
+# Times are in milliseconds and 'now' is a ticks_ms() value.
+#
+from sx127x import ticks_ms, ticks_add, ticks_diff, randrange
+from loraframe import FRAME_SEQUENCE_MASK
+
+try:
+    _UNUSED_=const(1)
+except:
+    const = lambda x: x
+
+_SEQUENCE_MODULO        = const(FRAME_SEQUENCE_MASK + 1)
+_ACK_BITS               = const(8)
+_MAX_WINDOW             = const(_ACK_BITS)
+
+# In-flight entry
+_ENTRY_DESTINATION      = const(0)
+_ENTRY_SEQUENCE         = const(1)
+_ENTRY_FRAME            = const(2)
+_ENTRY_RETRIES          = const(3)
+_ENTRY_TIMEOUT          = const(4)  # ms for the current try
+_ENTRY_DEADLINE         = const(5)  # None while queued or on air
+
+# Sequence numbers back from newest to sequence (0..63)
+def _behind(newest, sequence):
+    return (newest - sequence) % _SEQUENCE_MODULO
+
+# Parameters
+#     window         - frames in flight per destination (1..8)
+#     retries        - retransmissions before a frame is given up on
+#     sources        - source addresses tracked for acknowledging (least recently heard is dropped)
+#
+class ReliableLink():
+    def __init__(self, **kwargs):
+        self._window  = min(max(kwargs['window'] if 'window' in kwargs else 4, 1), _MAX_WINDOW)
+        self._retries = kwargs['retries'] if 'retries' in kwargs else 3
+        self._max_sources = kwargs['sources'] if 'sources' in kwargs else 32
+
+        # Sender
+        self._next_sequence = {}        # destination -> next sequence number
+        self._in_flight = []            # [ <entry>, ... ] oldest first
+        self._waiting = []              # [ <entry>, ... ] frames beyond the window
+
+        # Receiver: source -> [ <newest sequence>, <bitmap>, <last heard> ]
+        self._sources = {}
+        self._clock = 0
+
+        self._sent = 0
+        self._delivered = 0
+        self._failed = 0
+        self._retransmitted = 0
+        self._duplicates = 0
+
+    def _count(self, destination):
+        count = 0
+        for entry in self._in_flight:
+            if entry[_ENTRY_DESTINATION] == destination:
+                count += 1
+        return count
+
+    # Number a new frame to destination.  Returns (sequence, True if it may go now);
+    # if not, it is held until release() lets it go.
+    def add(self, destination, frame, timeout):
+        if destination in self._next_sequence:
+            sequence = self._next_sequence[destination]
+        else:
+            sequence = randrange(0, _SEQUENCE_MODULO)
+        self._next_sequence[destination] = (sequence + 1) % _SEQUENCE_MODULO
+
+        entry = [ destination, sequence, frame, 0, timeout, None ]
+        self._sent += 1
+        if self._count(destination) < self._window:
+            self._in_flight.append(entry)
+            return sequence, True
+
+        self._waiting.append(entry)
+        return sequence, False
+
+    # The frame has finished going out; start its timer
+    def transmitted(self, frame, now=None):
+        now = ticks_ms() if now == None else now
+        for entry in self._in_flight:
+            if entry[_ENTRY_FRAME] is frame:
+                entry[_ENTRY_DEADLINE] = ticks_add(now, entry[_ENTRY_TIMEOUT] << entry[_ENTRY_RETRIES])
+                return True
+        return False
+
+    # Take an ACK from source.  Returns the [ destination, sequence ] of frames now delivered.
+    def acknowledge(self, source, newest, bitmap):
+        delivered = []
+        for entry in list(self._in_flight):
+            if entry[_ENTRY_DESTINATION] == source:
+                behind = _behind(newest, entry[_ENTRY_SEQUENCE])
+                if behind == 0 or (behind <= _ACK_BITS and bitmap & (1 << (behind - 1))):
+                    self._in_flight.remove(entry)
+                    delivered.append(entry[0:2])
+        self._delivered += len(delivered)
+        return delivered
+
+    # Frames whose timers have run out, as (frames to send again, [ destination, sequence ] given up on)
+    def expired(self, now=None):
+        now = ticks_ms() if now == None else now
+        resend = []
+        failed = []
+        for entry in list(self._in_flight):
+            if entry[_ENTRY_DEADLINE] != None and ticks_diff(entry[_ENTRY_DEADLINE], now) <= 0:
+                entry[_ENTRY_DEADLINE] = None
+                if entry[_ENTRY_RETRIES] < self._retries:
+                    entry[_ENTRY_RETRIES] += 1
+                    resend.append(entry[_ENTRY_FRAME])
+                else:
+                    self._in_flight.remove(entry)
+                    failed.append(entry[0:2])
+        self._retransmitted += len(resend)
+        self._failed += len(failed)
+        return resend, failed
+
+    # Forget a frame that will never go out.  Returns its [ destination, sequence ] or None.
+    def cancel(self, frame):
+        for entries in (self._in_flight, self._waiting):
+            for entry in entries:
+                if entry[_ENTRY_FRAME] is frame:
+                    entries.remove(entry)
+                    self._failed += 1
+                    return entry[0:2]
+        return None
+
+    # Held frames that now fit in their destination's window, oldest first
+    def release(self):
+        frames = []
+        for entry in list(self._waiting):
+            if self._count(entry[_ENTRY_DESTINATION]) < self._window:
+                self._waiting.remove(entry)
+                self._in_flight.append(entry)
+                frames.append(entry[_ENTRY_FRAME])
+        return frames
+
+    # ms until the next timer runs out; -1 if none is running
+    def next_deadline(self, now=None):
+        now = ticks_ms() if now == None else now
+        wait = -1
+        for entry in self._in_flight:
+            if entry[_ENTRY_DEADLINE] != None:
+                delay = max(ticks_diff(entry[_ENTRY_DEADLINE], now), 0)
+                if wait < 0 or delay < wait:
+                    wait = delay
+        return wait
+
+    # Note a reliable frame from source.  Returns (True if not seen before, newest, bitmap)
+    # where newest and bitmap are what to acknowledge with.
+    def receive(self, source, sequence):
+        self._clock += 1
+        if source not in self._sources:
+            if len(self._sources) >= self._max_sources:
+                oldest = None
+                for key in self._sources:
+                    if oldest == None or self._sources[key][2] < self._sources[oldest][2]:
+                        oldest = key
+                del self._sources[oldest]
+            self._sources[source] = [ sequence, 0, self._clock ]
+            return True, sequence, 0
+
+        state = self._sources[source]
+        state[2] = self._clock
+        newest, bitmap = state[0], state[1]
+        ahead = _behind(sequence, newest)
+        fresh = True
+        if ahead == 0:
+            fresh = False
+        elif ahead < _SEQUENCE_MODULO // 2:
+            # Newer: slide the bitmap along
+            bitmap = ((bitmap << 1 | 1) << (ahead - 1)) & ((1 << _ACK_BITS) - 1) if ahead <= _ACK_BITS else 0
+            newest = sequence
+        else:
+            behind = _SEQUENCE_MODULO - ahead
+            if behind > _ACK_BITS:
+                # Further back than any window: the sender has restarted
+                newest, bitmap = sequence, 0
+            elif bitmap & (1 << (behind - 1)):
+                fresh = False
+            else:
+                bitmap |= 1 << (behind - 1)
+
+        if not fresh:
+            self._duplicates += 1
+
+        state[0], state[1] = newest, bitmap
+        return fresh, newest, bitmap
+
+    def stats(self):
+        return {
+            'in_flight':     len(self._in_flight),
+            'waiting':       len(self._waiting),
+            'sent':          self._sent,
+            'delivered':     self._delivered,
+            'failed':        self._failed,
+            'retransmitted': self._retransmitted,
+            'duplicates':    self._duplicates,
+        }
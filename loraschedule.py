@@ -0,0 +1,138 @@
+#
+# Transmit scheduler for the regulatory airtime limits in loradomains.
+#
+# Limits come from the optional 'dwell' and 'duty' members of a domain channel
+# entry.  Dwell is enforced over a sliding window: each transmission is kept
+# until no window a later transmission could fall in still covers it.  Duty
+# cycle is enforced as an off time of airtime * (1/duty - 1) after each
+# transmission.
+#
+# Times are in milliseconds and 'now' is a ticks_ms() value.
+#
+from sx127x import ticks_ms, ticks_add, ticks_diff
+
+# Whole milliseconds, rounded up
+def _ms(value):
+    return int(value) if value == int(value) else int(value) + 1
+
+class TransmitScheduler():
+    def __init__(self, domain):
+        self._channels = domain['channels']
+
+        # Per (direction, channel) state
+        self._history = {}          # [ [end, airtime], ... ] oldest first
+        self._off_until = {}        # end of duty cycle off time
+        self._airtime = {}          # total ms on air
+
+    # (dwell, duty) limits for channel; either is None if not limited
+    def _limits(self, channel, direction):
+        for group in self._channels:
+            if group['type'] == direction and group['chan'][0] <= channel <= group['chan'][1]:
+                return (group['dwell'] if 'dwell' in group else None, group['duty'] if 'duty' in group else None)
+        return (None, None)
+
+    # ms to wait before airtime may start at now; -1 if it never can
+    def _delay(self, limits, history, off_until, airtime, now):
+        dwell, duty = limits
+        wait = 0
+
+        if dwell != None:
+            if airtime > dwell[0]:
+                return -1
+
+            # Earliest window covering a packet sent now
+            start = ticks_add(now, airtime - dwell[1])
+            total = airtime
+            for entry in history:
+                if ticks_diff(entry[0], start) > 0:
+                    total += entry[1]
+
+            # Wait for the oldest transmissions to leave the window until it fits
+            for entry in history:
+                if total <= dwell[0]:
+                    break
+                if ticks_diff(entry[0], start) > 0:
+                    total -= entry[1]
+                    wait = max(wait, ticks_diff(entry[0], start))
+
+        if duty != None and off_until != None:
+            wait = max(wait, ticks_diff(off_until, now))
+
+        return wait
+
+    # Record airtime starting at now.  Returns the new duty cycle off time.
+    def _charge(self, limits, history, off_until, airtime, now):
+        dwell, duty = limits
+        end = ticks_add(now, airtime)
+
+        if dwell != None:
+            history.append([ end, airtime ])
+            # Drop what no later window can reach
+            start = ticks_add(end, -dwell[1])
+            while len(history) != 0 and ticks_diff(history[0][0], start) <= 0:
+                history.pop(0)
+
+        if duty != None:
+            off_until = ticks_add(now, _ms(airtime / duty))
+
+        return off_until
+
+    # Milliseconds until a packet of airtime ms may be sent on channel (0 is now).
+    # Returns -1 if it is longer than the channel allows at all.
+    def delay(self, channel, direction, airtime, now=None):
+        now = ticks_ms() if now == None else now
+        key = (direction, channel)
+        return self._delay(self._limits(channel, direction),
+                           self._history[key] if key in self._history else (),
+                           self._off_until[key] if key in self._off_until else None,
+                           _ms(airtime), now)
+
+    # Account for a packet of airtime ms sent on channel at now
+    def charge(self, channel, direction, airtime, now=None):
+        now = ticks_ms() if now == None else now
+        airtime = _ms(airtime)
+        key = (direction, channel)
+        if key not in self._history:
+            self._history[key] = []
+            self._off_until[key] = None
+            self._airtime[key] = 0
+
+        self._off_until[key] = self._charge(self._limits(channel, direction), self._history[key],
+                                            self._off_until[key], airtime, now)
+        self._airtime[key] += airtime
+
+    # Projected milliseconds to send packets of the listed airtimes back to back,
+    # each as soon as the limits allow.  Packets that can never be sent are skipped.
+    def drain_time(self, channel, direction, airtimes, now=None):
+        now = ticks_ms() if now == None else now
+        key = (direction, channel)
+        limits = self._limits(channel, direction)
+        history = list(self._history[key]) if key in self._history else []
+        off_until = self._off_until[key] if key in self._off_until else None
+
+        when = now
+        for airtime in airtimes:
+            airtime = _ms(airtime)
+            wait = self._delay(limits, history, off_until, airtime, when)
+            if wait >= 0:
+                when = ticks_add(when, wait)
+                off_until = self._charge(limits, history, off_until, airtime, when)
+                when = ticks_add(when, airtime)
+
+        return ticks_diff(when, now)
+
+    # The channel from channels that can send airtime soonest, as (channel, delay)
+    def best_channel(self, channels, direction, airtime, now=None):
+        now = ticks_ms() if now == None else now
+        best = (None, -1)
+        for channel in channels:
+            wait = self.delay(channel, direction, airtime, now)
+            if wait >= 0 and (best[0] == None or wait < best[1]):
+                best = (channel, wait)
+                if wait == 0:
+                    break
+        return best
+
+    # Total ms on air per (direction, channel)
+    def stats(self):
+        return dict(self._airtime)
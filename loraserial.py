@@ -0,0 +1,542 @@
+#
+# Host bridge serial framing.
+#
+# ASCII mode (default):
+#    $<%xx escaped frame>:<16 bit sum>:<rssi>\r\n
+#    +SENT <destination hex> <sequence>\r\n           frame sent reliably
+#    +DELIVERED <destination hex> <sequence>\r\n      it was acknowledged
+#    +UNDELIVERED <destination hex> <sequence>\r\n    it was given up on
+#    +CREDITS <count>\r\n                             frames the host may have waiting to go
+#    +BUSY <destination hex>\r\n                      frame refused: no credit left
+#
+# Control characters, bytes above 127 and '$', '%', ':' are sent as %xx.
+#
+# Binary mode, entered when the host sends '+BINARY\n' in ASCII mode (the
+# device answers '+BINARY <version>\r\n').  Each frame is COBS encoded and
+# ended by a 0x00 byte.  Decoded, a frame is:
+#
+#    0       type
+#    1..2    payload length (big endian)
+#    ...     header for the type (fixed size, see below)
+#    ...     payload
+#    last 2  CRC16-CCITT (0x1021, initial 0xFFFF) of everything before it
+#
+#    FRAME_RECEIVE   device -> host   header: rssi (int8 dBm), snr (int8 quarter dB),
+#                                             channel, timestamp (uint32 ms, wraps)
+#                                     payload: the LoRa frame
+#    FRAME_SEND      host -> device   payload: <destination hi> <destination lo> <data>
+#    FRAME_STATUS    device -> host   payload: <status code> [<data>]
+#                                     STATUS_OK after FRAME_SEND carries <destination hi> <destination lo>
+#                                     <sequence> if the frame was sent reliably; STATUS_DELIVERED and
+#                                     STATUS_UNDELIVERED carry the same when its fate is known.
+#                                     STATUS_CREDITS carries <count> of frames the host may have
+#                                     waiting to go; STATUS_BUSY after FRAME_SEND carries
+#                                     <destination hi> <destination lo> of a frame refused for want
+#                                     of a credit.
+#    FRAME_MODE      host -> device   payload: <mode>; SERIAL_ASCII returns to ASCII mode
+#
+from struct import pack_into, unpack_from
+from array import array
+from sx127x import ticks_ms, ticks_diff
+
+try:
+    from uselect import poll, POLLIN
+except:
+    from select import poll, POLLIN
+
+try:
+    _UNUSED_=const(1)
+except:
+    const = lambda x: x
+
+PROTOCOL_VERSION        = const(1)
+
+SERIAL_ASCII            = const(0)
+SERIAL_BINARY           = const(1)
+
+# Frame delimiters of each mode
+ASCII_DELIMITER         = const(0x0A)       # '\n'
+BINARY_DELIMITER        = const(0x00)
+
+# Negotiation lines (ASCII mode)
+BINARY_REQUEST          = b'+BINARY'
+ASCII_REPLY             = b'+ASCII\r\n'
+
+FRAME_RECEIVE           = const(0x01)
+FRAME_SEND              = const(0x02)
+FRAME_STATUS            = const(0x03)
+FRAME_MODE              = const(0x04)
+
+STATUS_OK               = const(0x00)
+STATUS_CRC_ERROR        = const(0x01)
+STATUS_FRAME_ERROR      = const(0x02)
+STATUS_UNKNOWN_TYPE     = const(0x03)
+STATUS_DELIVERED        = const(0x04)
+STATUS_UNDELIVERED      = const(0x05)
+STATUS_CREDITS          = const(0x06)
+STATUS_BUSY             = const(0x07)
+
+_COMMON_HEADER          = const(3)
+_RECEIVE_HEADER         = const(7)           # rssi, snr, channel, timestamp
+_CRC_SIZE               = const(2)
+
+_MAX_PAYLOAD            = const(255)
+_MAX_ASCII_LINE         = const(1 + _MAX_PAYLOAD * 3 + 20)   # $<escaped>:<sum>:<rssi>\r\n
+_MAX_FRAME              = const(_COMMON_HEADER + _RECEIVE_HEADER + _MAX_PAYLOAD + _CRC_SIZE)
+_MAX_WIRE               = const(_MAX_FRAME + _MAX_FRAME // 254 + 2)
+
+_HEX_DIGITS = b'0123456789abcdef'
+
+# Per byte value: 1 if it is sent as %xx in ASCII mode
+def _escape_table():
+    table = bytearray(256)
+    for ch in range(256):
+        table[ch] = 1 if ch < 32 or ch > 127 or ch in b'$%:' else 0
+    return table
+
+# Per ASCII character: its hex digit value, or 0xFF if not a hex digit
+def _hex_table():
+    table = bytearray(b'\xFF' * 256)
+    for value in range(16):
+        table[_HEX_DIGITS[value]] = value
+        table[_HEX_DIGITS.upper()[value]] = value
+    return table
+
+_ESCAPE_TABLE = _escape_table()
+_HEX_TABLE = _hex_table()
+
+# Escape the first length bytes of data into out starting at index.
+# Returns (index after the last byte written, sum of the unescaped bytes).
+def escape(data, length, out, index=0):
+    escaped = _ESCAPE_TABLE
+    digits = _HEX_DIGITS
+    sum = 0
+    for position in range(length):
+        ch = data[position]
+        sum += ch
+        if escaped[ch]:
+            out[index] = 0x25       # '%'
+            out[index + 1] = digits[ch >> 4]
+            out[index + 2] = digits[ch & 0x0F]
+            index += 3
+        else:
+            out[index] = ch
+            index += 1
+    return index, sum
+
+# Remove %xx escapes from the first length bytes of data into out (which may be data).
+# Returns (length written or -1 if an escape is malformed, sum of the escaped bytes
+# less the hex digits of each escape).
+def unescape(data, length, out):
+    hex = _HEX_TABLE
+    total = 0
+    position = 0
+
+    # Nothing to undo before the first escape: copy it (if not in place) and sum it whole
+    index = _find_byte(data, 0x25, 0, length)
+    if index < 0:
+        index = length
+    if index != 0:
+        if out is not data:
+            out[0:index] = data[0:index]
+        total = sum(data[0:index])
+        position = index
+
+    while position < length:
+        ch = data[position]
+        total += ch
+        if ch == 0x25:              # '%'
+            if position + 2 >= length:
+                return -1, total
+            high = hex[data[position + 1]]
+            low = hex[data[position + 2]]
+            if high == 0xFF or low == 0xFF:
+                return -1, total
+            out[index] = (high << 4) | low
+            position += 3
+        else:
+            out[index] = ch
+            position += 1
+        index += 1
+    return index, total
+
+# Write the decimal text of value into out at index; returns the index after it
+def _put_decimal(out, index, value):
+    if value < 0:
+        out[index] = 0x2D           # '-'
+        index += 1
+        value = -value
+    start = index
+    while True:
+        out[index] = 0x30 + value % 10
+        index += 1
+        value //= 10
+        if value == 0:
+            break
+    # Digits went in backwards
+    end = index - 1
+    while start < end:
+        out[start], out[end] = out[end], out[start]
+        start += 1
+        end -= 1
+    return index
+
+# ASCII mode line encoder working in a preallocated buffer.  The view returned
+# is only good until the next call.
+class AsciiFraming():
+    def __init__(self):
+        self._line = bytearray(_MAX_ASCII_LINE)
+        self._line_view = memoryview(self._line)
+        self._input = bytearray(_MAX_ASCII_LINE)
+        self._input_view = memoryview(self._input)
+
+        self.frames_in = 0
+        self.crc_errors = 0
+        self.framing_errors = 0
+
+    # The whole line for a received LoRa frame, ready for a single write
+    def encode_receive(self, data, rssi):
+        line = self._line
+        line[0] = 0x24              # '$'
+        index, sum = escape(data, len(data), line, 1)
+        line[index] = 0x3A          # ':'
+        index = _put_decimal(line, index + 1, sum % 0x10000)
+        line[index] = 0x3A
+        index = _put_decimal(line, index + 1, int(rssi))
+        line[index] = 0x0D
+        line[index + 1] = 0x0A
+        return self._line_view[0:index + 2]
+
+    # Decode the first length bytes of a host line (without its '\n'):
+    #    $<%xx escaped frame>:<hex sum>
+    # Text before the last '$' is ignored.  Returns a view of the frame or None
+    # if the line is damaged.
+    def decode(self, line, length):
+        start = -1
+        separator = -1
+        for index in range(length):
+            if line[index] == 0x24:     # '$'
+                start = index
+                separator = -1
+            elif line[index] == 0x3A and start >= 0 and separator < 0:
+                separator = index
+
+        if start < 0:
+            # Not a frame at all (console noise)
+            return None
+
+        if separator < 0 or separator - start - 1 > _MAX_ASCII_LINE or length - separator - 1 > 16:
+            self.framing_errors += 1
+            return None
+
+        # Hex sum, possibly escaped, with an optional '\r'
+        cksum = 0
+        digits, dummy = unescape(line[separator + 1:length], length - separator - 1, self._input)
+        for index in range(max(digits, 0)):
+            value = _HEX_TABLE[self._input[index]]
+            if value == 0xFF:
+                if self._input[index] == 0x0D and index == digits - 1:
+                    break
+                digits = -1
+                break
+            cksum = (cksum << 4) | value
+
+        size, sum = unescape(line[start + 1:separator], separator - start - 1, self._input)
+        if size < 0 or digits <= 0:
+            self.framing_errors += 1
+            return None
+
+        if sum != cksum:
+            self.crc_errors += 1
+            return None
+
+        self.frames_in += 1
+        return self._input_view[0:size]
+
+# Index of the first byte equal to value in buffer[start:end], or -1.  MicroPython's
+# bytearray has no find(), so this is a viper loop there and a plain one elsewhere.
+try:
+    import micropython
+
+    @micropython.viper
+    def _find_byte(buffer, value: int, start: int, end: int) -> int:
+        data = ptr8(buffer)
+        index = start
+        while index < end:
+            if data[index] == value:
+                return index
+            index += 1
+        return -1
+
+except (ImportError, AttributeError):
+    def _find_byte(buffer, value, start, end):
+        for index in range(start, end):
+            if buffer[index] == value:
+                return index
+        return -1
+
+# Poll-driven reader splitting a byte stream into delimited frames.
+#
+# Bytes are read in bulk into a ring buffer.  frame() hands back the next
+# complete frame (without its delimiter) as a view; it is good until the next
+# call.  Frames that would not fit in the ring are discarded and counted.
+#
+# Parameters
+#     size           - ring buffer size in bytes (a power of 2)
+#     chunk          - bytes to ask the stream for per read when it cannot say how
+#                      many are waiting.  Leave at 1 for streams whose reads block
+#                      until full (the MicroPython console); use 64 or more for
+#                      streams returning what is waiting (UART with timeout=0, host pipes).
+#
+class SerialReader():
+    def __init__(self, stream, **kwargs):
+        self._stream = stream
+        self._size  = kwargs['size']  if 'size'  in kwargs else 1024
+        self._chunk = kwargs['chunk'] if 'chunk' in kwargs else 1
+        self._mask = self._size - 1
+        if self._size & self._mask:
+            raise Exception("size must be a power of 2")
+
+        self._buffer = bytearray(self._size)
+        self._view = memoryview(self._buffer)
+        self._frame = bytearray(self._size)
+        self._frame_view = memoryview(self._frame)
+        self._byte = bytearray(1)
+        self._head = 0              # Bytes ever read
+        self._tail = 0              # Bytes ever consumed
+        self._scanned = 0           # Bytes from tail already known to hold no delimiter
+        self._discard = False       # Drop up to the next delimiter (rest of an overrun)
+        self._delimiter = None      # Delimiter _scanned applies to
+
+        self._poll = poll()
+        self._poll.register(stream, POLLIN)
+        self._any = stream.any if hasattr(stream, 'any') else None
+
+        self._bytes = 0
+        self._frames = 0
+        self._overruns = 0
+        self._rate_frames = 0
+        self._rate_time = ticks_ms()
+
+    # Read whatever the stream has, waiting up to timeout ms (-1 forever) for the first byte.
+    # Returns the number of bytes read.
+    def fill(self, timeout=-1):
+        if self._head - self._tail == self._size:
+            # Full without a delimiter: nothing in it can ever be a frame
+            self._tail = self._head
+            self._scanned = 0
+            self._overruns += 1
+            self._discard = True
+
+        total = 0
+        ready = self._poll.poll(timeout)
+        while ready and self._head - self._tail < self._size:
+            wanted = self._any() if self._any != None else self._chunk
+            if wanted <= 0:
+                break
+
+            start = self._head & self._mask
+            if wanted == 1:
+                # Byte at a time: read into a standing buffer rather than slicing the ring each time
+                count = self._stream.readinto(self._byte)
+                if count:
+                    self._buffer[start] = self._byte[0]
+            else:
+                wanted = min(wanted, self._size - (self._head - self._tail), self._size - start)
+                count = self._stream.readinto(self._view[start:start + wanted])
+            if not count:
+                break
+
+            self._head += count
+            total += count
+
+            # Keep going while more is waiting
+            ready = self._poll.poll(0)
+
+        self._bytes += total
+        return total
+
+    # Next frame ending in delimiter or None if none is complete
+    def frame(self, delimiter):
+        if delimiter != self._delimiter:
+            self._delimiter = delimiter
+            self._scanned = 0
+
+        buffer = self._buffer
+        index = self._tail + self._scanned
+        while index != self._head:
+            start = index & self._mask
+            end = min(start + (self._head - index), self._size)
+            found = _find_byte(buffer, delimiter, start, end)
+            if found >= 0:
+                length = index + (found - start) - self._tail
+                self._tail += length + 1
+                self._scanned = 0
+                if self._discard:
+                    self._discard = False
+                    index = self._tail
+                    continue
+                self._frames += 1
+                return self._copy_out(self._tail - length - 1, length)
+            index += end - start
+
+        self._scanned = self._head - self._tail
+        return None
+
+    # View of length bytes starting at absolute position; copied only if it wraps
+    def _copy_out(self, position, length):
+        start = position & self._mask
+        if start + length <= self._size:
+            return self._view[start:start + length]
+
+        first = self._size - start
+        self._frame_view[0:first] = self._view[start:self._size]
+        self._frame_view[first:length] = self._view[0:length - first]
+        return self._frame_view[0:length]
+
+    # Frames per second since the previous call, bytes read, frames and overruns
+    def stats(self):
+        now = ticks_ms()
+        elapsed = ticks_diff(now, self._rate_time)
+        rate = (self._frames - self._rate_frames) * 1000 / elapsed if elapsed > 0 else 0
+        self._rate_frames = self._frames
+        self._rate_time = now
+        return {
+            'bytes':          self._bytes,
+            'frames':         self._frames,
+            'frames_per_sec': rate,
+            'overruns':       self._overruns,
+        }
+
+def _crc16_table():
+    table = array('H', [ 0 ] * 256)
+    for index in range(256):
+        crc = index << 8
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x1021) & 0xFFFF if crc & 0x8000 else (crc << 1) & 0xFFFF
+        table[index] = crc
+    return table
+
+_CRC16_TABLE = _crc16_table()
+
+# CRC16-CCITT of the first length bytes of data
+def crc16(data, length, crc=0xFFFF):
+    table = _CRC16_TABLE
+    for index in range(length):
+        crc = ((crc << 8) & 0xFFFF) ^ table[((crc >> 8) ^ data[index]) & 0xFF]
+    return crc
+
+# COBS encode the first length bytes of data into out (no delimiter).  Returns the encoded length.
+def cobs_encode(data, length, out):
+    code_index = 0
+    code = 1
+    index = 1
+    for position in range(length):
+        byte = data[position]
+        if byte == 0:
+            out[code_index] = code
+            code_index = index
+            index += 1
+            code = 1
+        else:
+            out[index] = byte
+            index += 1
+            code += 1
+            if code == 0xFF:
+                out[code_index] = code
+                code_index = index
+                index += 1
+                code = 1
+    out[code_index] = code
+    return index
+
+# COBS decode the first length bytes of data (no delimiter) into out.  Returns the decoded length or -1 if malformed.
+def cobs_decode(data, length, out):
+    index = 0
+    position = 0
+    while position < length:
+        code = data[position]
+        if code == 0 or position + code > length:
+            return -1
+        position += 1
+        for count in range(code - 1):
+            out[index] = data[position]
+            index += 1
+            position += 1
+        if code != 0xFF and position < length:
+            out[index] = 0
+            index += 1
+    return index
+
+# Binary mode encoder/decoder working in preallocated buffers.  Encoding and decoding
+# use separate buffers so one thread may do each; the views returned are only good
+# until the next call of the same kind.
+class BinaryFraming():
+    def __init__(self):
+        self._frame = bytearray(_MAX_FRAME)
+        self._wire = bytearray(_MAX_WIRE)
+        self._wire_view = memoryview(self._wire)
+        self._input = bytearray(_MAX_FRAME)
+        self._input_view = memoryview(self._input)
+
+        self.frames_in = 0
+        self.frames_out = 0
+        self.crc_errors = 0
+        self.framing_errors = 0
+
+    # Add the CRC to a frame of length bytes and COBS encode it with its delimiter
+    def _finish(self, length):
+        crc = crc16(self._frame, length)
+        self._frame[length] = crc >> 8
+        self._frame[length + 1] = crc & 0xFF
+        size = cobs_encode(self._frame, length + _CRC_SIZE, self._wire)
+        self._wire[size] = 0
+        self.frames_out += 1
+        return self._wire_view[0:size + 1]
+
+    # Wire bytes for a received LoRa frame
+    def encode_receive(self, data, rssi, snr, channel, timestamp):
+        length = len(data)
+        pack_into('>BHbbBI', self._frame, 0, FRAME_RECEIVE, length,
+                  min(max(int(rssi), -128), 127), min(max(int(snr * 4), -128), 127),
+                  channel if channel != None else 0xFF, timestamp & 0xFFFFFFFF)
+        start = _COMMON_HEADER + _RECEIVE_HEADER
+        self._frame[start:start + length] = data
+        return self._finish(start + length)
+
+    # Wire bytes for a status report
+    def encode_status(self, code, data=b''):
+        length = 1 + len(data)
+        pack_into('>BHB', self._frame, 0, FRAME_STATUS, length, code)
+        self._frame[_COMMON_HEADER + 1:_COMMON_HEADER + length] = data
+        return self._finish(_COMMON_HEADER + length)
+
+    # Decode the first length bytes of block (one COBS block without its delimiter).
+    # Returns (type, view of the type's header and payload) or None if the frame is damaged.
+    def decode(self, block, length):
+        # Decoding never grows a block
+        size = cobs_decode(block, length, self._input) if length <= _MAX_FRAME + 1 else -1
+        if size < _COMMON_HEADER + _CRC_SIZE:
+            self.framing_errors += 1
+            return None
+
+        if crc16(self._input, size - _CRC_SIZE) != (self._input[size - 2] << 8) | self._input[size - 1]:
+            self.crc_errors += 1
+            return None
+
+        type, payload = unpack_from('>BH', self._input, 0)
+        payload += _RECEIVE_HEADER if type == FRAME_RECEIVE else 0
+        if _COMMON_HEADER + payload + _CRC_SIZE != size:
+            self.framing_errors += 1
+            return None
+
+        self.frames_in += 1
+        return (type, self._input_view[_COMMON_HEADER:_COMMON_HEADER + payload])
+
+    def stats(self):
+        return {
+            'frames_in':      self.frames_in,
+            'frames_out':     self.frames_out,
+            'crc_errors':     self.crc_errors,
+            'framing_errors': self.framing_errors,
+        }
@@ -6,9 +6,11 @@ from time import sleep
 import sys
 
 class LoRaWebserver(thread):
-    def __init__(self, config, name="LoraWebServer", apmode=True, display=None):
+    # executor, if given, runs short jobs (such as the reboot) instead of a thread of their own
+    def __init__(self, config, name="LoraWebServer", apmode=True, display=None, executor=None):
         super().__init__(name, stack=8192)
         self._config = config
+        self._executor = executor
         self._apmode = apmode
         self._display = display if display else lambda text : None
 
@@ -198,8 +200,12 @@ class LoRaWebserver(thread):
         elif request.method == 'POST':
             header, html = self.home_page(notice="Rebooting")
             
-            # Set a thread to do a reboot after five seconds
-            thread(run=self.reboot_delay).start()
+            # Reboot after a second, once the reply has gone
+            if self._executor != None:
+                import machine
+                self._executor.schedule(1000, machine.reset)
+            else:
+                thread(run=self.reboot_delay).start()
 
         else:
             header, html = self.reboot_page(notice="Invalid type: %s" % request.method)
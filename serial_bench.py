@@ -0,0 +1,179 @@
+#
+# Host benchmark for the serial bridge ASCII framing.
+#
+# Compares the original per-byte escape_data/unescape_data of loracom_main
+# (reproduced below) against loraserial's table-driven versions and reports
+# bytes per second and heap allocated per frame.  Also times SerialReader
+# splitting a burst of lines.  Works under CPython and the MicroPython unix port.
+#
+#    python3 serial_bench.py
+#    micropython serial_bench.py
+#
+import gc
+import sys
+
+from loraserial import AsciiFraming, SerialReader, unescape, ASCII_DELIMITER
+
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    from time import perf_counter
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+# Original implementation from loracom_main, including its three writes per frame
+def escape_data(data, sum=0):
+    out = bytearray()
+    for i in range(len(data)):
+        ch = data[i]
+        sum += ch
+        if ch < 32 or ch > 127 or ch in [ ord('$'), ord('%'), ord(':') ]:
+            out.append(ord('%'))
+            hexval = "%02x" % ch
+            out.append(ord(hexval[0]))
+            out.append(ord(hexval[1]))
+        else:
+            out.append(ch)
+
+    return bytes(out), sum
+
+def unescape_data(buffer):
+    out = bytearray()
+    sum = 0
+    index = 0
+    while index < len(buffer):
+        ch = buffer[index]
+        sum += ch
+        if ch == ord('%'):
+            # The original omitted the base, so int() rejected every escape
+            out.append(int("0x%c%c" % (buffer[index + 1], buffer[index+2]), 16) % 256)
+            index += 2
+        else:
+            out.append(ch)
+        index += 1
+
+    return bytes(out), sum
+
+# Counts writes in place of sys.stdout
+class _Sink():
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+def _reference_receive(sink, data, rssi):
+    output, sum = escape_data(data)
+    sink.write("$")
+    sink.write(output)
+    sink.write(":%d:%d\r\n" % (sum % 0x10000, rssi))
+
+# Heap bytes allocated while running function 'count' times
+try:
+    gc.mem_alloc
+
+    def _allocated(function, count):
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        for i in range(count):
+            function()
+        after = gc.mem_alloc()
+        gc.enable()
+        return after - before
+
+except AttributeError:
+    import tracemalloc
+
+    def _allocated(function, count):
+        function()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        for i in range(count):
+            function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak - before
+
+# Payload bytes per second through function, best of five runs
+def _rate(function, size, count):
+    best = None
+    for run in range(5):
+        start = ticks_us()
+        for i in range(count):
+            function()
+        elapsed = ticks_diff(ticks_us(), start)
+        best = elapsed if best == None or elapsed < best else best
+    return size * count * 1000000 / max(best, 1)
+
+def main(count=200):
+    framing = AsciiFraming()
+    sink = _Sink()
+
+    # Mostly printable text with some bytes that need escaping
+    data = bytearray(255)
+    for i in range(len(data)):
+        data[i] = i if i % 4 == 0 else 0x41 + i % 26
+    line = bytes(framing.encode_receive(data, -97))
+    escaped = line[1:line.index(b':')]
+    scratch = bytearray(len(escaped))
+
+    # Plain text, escaped only where the line format needs it
+    text = bytearray(0x41 + i % 26 for i in range(255))
+    text_line = bytes(framing.encode_receive(text, -97))
+    text_escaped = text_line[1:text_line.index(b':')]
+
+    # Both must produce the same bytes
+    reference = _Sink()
+    reference.bytes = bytearray()
+    reference.write = lambda text: reference.bytes.extend(text if type(text) != str else text.encode())
+    _reference_receive(reference, data, -97)
+    assert bytes(reference.bytes) == line
+    assert unescape(escaped, len(escaped), scratch) == (len(data), unescape_data(escaped)[1])
+    assert unescape(text_escaped, len(text_escaped), scratch) == (len(text), unescape_data(text_escaped)[1])
+
+    operations = (
+        ("escape (original)",       len(data),         lambda: _reference_receive(sink, data, -97)),
+        ("escape (table)",          len(data),         lambda: sink.write(framing.encode_receive(data, -97))),
+        ("unescape (original)",     len(escaped),      lambda: unescape_data(escaped)),
+        ("unescape (table)",        len(escaped),      lambda: unescape(escaped, len(escaped), scratch)),
+        ("unescape text (original)", len(text_escaped), lambda: unescape_data(text_escaped)),
+        ("unescape text (table)",   len(text_escaped), lambda: unescape(text_escaped, len(text_escaped), scratch)),
+    )
+
+    # SerialReader on a burst of lines put straight into its ring (stdin only
+    # stands in for the stream, it is never read)
+    reader = SerialReader(sys.stdin, size=1024)
+    burst = (line * (1024 // len(line)))[0:1024]
+    lines = burst.count(b'\n')
+
+    def split():
+        reader._buffer[0:len(burst)] = burst
+        reader._tail = reader._head = 0
+        reader._scanned = 0
+        reader._head = len(burst)
+        count = 0
+        while reader.frame(ASCII_DELIMITER) != None:
+            count += 1
+        assert count == lines
+
+    split()
+    operations += (("split lines", len(burst), split),)
+
+    print("%-24s %14s %14s %8s" % ("operation", "bytes/sec", "bytes alloc", "writes"))
+    for name, size, function in operations:
+        sink.writes = 0
+        function()
+        writes = sink.writes
+        rate = _rate(function, size, count)
+        print("%-24s %14.0f %14.1f %8d" % (name, rate, _allocated(function, count) / count, writes))
+
+if __name__ == "__main__":
+    main()
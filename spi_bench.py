@@ -0,0 +1,113 @@
+#
+# Host benchmark for the LoRaHandler SPI transfer path.
+#
+# Runs loracom.LoRaHandler against a counting SPI stand-in and reports, per
+# operation, the number of SPI calls and the heap allocated.  Works under
+# CPython (tracemalloc) and the MicroPython unix port (gc.mem_alloc).
+#
+#    python3 spi_bench.py
+#    micropython spi_bench.py
+#
+import sys
+import gc
+
+# Minimal stand-ins for the 'machine' objects LoRaHandler uses
+class _CountingSPI():
+    MSB = 0
+
+    def __init__(self, *args, **kwargs):
+        self.calls = 0
+
+    def write(self, buffer):
+        self.calls += 1
+
+    def readinto(self, buffer, write=0):
+        self.calls += 1
+
+    def write_readinto(self, out_buffer, in_buffer):
+        self.calls += 1
+
+    def deinit(self):
+        pass
+
+class _Pin():
+    IN = OUT = PULL_UP = PULL_DOWN = IRQ_RISING = IRQ_FALLING = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def value(self, value=None):
+        return 0
+
+    def irq(self, handler=None, trigger=0):
+        pass
+
+class _machine():
+    SPI = _CountingSPI
+    Pin = _Pin
+
+sys.modules['machine'] = _machine
+
+from loracom import LoRaHandler
+from loradomains import US902_928
+
+# Heap bytes allocated while running function 'count' times
+try:
+    gc.mem_alloc
+
+    def _allocated(function, count):
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        for i in range(count):
+            function()
+        after = gc.mem_alloc()
+        gc.enable()
+        return after - before
+
+except AttributeError:
+    import tracemalloc
+
+    def _allocated(function, count):
+        # Prime any lazily created state before measuring
+        function()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        for i in range(count):
+            function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak - before
+
+def main(count=1000):
+    lora = LoRaHandler(US902_928)
+    lora._spi = _CountingSPI()
+    lora._ss = _Pin()
+    lora._dio_table = []
+    lora._power = None
+
+    packet = bytearray(255)
+    status = bytearray(4)
+
+    operations = (
+        ("read_register",        lambda: lora.read_register(0x12)),
+        ("write_register",       lambda: lora.write_register(0x12, 0xFF)),
+        ("read_registers(4)",    lambda: lora.read_registers(0x10, 4, status)),
+        ("read_buffer(255)",     lambda: lora.read_buffer(0x00, 255, packet)),
+        ("read_buffer(64)",      lambda: lora.read_buffer(0x00, 64, packet)),
+        ("write_buffer(64)",     lambda: lora.write_buffer(0x00, packet, 64)),
+        ("set_channel",          lambda: lora.set_channel(64, 'up', 4)),
+    )
+
+    print("%-20s %10s %14s" % ("operation", "spi calls", "bytes alloc"))
+    for name, function in operations:
+        # First call fills the register shadow; count the steady state
+        function()
+        lora._spi.calls = 0
+        function()
+        calls = lora._spi.calls
+        print("%-20s %10d %14.1f" % (name, calls, _allocated(function, count) / count))
+
+if __name__ == "__main__":
+    main()
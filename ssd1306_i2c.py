@@ -88,3 +88,7 @@ class Display:
 
     def show_time(self, year, month, day, hour, minute, second):
         self.show_datetime(year, month, day, hour, minute, second)
+
+    # Contention on the display lock, taken for every draw
+    def lock_stats(self):
+        return self._lock.stats()
@@ -5,6 +5,24 @@
 #
 import gc
 from ulock import *
+from upool import *
+from uthread import thread
+
+try:
+    from urandom import randrange
+except ImportError:
+    from random import randrange
+
+try:
+    from time import ticks_us, ticks_ms, ticks_add, ticks_diff, sleep_ms
+except ImportError:
+    # Host (CPython) fallback
+    from time import monotonic, sleep
+    ticks_us = lambda : int(monotonic() * 1000000)
+    ticks_ms = lambda : int(monotonic() * 1000)
+    ticks_add = lambda ticks, delta : ticks + delta
+    ticks_diff = lambda new, old : new - old
+    sleep_ms = lambda ms : sleep(ms / 1000)
 
 try:
     _UNUSED_=const(1)
@@ -29,6 +47,7 @@ _SX127x_MODE_TX                     = const(0x03)
 _SX127x_MODE_FS_RX                  = const(0x04)
 _SX127x_MODE_RX_CONTINUOUS          = const(0x05)
 _SX127x_MODE_RX_SINGLE              = const(0x06)
+_SX127x_MODE_CAD                    = const(0x07)
 # 0x02 through 0x05 not used
 _SX127x_REG_FREQ_MSB             = const(0x06)     # Carrier MSB
 _SX127x_REG_FREQ_MID             = const(0x07)     # Carrier Middle
@@ -44,7 +63,7 @@ _SX127x_REG_RX_FIFO_BASE         = const(0x0F)     # Start RX data
 _SX127x_REG_RX_FIFO_CURRENT      = const(0x10)     # Start addr of last packet received
 _SX127x_REG_IRQ_FLAGS_MASK       = const(0x11)     # Optional IRQ flag mask
 _SX127x_REG_IRQ_FLAGS            = const(0x12)     # IRQ flags
-_SX127x_REG_CAD_DETECTED            = const(0x01)
+_SX127x_IRQ_CAD_DETECTED            = const(0x01)
 _SX127x_IRQ_FHSS_CHANGE_CHANNEL     = const(0x02)
 _SX127x_IRQ_CAD_COMPLETE            = const(0x04)
 _SX127x_IRQ_TX_DONE                 = const(0x08)
@@ -58,10 +77,16 @@ _SX127x_REG_RX_HEADER_CNT_LSB    = const(0x15)     # Number of valid headers LSB
 _SX127x_REG_RX_PACKET_CNT_MSB    = const(0x16)     # Number of packets MSB
 _SX127x_REG_RX_PACKET_CNT_LSB    = const(0x17)     # Number of packets LSB
 _SX127x_REG_MODEM_STATUS         = const(0x18)     # Live modem status
+_SX127x_MODEM_SIGNAL_DETECTED       = const(0x01)
+_SX127x_MODEM_SIGNAL_SYNCHRONIZED   = const(0x02)
+_SX127x_MODEM_RX_ONGOING            = const(0x04)
+_SX127x_MODEM_HEADER_VALID          = const(0x08)
+_SX127x_MODEM_CLEAR                 = const(0x10)
 _SX127x_REG_PACKET_SNR           = const(0x19)     # SNR estimate of last packet
 _SX127x_REG_PACKET_RSSI          = const(0x1A)     # Last packet RSSI value
 _SX127x_REG_RSSI_VALUE           = const(0x1B)     # Current SNR value
 _SX127x_REG_HOP_CHANNEL          = const(0x1C)     # FHSS Start channel
+_SX127x_HOP_PRESENT_CHANNEL         = const(0x3F)  # Current hop number
 _SX127x_REG_MODEM_CONFIG_1       = const(0x1D)     # Modem PHY config 1
 _SX127x_REG_MODEM_CONFIG_2       = const(0x1E)     # Modem PHY config 2
 _SX127x_REG_SYMBOL_TIMEOUT       = const(0x1F)     # Receiver timeout value
@@ -105,6 +130,59 @@ _SX127x_REG_PLL                  = const(0x70)     # Constrols PLL bandwidth
 
 # Other consts
 _SX127x_MAX_PACKET_LENGTH        = const(255)
+_SX127x_REG_COUNT                = const(0x80)     # Size of register file (incl. test registers)
+
+# Registers the chip changes on its own.  These are never served from the register shadow.
+_VOLATILE_REGISTERS = (
+        _SX127x_REG_FIFO,
+        _SX127x_REG_OP_MODE,
+        _SX127x_REG_FIFO_PTR,
+        _SX127x_REG_RX_FIFO_CURRENT,
+        _SX127x_REG_IRQ_FLAGS,
+        _SX127x_REG_RX_NUM_BYTES,
+        _SX127x_REG_RX_HEADER_CNT_MSB,
+        _SX127x_REG_RX_HEADER_CNT_LSB,
+        _SX127x_REG_RX_PACKET_CNT_MSB,
+        _SX127x_REG_RX_PACKET_CNT_LSB,
+        _SX127x_REG_MODEM_STATUS,
+        _SX127x_REG_PACKET_SNR,
+        _SX127x_REG_PACKET_RSSI,
+        _SX127x_REG_RSSI_VALUE,
+        _SX127x_REG_HOP_CHANNEL,
+        _SX127x_REG_RX_FIFO_BYTE,
+        _SX127x_REG_FEI_MSB,
+        _SX127x_REG_FEI_MID,
+        _SX127x_REG_FEI_LSB,
+        _SX127x_REG_RSSI_WIDEBAND,
+        _SX127x_REG_VERSION,
+)
+
+# Layout of the RX_FIFO_CURRENT..RX_NUM_BYTES burst read by the receive handler
+_RX_STATUS_FIFO_CURRENT          = const(0)
+_RX_STATUS_IRQ_FLAGS             = const(2)
+_RX_STATUS_NUM_BYTES             = const(3)
+_RX_STATUS_SIZE                  = const(4)
+
+# Layout of the PACKET_SNR..RSSI_VALUE burst
+_RX_METADATA_SNR                 = const(0)
+_RX_METADATA_RSSI                = const(1)
+_RX_METADATA_SIZE                = const(3)
+
+# Receive address filter: a frame starts with its destination (network << 6 | unit)
+_FILTER_HEADER_SIZE              = const(2)
+_FILTER_UNIT_BITS                = const(6)
+_FILTER_UNITS                    = const(64)
+_FILTER_BROADCAST_UNIT           = const(0x3F)
+
+# DIO event ring between the interrupt handler and the service thread (power of 2)
+_IRQ_RING_SIZE                   = const(16)
+
+# Hop table entries; the chip counts hops in the 6 bit HOP_CHANNEL field
+_HOP_TABLE_SIZE                  = const(64)
+_HOP_ENTRY_SIZE                  = const(3)        # FREQ_MSB, FREQ_MID, FREQ_LSB
+
+# DIO_MAPPING_1 DIO1 field for FhssChangeChannel
+_DIO1_FHSS_CHANGE_CHANNEL        = const(0x10)
 
 _TX_FIFO_BASE              = const(0x00)
 _RX_FIFO_BASE              = const(0x00)
@@ -121,6 +199,93 @@ _BANDWIDTH_BINS = (
         250E3
 )
 
+# Bandwidth in Hz the device actually uses for a MODEM_CONFIG_1 bandwidth code
+def _bandwidth_hz(code):
+    return _BANDWIDTH_BINS[code] if code < len(_BANDWIDTH_BINS) else 500E3
+
+# Milliseconds on air for a packet of length bytes (SX1276 datasheet 4.1.1.6/7).
+# bandwidth is in Hz, coding_rate 5..8 for 4/5..4/8.
+def time_on_air(length, spreading_factor, bandwidth, coding_rate=5, preamble_length=8,
+                implicit_header=False, enable_crc=True, low_data_rate=False):
+    symbol = 1000 * 2**spreading_factor / bandwidth
+    numerator = 8 * length - 4 * spreading_factor + 28 + (16 if enable_crc else 0) - (20 if implicit_header else 0)
+    denominator = 4 * (spreading_factor - (2 if low_data_rate else 0))
+    symbols = 8 + max(-(-numerator // denominator) * coding_rate, 0)
+    return (preamble_length + 4.25 + symbols) * symbol
+
+# Channel plan image.  One entry of _PLAN_SIZE bytes per (direction, channel, data_rate),
+# holding the values (or register fields) that set_channel() needs to write.
+_PLAN_FRF_MSB                    = const(0)        # FREQ_MSB .. PA_CONFIG are contiguous (0x06..0x09)
+_PLAN_FRF_MID                    = const(1)
+_PLAN_FRF_LSB                    = const(2)
+_PLAN_PA_CONFIG                  = const(3)
+_PLAN_MODEM_CONFIG_1             = const(4)        # Bandwidth field of MODEM_CONFIG_1
+_PLAN_MODEM_CONFIG_2             = const(5)        # Spreading factor field of MODEM_CONFIG_2
+_PLAN_MODEM_CONFIG_3             = const(6)        # Low data rate optimize field of MODEM_CONFIG_3
+_PLAN_DETECTION_OPTIMIZE         = const(7)
+_PLAN_DETECTION_THRESHOLD        = const(8)
+_PLAN_SIZE                       = const(9)
+
+# Plan group tuple members (one group per entry in domain['channels'])
+_GROUP_TYPE                      = const(0)
+_GROUP_CHAN_LOW                  = const(1)
+_GROUP_CHAN_HIGH                 = const(2)
+_GROUP_DR_LOW                    = const(3)
+_GROUP_DR_HIGH                   = const(4)
+_GROUP_FREQ                      = const(5)
+_GROUP_STEP                      = const(6)
+_GROUP_OFFSET                    = const(7)
+
+# Return MODEM_CONFIG_1 bandwidth code for bandwidth (limited by table specification)
+def _bandwidth_code(bandwidth):
+    for i in range(len(_BANDWIDTH_BINS)):
+        if bandwidth <= _BANDWIDTH_BINS[i]:
+            return i
+    return len(_BANDWIDTH_BINS)
+
+# True when the symbol time is long enough to need 'low data rate optimize'
+def _low_data_rate(bandwidth, spreading_factor):
+    return 1000 / (bandwidth / 2**spreading_factor) > 16
+
+# Order in which to visit count channels: a full period LCG (x = 5x + seed, seed
+# odd) modulo the next power of two, skipping values >= count.  Every channel
+# appears once and every node with the same seed gets the same order.
+def hop_sequence(count, seed=1):
+    modulus = 1
+    while modulus < count:
+        modulus <<= 1
+    seed |= 1
+
+    sequence = []
+    x = 0
+    while len(sequence) < count:
+        x = (5 * x + seed) % modulus
+        if x < count:
+            sequence.append(x)
+    return sequence
+
+# Scan channel statistics list members
+_SCAN_DWELLS                     = const(0)
+_SCAN_DETECTIONS                 = const(1)
+_SCAN_PACKETS                    = const(2)
+_SCAN_CRC_ERRORS                 = const(3)
+_SCAN_RSSI_TOTAL                 = const(4)
+_SCAN_RSSI_LAST                  = const(5)
+_SCAN_RSSI_SAMPLES               = const(6)
+_SCAN_SIZE                       = const(7)
+
+# The sooner of two timeouts in ms, where -1 is no timeout
+def _earliest(first, second):
+    return second if first < 0 or 0 <= second < first else first
+
+# Return PA_CONFIG value for level in dBm
+def _pa_config(level, mode="PA"):
+    if mode == "PA":
+        # PA Boost mode
+        return _SX127x_PA_BOOST | min(max(int(round(level) - 2), 0), 15)
+    else:
+        return 0x70 | (min(max(level, 0), 15))
+
 # _FREQUENCIES = {
 #         196: (42, 64, 0),
 #         433: (108, 64, 0),
@@ -130,6 +295,29 @@ _BANDWIDTH_BINS = (
 #         915: (228, 192, 0),
 # }
 
+# Receive packet buffer.  The driver fills these from a fixed pool; whoever
+# consumes the packet must hand it back with release().
+class SX127x_packet():
+    def __init__(self, pool=None):
+        self._pool   = pool
+        self.in_use  = False       # Out of the pool (kept by the pool)
+        self.buffer  = bytearray(_SX127x_MAX_PACKET_LENGTH)
+        self._view   = memoryview(self.buffer)
+        self.length  = 0
+        self.channel = None
+        self.crc_ok  = False
+        self.rssi    = 0
+        self.snr     = 0
+
+    # View of the received bytes
+    def data(self):
+        return self._view[0:self.length]
+
+    # Hand the buffer back.  A second release() is ignored (and counted in the pool stats).
+    def release(self):
+        if self._pool != None:
+            self._pool.put(self)
+
 # SX127x driver class
 # Must be inherited by an object that contains the following members:
 # Required:
@@ -140,22 +328,57 @@ _BANDWIDTH_BINS = (
 #    attach_interrupt(<dio#>, <callback>)              Enable interrupt, callback supplied (None causes disable)
 #         Call attach_interrupt with None callback to disable
 #
-#    onReceive(packet, crc_ok, rssi)                   Callback to receive a packet
+#    onReceive(packet, crc_ok, rssi)                   Callback to receive a packet (an SX127x_packet
+#                                                      from the driver pool; must be release()d when done)
 #
 #    onTransmit()                                      Callback when packet has been transmitted
 #                                                      Returns next packet if more to send
 #
+#    onReceive() and onTransmit() are called from the driver's service thread,
+#    never from the DIO interrupt itself.
+#
+#    onPoll()                                          Optional: called by the service thread after every
+#                                                      wakeup.  Returns milliseconds until it wants to be
+#                                                      called again, or -1 to wait for the next event.
+#
 #    reset()                                           Reset device
 #
+#  The driver keeps a write-through shadow of the configuration registers and
+#  only goes to the device for registers in _VOLATILE_REGISTERS.  Anything that
+#  changes registers behind the driver's back (e.g. calling reset() outside of
+#  init()) must call invalidate_registers() or sync_registers() afterwards.
+#
 #  Optional:
 #    write_buffer(<register>, <bytearray of values>, size)   Optional: write a packet
-#    read_buffer(<register>, <length>                  Optional: read a packet
+#    read_buffer(<register>, <length>, [<buffer>])     Optional: read a packet (into buffer if supplied)
+#    write_registers(<start>, <values>)                Optional: write contiguous registers in one transfer
+#    read_registers(<start>, <length>, [<buffer>])     Optional: read contiguous registers in one transfer
 #    set_power(state)                                  Set power mode (override and extend is suggested)
 #
 
 # Parameters
 #     domain                - domain frequency and data rate table
 #     channel               - specified if to lock to a specific channel
+#     rx_buffers            - number of receive packet buffers in the pool
+#     service_thread        - False to not start the interrupt service thread in init();
+#                             the owner must then call service() itself
+#     listen_before_talk    - True to run channel activity detection before each transmission
+#                             and back off while the channel is busy
+#     cad_backoff           - (<first>, <largest>) backoff window in ms; doubles on each busy CAD
+#     cad_attempts          - busy CADs before transmitting regardless
+#     hop_period            - symbols between frequency hops (0: no hopping).  Sender and
+#                             receiver must agree on it, hop_channels and hop_seed.
+#     hop_channels          - channels to hop over (default: the largest channel group in the
+#                             configured direction, e.g. the 64 narrow-band US902-928 uplinks)
+#     hop_seed              - hop sequence seed
+#     scan_channels         - channels (in the configured direction) to receive on in turn
+#     scan_dwell            - ms to listen on each scan channel; the dwell is extended while
+#                             the modem sees a preamble or header.  Senders need a preamble
+#                             longer than a full scan to be heard reliably.
+#     address_filter        - (<network>, <units>) to pass on only frames whose first two bytes
+#                             (network << 6 | unit) name network and one of units or the
+#                             broadcast unit.  Others are dropped before a buffer is taken.
+#                             None (default) passes everything; see set_address_filter().
 #
 class SX127x_driver:
 
@@ -169,34 +392,6 @@ class SX127x_driver:
         self._channel = kwargs['channel'] if 'channel' in kwargs else None
 
         self._pll_step = self._xtal / 2**19
-        print("PLL step %f" % self._pll_step)
-
-        # Define channel table for this frequency
-        if 'channels' in self._domain:
-            self._channels = {}
-            for channel in self._domain['channels']:
-                print("testing channel %s" % channel)
-                # Process the range and type of the channel
-                chantype = channel['type']
-
-                if chantype not in self._channels:
-                    self._channels[chantype] = {}
-
-                freq = channel['freq'][0]
-                step = channel['freq'][1]
-                for c in range(channel['chan'][0], channel['chan'][1] + 1):
-                    # self._channels[chantype][c] = { 'dr': channel['dr'], 'freq': self._calc_freq(freq) }
-                    self._channels[chantype][c] = { 'dr': channel['dr'], 'freq': self._calc_freq(freq), 'hz': freq }
-                    freq += step
-
-            # Dump for inspection
-            for t in self._channels:
-                channels = self._channels[t]
-                for c in channels:
-                    print("%s %d: %s" % (t, c, self._channels[t][c]))
-
-        else:
-            raise LorDeviceException("'channels' not found in domain")
 
         if 'data_rates' in self._domain:
             self._data_rates = self._domain['data_rates']
@@ -204,11 +399,18 @@ class SX127x_driver:
         else:
             raise LoraDeviceException("'data_rates' not found in domain")
 
+        # Precompile the channel plan for this domain
+        if 'channels' in self._domain:
+            self._compile_channel_plan()
+
+        else:
+            raise LoraDeviceException("'channels' not found in domain")
+
         self._sync_word        = kwargs['sync_word']        if 'sync_word'        in kwargs else 0x34
         self._preamble_length  = kwargs['preamble_length']  if 'preamble_length'  in kwargs else 8
         self._coding_rate      = kwargs['coding_rate']      if 'coding_rate'      in kwargs else 5
         self._implicit_header  = kwargs['implicit_header']  if 'implicit_header'  in kwargs else False
-        # self._hop_period     = kwargs['hop_period']       if 'hop_period'       in kwargs else 0
+        self._hop_period       = kwargs['hop_period']       if 'hop_period'       in kwargs else 0
         self._enable_crc       = kwargs['enable_crc']       if 'enable_crc'       in kwargs else True
 
         # Set default in case not set by caller
@@ -218,21 +420,101 @@ class SX127x_driver:
 
         self._tx_interrupts = 0
         self._rx_interrupts = 0
-        # self._fhss_interrupts = 0
+        self._fhss_interrupts = 0
+
+        # Frequency hopping: FRF bytes for each hop number, built in init()
+        self._hop_channels = kwargs['hop_channels'] if 'hop_channels' in kwargs else None
+        self._hop_seed     = kwargs['hop_seed']     if 'hop_seed'     in kwargs else 1
+        self._hop_table = None
+        self._hop_entries = None            # FRF bytes of each hop number, as views into _hop_table
+        self._hop_number = 0                # Hop the chip is on; it counts from 0 in every packet
+        self._dio1_mapping = 0
 
         self._current_implicit_header = None
 
+        # SNR of the last received packet
+        self._packet_snr = 0
+
+        # Scratch buffers for the burst reads in the receive handler
+        self._rx_status = bytearray(_RX_STATUS_SIZE)
+        self._rx_metadata = bytearray(_RX_METADATA_SIZE)
+
+        # Write-through shadow of the configuration registers
+        self._shadow = bytearray(_SX127x_REG_COUNT)
+        self._shadow_valid = bytearray(_SX127x_REG_COUNT)
+        self._cacheable = bytearray(b'\x01' * _SX127x_REG_COUNT)
+        for reg in _VOLATILE_REGISTERS:
+            self._cacheable[reg] = 0
+
+        # DIO interrupts only record an event here; service_interrupts() does the work
+        self._irq_dio = bytearray(_IRQ_RING_SIZE)
+        self._irq_time = [ 0 ] * _IRQ_RING_SIZE
+        self._irq_head = 0
+        self._irq_tail = 0
+        self._irq_event = lock(True)
+        self._irq_events = 0
+        self._irq_overflows = 0
+        self._irq_max_latency = 0
+        self._irq_total_latency = 0
+        self._irq_max_service = 0
+        self._dio0_isr = lambda event : self._record_interrupt(0)
+        self._dio1_isr = lambda event : self._hop_interrupt()
+
+        self._service = kwargs['service_thread'] if 'service_thread' in kwargs else True
+        self._service_thread = None
+
+        # Diagnostics are passed to log(text) (print by default)
+        self._log = kwargs['log'] if 'log' in kwargs else print
+
+        # Receive buffers; packets arriving while all are in use are dropped
+        self._rx_pool = pool(kwargs['rx_buffers'] if 'rx_buffers' in kwargs else 4, SX127x_packet)
+
+        # Address filter: per unit accept flags for _filter_network (None: accept all)
+        self._filter_network = None
+        self._filter_units = bytearray(_FILTER_UNITS)
+        self._filter_header = bytearray(_FILTER_HEADER_SIZE)
+        self._filter_passed = 0
+        self._filter_network_dropped = 0
+        self._filter_unit_dropped = 0
+        self._filter_short_dropped = 0
+        if 'address_filter' in kwargs and kwargs['address_filter'] != None:
+            self.set_address_filter(kwargs['address_filter'][0], kwargs['address_filter'][1])
+
+        # Listen before talk
+        self._lbt          = kwargs['listen_before_talk'] if 'listen_before_talk' in kwargs else False
+        self._cad_backoff  = kwargs['cad_backoff']        if 'cad_backoff'        in kwargs else (10, 640)
+        self._cad_attempts = kwargs['cad_attempts']       if 'cad_attempts'       in kwargs else 8
+        self._cad_packet = None             # Packet waiting for a clear channel
+        self._cad_implicit_header = False
+        self._cad_busy = 0                  # Busy CADs seen by _cad_packet
+        self._cad_retry = None              # ticks_ms() of the next CAD
+        self._cad_channels = {}             # (direction, channel) -> [ <CADs>, <busy> ]
+        self._cad_forced = 0
+
+        # Scanning receiver
+        self._scan_channels = kwargs['scan_channels'] if 'scan_channels' in kwargs else None
+        self._scan_dwell    = kwargs['scan_dwell']    if 'scan_dwell'    in kwargs else 0
+        self._scan_index = 0
+        self._scan_current = None           # Channel the receiver is tuned to
+        self._scan_next = None              # ticks_ms() at the end of this dwell
+        self._scan_locked = 0               # ms spent locked on the current channel
+        self._scan_stats = {}               # channel -> [ _SCAN_SIZE counters ]
+        self._tx_active = False
+
         self._lock = rlock()
 
 
     def init(self, wanted_version=0x12, start=True):
         self.reset()
 
+        # Device has reverted to power-on defaults
+        self.invalidate_registers()
+
         # Read version
         version = None
         max_tries = 5
         while version != wanted_version and max_tries != 0:
-            version = self.read_register(_SX127x_REG_VERSION)
+            version = self._get_register(_SX127x_REG_VERSION)
             max_tries = max_tries - 1
 
         if version != wanted_version:
@@ -250,32 +532,45 @@ class SX127x_driver:
         self.set_preamble_length(self._preamble_length)
         self.set_sync_word(self._sync_word)
         self.set_enable_crc(self._enable_crc)
-        # self.set_hop_period(self._hop_period)
+        self.set_hop_period(self._hop_period)
 
         # Configure the unit for receive (may override several of above)
         if self._channel != None:
             self.set_channel(self._channel[0], direction=self._channel[1], data_rate=self._channel[2])
         else:
-            self.set_channel((0, 'up', 0))
+            self.set_channel(0, direction='up')
+
+        # Packets start on the first hop frequency
+        if self._hop_period != 0:
+            self._compile_hop_table()
+            self._fhss_reset()
 
         # LNA Boost
-        self.write_register(_SX127x_REG_LNA, self.read_register(_SX127x_REG_LNA) | 0x03)  # MANIFEST CONST?
+        self._update_register(_SX127x_REG_LNA, 0x03, 0x03)  # MANIFEST CONST?
 
-        # auto AGC enable
-        self.write_register(_SX127x_REG_MODEM_CONFIG_3, 0x04)  # MANIFEST??
+        # auto AGC enable (leave low data rate optimize as set_spreading_factor left it)
+        self._update_register(_SX127x_REG_MODEM_CONFIG_3, 0x04, 0x04)  # MANIFEST??
 
-        self.write_register(_SX127x_REG_TX_FIFO_BASE, _TX_FIFO_BASE) 
-        self.write_register(_SX127x_REG_RX_FIFO_BASE, _RX_FIFO_BASE) 
+        self._set_register(_SX127x_REG_TX_FIFO_BASE, _TX_FIFO_BASE) 
+        self._set_register(_SX127x_REG_RX_FIFO_BASE, _RX_FIFO_BASE) 
 
-        # Mask all but Tx and Rx
-        self.write_register(_SX127x_REG_IRQ_FLAGS_MASK, 0xFF & ~(_SX127x_IRQ_TX_DONE | _SX127x_IRQ_RX_DONE))
+        # Mask all but Tx, Rx, CAD and (when hopping) channel change
+        self._set_register(_SX127x_REG_IRQ_FLAGS_MASK,
+                           0xFF & ~(_SX127x_IRQ_TX_DONE | _SX127x_IRQ_RX_DONE | _SX127x_IRQ_CAD_COMPLETE | _SX127x_IRQ_CAD_DETECTED |
+                                    (_SX127x_IRQ_FHSS_CHANGE_CHANNEL if self._hop_period != 0 else 0)))
 
         # Clear all interrupts
-        self.write_register(_SX127x_REG_IRQ_FLAGS, 0xFF)
+        self._set_register(_SX127x_REG_IRQ_FLAGS, 0xFF)
 
-        # if self._hop_period != 0:
-        #     # Catch the FSHH step
-        #     self.attach_interrupt(1, self._fhss_interrupt)
+        # DIO0 stays attached; the DIO mapping selects RxDone or TxDone
+        self.attach_interrupt(0, self._dio0_isr)
+
+        if self._hop_period != 0:
+            # Catch the FHSS step
+            self.attach_interrupt(1, self._dio1_isr)
+
+        if self._service:
+            self.start_service()
 
         if start:
             # Place in standby mode
@@ -283,6 +578,9 @@ class SX127x_driver:
         else:
             self.set_standby_mode()
 
+        if self._scan_channels != None:
+            self.start_scan(self._scan_channels, self._scan_dwell)
+
 
     # If we cannot do a block write, write byte at a time
     # Can be overwritten by base class to achieve better throughput
@@ -292,11 +590,24 @@ class SX127x_driver:
             self.write_register(address, buffer[i])
 
     # If user does not define a block write, do it the hard way
-    def read_buffer(self, address, length):
-        buffer = bytearray()
-        for l in range(length):
-            buffer.append(self.read_register(address))
-        self._garbage_collect()
+    def read_buffer(self, address, length, buffer=None):
+        if buffer == None:
+            buffer = bytearray(length)
+        for index in range(length):
+            buffer[index] = self.read_register(address)
+        return buffer
+
+    # Burst register access.  The device auto-increments the address, so a base
+    # class with block transfers should override these with one transfer each.
+    def write_registers(self, start, data):
+        for index in range(len(data)):
+            self.write_register(start + index, data[index])
+
+    def read_registers(self, start, length, buffer=None):
+        if buffer == None:
+            buffer = bytearray(length)
+        for index in range(length):
+            buffer[index] = self.read_register(start + index)
         return buffer
 
     # Must be overriden by base class
@@ -309,6 +620,53 @@ class SX127x_driver:
     def attach_interrupt(self, dio, callback):
         raise Exception("enable_interrupt not defined.")
 
+    # Read a register through the shadow.  A cacheable register only costs a
+    # bus transaction the first time it is read after invalidate_registers().
+    def _get_register(self, reg):
+        if self._shadow_valid[reg]:
+            return self._shadow[reg]
+
+        value = self.read_register(reg)
+        if self._cacheable[reg]:
+            self._shadow[reg] = value
+            self._shadow_valid[reg] = 1
+        return value
+
+    # Write a register, keeping the shadow in step
+    def _set_register(self, reg, value):
+        value &= 0xFF
+        if self._cacheable[reg]:
+            self._shadow[reg] = value
+            self._shadow_valid[reg] = 1
+        self.write_register(reg, value)
+
+    # Write contiguous registers in one transfer, keeping the shadow in step
+    def _set_registers(self, start, data):
+        for index in range(len(data)):
+            if self._cacheable[start + index]:
+                self._shadow[start + index] = data[index]
+                self._shadow_valid[start + index] = 1
+        self.write_registers(start, data)
+
+    # Replace the bits selected by mask; the old value comes from the shadow when possible
+    def _update_register(self, reg, mask, bits):
+        self._set_register(reg, (self._get_register(reg) & ~mask) | (bits & mask))
+
+    # Forget the shadowed values.  Must be called whenever the device is reset().
+    def invalidate_registers(self):
+        for reg in range(_SX127x_REG_COUNT):
+            self._shadow_valid[reg] = 0
+
+    # Reload the shadow from the device (skipping the FIFO, which a read would consume)
+    def sync_registers(self):
+        self.invalidate_registers()
+        values = self.read_registers(_SX127x_REG_OP_MODE, _SX127x_REG_PLL)
+        for index in range(len(values)):
+            reg = _SX127x_REG_OP_MODE + index
+            if self._cacheable[reg]:
+                self._shadow[reg] = values[index]
+                self._shadow_valid[reg] = 1
+
     def set_power(self, power=True):
         if power:
             # Bring things up
@@ -322,97 +680,190 @@ class SX127x_driver:
 #        return flags
 
 
+    # Receive buffer pool usage and exhaustion counters
+    def rx_pool_stats(self):
+        return self._rx_pool.stats()
+
+    # Contention on the driver lock, taken for every transmit and receive
+    def lock_stats(self):
+        return self._lock.stats()
+
     def get_packet_rssi(self):
-        rssi = self.read_register(_SX127x_REG_PACKET_RSSI) - 157
+        return self._decode_rssi(self._get_register(_SX127x_REG_PACKET_RSSI))
+
+    def get_packet_snr(self):
+        return self._decode_snr(self._get_register(_SX127x_REG_PACKET_SNR))
+
+    # Convert PACKET_RSSI register value to dBm
+    def _decode_rssi(self, value):
+        rssi = value - 157
         if self._domain['freq_range'][0] < 868E6:
             rssi = rssi + 7
         return rssi
 
-    def get_packet_snr(self):
-        return self.read_register(_SX127x_REG_PACKET_SNR) / 4.0
+    # PACKET_SNR is two's complement in quarter dB
+    def _decode_snr(self, value):
+        return (value - 256 if value & 0x80 else value) / 4.0
 
     def set_standby_mode(self):
         # print("standby mode")
-        self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_STANDBY)
+        self._set_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_STANDBY)
 
     def set_sleep_mode(self):
         # print("sleep mode")
-        self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_SLEEP)
+        self._set_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_SLEEP)
 
     def set_receive_mode(self):
         # print("receive mode")
         # self.set_channel(self._receive_channel)
-        self.attach_interrupt(0, self._rxhandle_interrupt)
         # self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_RX_SINGLE)
-        self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_RX_CONTINUOUS)
-        self.write_register(_SX127x_REG_DIO_MAPPING_1, 0b00000000)
+        self._set_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_RX_CONTINUOUS)
+        self._set_register(_SX127x_REG_DIO_MAPPING_1, 0b00000000 | self._dio1_mapping)
+
+    # Channel activity detection; DIO0 signals CadDone
+    def set_cad_mode(self):
+        self._set_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_CAD)
+        self._set_register(_SX127x_REG_DIO_MAPPING_1, 0b10000000 | self._dio1_mapping)
 
     def set_transmit_mode(self):
         # print("transmit mode")
         # Reset SEED
         # self.set_channel(self._transmit_channel)
-        self.attach_interrupt(0, self._txhandle_interrupt)
-        self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_TX)
-        self.write_register(_SX127x_REG_DIO_MAPPING_1, 0b01000000)
+        self._set_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_TX)
+        self._set_register(_SX127x_REG_DIO_MAPPING_1, 0b01000000 | self._dio1_mapping)
 
     # Level in dBm
     def set_tx_power(self, level, mode="PA"):
         self._tx_power = (level, mode)
-
-        if mode == "PA":
-            # PA Boost mode
-            level = min(max(int(round(level) - 2), 0), 15)
-            self.write_register(_SX127x_REG_PA_CONFIG, _SX127x_PA_BOOST | level)
-        else:
-            self.write_register(_SX127x_REG_PA_CONFIG, 0x70 | (min(max(level, 0), 15)))
+        self._set_register(_SX127x_REG_PA_CONFIG, _pa_config(level, mode))
 
     def get_tx_power(self):
         return self._tx_power
 
+    # Build the flat register image for every (direction, channel, data_rate) in the domain
+    def _compile_channel_plan(self):
+        self._plan_groups = []
+        size = 0
+        for channel in self._domain['channels']:
+            for data_rate in range(channel['dr'][0], channel['dr'][1] + 1):
+                if data_rate not in self._data_rates:
+                    raise LoraDeviceException("data rate %d not found in domain" % data_rate)
+
+            self._plan_groups.append((channel['type'], channel['chan'][0], channel['chan'][1],
+                                      channel['dr'][0], channel['dr'][1],
+                                      channel['freq'][0], channel['freq'][1], size))
+            size += (channel['chan'][1] - channel['chan'][0] + 1) * (channel['dr'][1] - channel['dr'][0] + 1) * _PLAN_SIZE
+
+        self._plan = bytearray(size)
+        for group in self._plan_groups:
+            offset = group[_GROUP_OFFSET]
+            freq = group[_GROUP_FREQ]
+            for c in range(group[_GROUP_CHAN_LOW], group[_GROUP_CHAN_HIGH] + 1):
+                for data_rate in range(group[_GROUP_DR_LOW], group[_GROUP_DR_HIGH] + 1):
+                    self._compile_plan_entry(self._plan, offset, freq, data_rate)
+                    offset += _PLAN_SIZE
+                freq += group[_GROUP_STEP]
+
+        # For data rates the domain does not allow on a channel
+        self._plan_scratch = bytearray(_PLAN_SIZE)
+
+    # Fill one plan entry.  Only the frequency is filled if data_rate is not in the domain.
+    def _compile_plan_entry(self, plan, offset, freq, data_rate):
+        frf = self._calc_freq(freq)
+        plan[offset + _PLAN_FRF_MSB] = frf[0]
+        plan[offset + _PLAN_FRF_MID] = frf[1]
+        plan[offset + _PLAN_FRF_LSB] = frf[2]
+
+        if data_rate in self._data_rates:
+            rate = self._data_rates[data_rate]
+            sf = min(max(rate['sf'], 6), 12)
+            plan[offset + _PLAN_PA_CONFIG] = _pa_config(rate['tx'])
+            plan[offset + _PLAN_MODEM_CONFIG_1] = _bandwidth_code(rate['bw']) << 4
+            plan[offset + _PLAN_MODEM_CONFIG_2] = sf << 4
+            plan[offset + _PLAN_MODEM_CONFIG_3] = 0x08 if _low_data_rate(rate['bw'], sf) else 0x00
+            plan[offset + _PLAN_DETECTION_OPTIMIZE] = 0xc5 if sf == 6 else 0xc3
+            plan[offset + _PLAN_DETECTION_THRESHOLD] = 0x0c if sf == 6 else 0x0a
+
+    # Return the plan group holding channel or None
+    def _find_plan_group(self, channel, direction):
+        for group in self._plan_groups:
+            if group[_GROUP_TYPE] == direction and group[_GROUP_CHAN_LOW] <= channel <= group[_GROUP_CHAN_HIGH]:
+                return group
+        return None
+
+    # Write register only if the shadow says it is different
+    def _refresh_register(self, reg, value):
+        if not self._shadow_valid[reg] or self._shadow[reg] != value:
+            self._set_register(reg, value)
+
+    # Write a plan entry to the device.  The frequency is always written (the
+    # synthesizer only retunes when FREQ_LSB is written); the remaining modem settings
+    # are merged into the shadowed registers and only written when they change.
+    def _apply_plan_entry(self, plan, offset, with_rate):
+        # FREQ_MSB, FREQ_MID, FREQ_LSB (and PA_CONFIG) in one transfer
+        view = memoryview(plan)
+        if with_rate:
+            self._set_registers(_SX127x_REG_FREQ_MSB, view[offset:offset + _PLAN_PA_CONFIG + 1])
+        else:
+            self._set_registers(_SX127x_REG_FREQ_MSB, view[offset:offset + _PLAN_FRF_LSB + 1])
+
+        if with_rate:
+            self._refresh_register(_SX127x_REG_MODEM_CONFIG_1,
+                                   (self._get_register(_SX127x_REG_MODEM_CONFIG_1) & 0x0F) | plan[offset + _PLAN_MODEM_CONFIG_1])
+            self._refresh_register(_SX127x_REG_MODEM_CONFIG_2,
+                                   (self._get_register(_SX127x_REG_MODEM_CONFIG_2) & 0x0F) | plan[offset + _PLAN_MODEM_CONFIG_2])
+            self._refresh_register(_SX127x_REG_MODEM_CONFIG_3,
+                                   (self._get_register(_SX127x_REG_MODEM_CONFIG_3) & ~0x08) | plan[offset + _PLAN_MODEM_CONFIG_3])
+            self._refresh_register(_SX127x_REG_DETECTION_OPTIMIZE, plan[offset + _PLAN_DETECTION_OPTIMIZE])
+            self._refresh_register(_SX127x_REG_DETECTION_THRESHOLD, plan[offset + _PLAN_DETECTION_THRESHOLD])
+
     #
     # set channel and optional data_rate
     #
     # if no data_rate, calculates rate from channel configuration.
     # If data_rate < 0, then no change will be made to data_rate, etc.
     def set_channel(self, channel, direction='up', data_rate=None):
-        print("set channel to '%s' %d dr %d" % (direction, channel, data_rate))
-        if channel in self._channels[direction]:
-            self._current_channel = self._channels[direction][channel]
-
-            info = self._current_channel['freq']
-            self.write_register(_SX127x_REG_FREQ_MSB, info[0])
-            self.write_register(_SX127x_REG_FREQ_MID, info[1])
-            self.write_register(_SX127x_REG_FREQ_LSB, info[2])
-
-            # If no datarate selected, use the channel-specific default
-            if data_rate == None:
-                data_rate = self._current_channel['dr'][0]
-
-            # If valid datarate, set bandwidth, spreading factor and tx power
-            # I.e. call set_channel with data_rate=-1 to avoid changing values
-            if data_rate >= 0 and data_rate < len(self._data_rates):
-                self.set_bandwidth(self._data_rates[data_rate]['bw'])
-                self.set_spreading_factor(self._data_rates[data_rate]['sf'])
-                self.set_tx_power(self._data_rates[data_rate]['tx'])
-    
-            self._channel = (channel, direction, data_rate)
+        group = self._find_plan_group(channel, direction)
+        if group == None:
+            raise Exception("Invalid channel: %s" % channel)
 
+        # If no datarate selected, use the channel-specific default
+        if data_rate == None:
+            data_rate = group[_GROUP_DR_LOW]
+
+        if group[_GROUP_DR_LOW] <= data_rate <= group[_GROUP_DR_HIGH]:
+            plan = self._plan
+            offset = group[_GROUP_OFFSET] + ((channel - group[_GROUP_CHAN_LOW]) * (group[_GROUP_DR_HIGH] - group[_GROUP_DR_LOW] + 1) +
+                                             data_rate - group[_GROUP_DR_LOW]) * _PLAN_SIZE
         else:
-            raise Exception("Invalid channel: %s" % channel)
+            # Not in the precompiled plan; build the entry on the fly
+            plan = self._plan_scratch
+            offset = 0
+            self._compile_plan_entry(plan, offset, group[_GROUP_FREQ] + (channel - group[_GROUP_CHAN_LOW]) * group[_GROUP_STEP], data_rate)
+
+        # If valid datarate, set bandwidth, spreading factor and tx power
+        # I.e. call set_channel with data_rate=-1 to avoid changing values
+        with_rate = data_rate in self._data_rates
+        self._apply_plan_entry(plan, offset, with_rate)
+
+        if with_rate:
+            rate = self._data_rates[data_rate]
+            self._bandwidth = rate['bw']
+            self._spreading_factor = min(max(rate['sf'], 6), 12)
+            self._tx_power = (rate['tx'], "PA")
+
+        self._channel = (channel, direction, data_rate)
+        self._scan_current = channel
+
+        if self._hop_table != None:
+            self._fhss_reset()
 
     def get_channel(self):
         return self._channel
 
     # Set bandwidth (limited by table specification)
     def set_bandwidth(self, bandwidth):
-        bw = len(_BANDWIDTH_BINS)
-        for i in range(len(_BANDWIDTH_BINS)):
-            if bandwidth <= _BANDWIDTH_BINS[i]:
-                bw = i
-                break
-    
-        self.write_register(_SX127x_REG_MODEM_CONFIG_1,
-                             (self.read_register(_SX127x_REG_MODEM_CONFIG_1) & 0x0f) | (bw << 4))
+        self._update_register(_SX127x_REG_MODEM_CONFIG_1, 0xF0, _bandwidth_code(bandwidth) << 4)
 
         self._bandwidth = bandwidth
 
@@ -423,18 +874,12 @@ class SX127x_driver:
         self._spreading_factor = min(max(spreading_factor, 6), 12)
     
         # Set 'low data rate' flag if long symbol time otherwise clear it
-        config3 = self.read_register(_SX127x_REG_MODEM_CONFIG_3)
-        if 1000 / (self._bandwidth / 2**self._spreading_factor) > 16:
-            config3 |= 0x08
-        else:
-            config3 &= ~0x08
-        
-        self.write_register(_SX127x_REG_MODEM_CONFIG_3, config3)
+        low_data_rate = _low_data_rate(self._bandwidth, self._spreading_factor)
+        self._update_register(_SX127x_REG_MODEM_CONFIG_3, 0x08, 0x08 if low_data_rate else 0x00)
     
-        self.write_register(_SX127x_REG_DETECTION_OPTIMIZE, 0xc5 if self._spreading_factor == 6 else 0xc3)
-        self.write_register(_SX127x_REG_DETECTION_THRESHOLD, 0x0c if self._spreading_factor == 6 else 0x0a)
-        self.write_register(_SX127x_REG_MODEM_CONFIG_2,
-                            (self.read_register(_SX127x_REG_MODEM_CONFIG_2) & 0x0f) | ((self._spreading_factor << 4) & 0xf0))
+        self._set_register(_SX127x_REG_DETECTION_OPTIMIZE, 0xc5 if self._spreading_factor == 6 else 0xc3)
+        self._set_register(_SX127x_REG_DETECTION_THRESHOLD, 0x0c if self._spreading_factor == 6 else 0x0a)
+        self._update_register(_SX127x_REG_MODEM_CONFIG_2, 0xF0, self._spreading_factor << 4)
     
     def get_spreading_factor(self):
         return self._spreading_factor
@@ -442,101 +887,347 @@ class SX127x_driver:
     def set_coding_rate(self, rate):
         # Limit it
         rate = min(max(rate, 5), 8)
+        self._coding_rate = rate
 
-        self.write_register(_SX127x_REG_MODEM_CONFIG_1, (self.read_register(_SX127x_REG_MODEM_CONFIG_1) & 0xF1) | (rate - 4) << 1)
+        self._update_register(_SX127x_REG_MODEM_CONFIG_1, 0x0E, (rate - 4) << 1)
 
     def set_preamble_length(self, length):
-        self.write_register(_SX127x_REG_PREAMBLE_MSB, (length >> 8))
-        self.write_register(_SX127x_REG_PREAMBLE_LSB, length)
+        self._preamble_length = length
+        self._set_registers(_SX127x_REG_PREAMBLE_MSB, bytes(((length >> 8) & 0xFF, length & 0xFF)))
 
     def set_enable_crc(self, enable=True):
-        config = self.read_register(_SX127x_REG_MODEM_CONFIG_2)
-        if enable:
-            config |= 0x04
+        self._enable_crc = enable
+        self._update_register(_SX127x_REG_MODEM_CONFIG_2, 0x04, 0x04 if enable else 0x00)
+
+    # Symbols between frequency hops (0 disables hopping)
+    def set_hop_period(self, hop_period):
+        self._hop_period = hop_period
+        self._dio1_mapping = _DIO1_FHSS_CHANGE_CHANNEL if hop_period != 0 else 0
+        self._set_register(_SX127x_REG_HOP_PERIOD, hop_period)
+
+    # Build the FRF bytes for each hop number from the domain channel table
+    def _compile_hop_table(self):
+        direction = self._channel[1]
+        channels = self._hop_channels
+        if channels == None:
+            # The direction's largest group: the one FHSS rules are written for
+            largest = None
+            for group in self._plan_groups:
+                if group[_GROUP_TYPE] == direction and (largest == None or
+                        group[_GROUP_CHAN_HIGH] - group[_GROUP_CHAN_LOW] > largest[_GROUP_CHAN_HIGH] - largest[_GROUP_CHAN_LOW]):
+                    largest = group
+            channels = range(largest[_GROUP_CHAN_LOW], largest[_GROUP_CHAN_HIGH] + 1)
+
+        sequence = hop_sequence(len(channels), self._hop_seed)
+        self._hop_table = bytearray(_HOP_TABLE_SIZE * _HOP_ENTRY_SIZE)
+        for index in range(_HOP_TABLE_SIZE):
+            channel = channels[sequence[index % len(sequence)]]
+            group = self._find_plan_group(channel, direction)
+            if group == None:
+                raise LoraDeviceException("Invalid hop channel: %s" % channel)
+            frf = self._calc_freq(group[_GROUP_FREQ] + (channel - group[_GROUP_CHAN_LOW]) * group[_GROUP_STEP])
+            for byte in range(_HOP_ENTRY_SIZE):
+                self._hop_table[index * _HOP_ENTRY_SIZE + byte] = frf[byte]
+        view = memoryview(self._hop_table)
+        self._hop_entries = [ view[index * _HOP_ENTRY_SIZE:(index + 1) * _HOP_ENTRY_SIZE] for index in range(_HOP_TABLE_SIZE) ]
+
+    # DIO1 (FhssChangeChannel) comes here.  The chip's hop count restarts with every
+    # packet, as _fhss_reset() does ours, so the next frequency is already known and is
+    # written at once, without reading HOP_CHANNEL back.  If the driver is busy with the
+    # device (perhaps on this very thread) the service thread does it.  No allocation.
+    def _hop_interrupt(self):
+        if self._hop_table != None and self._lock.acquire_free():
+            try:
+                self._fhss_hop((self._hop_number + 1) & (_HOP_TABLE_SIZE - 1))
+            finally:
+                self._lock.release()
         else:
-            config &= ~0x04
-        self.write_register(_SX127x_REG_MODEM_CONFIG_2, config)
-
-    # def set_hop_period(self, hop_period):
-    #    self.write_register(_SX127x_REG_HOP_PERIOD, hop_period)
+            self._record_interrupt(1)
+
+    # A hop the interrupt handler left to us.  Hops made meanwhile raise no new edge
+    # (the flag is still set), so go by the chip's own count.
+    def _fhss_catch_up(self):
+        self._fhss_hop(self.read_register(_SX127x_REG_HOP_CHANNEL) & _SX127x_HOP_PRESENT_CHANNEL)
+
+    # Move to the frequency of hop number and clear the interrupt
+    def _fhss_hop(self, number):
+        self._hop_number = number
+        self._set_registers(_SX127x_REG_FREQ_MSB, self._hop_entries[number])
+        self._set_register(_SX127x_REG_IRQ_FLAGS, _SX127x_IRQ_FHSS_CHANGE_CHANNEL)
+        self._fhss_interrupts += 1
+
+    # Back to the first hop frequency, where every packet starts
+    def _fhss_reset(self):
+        self._hop_number = 0
+        self._set_registers(_SX127x_REG_FREQ_MSB, self._hop_entries[0])
+
+    # Milliseconds on air for a packet of length bytes with the current modem settings
+    def time_on_air(self, length, implicit_header=False):
+        return time_on_air(length, self._spreading_factor, _bandwidth_hz(_bandwidth_code(self._bandwidth)),
+                           self._coding_rate, self._preamble_length, implicit_header, self._enable_crc,
+                           (self._get_register(_SX127x_REG_MODEM_CONFIG_3) & 0x08) != 0)
 
     def set_sync_word(self, sync):
-        self.write_register(_SX127x_REG_SYNC_WORD, sync)
+        self._set_register(_SX127x_REG_SYNC_WORD, sync)
 
     def set_implicit_header(self, implicit_header = True):
         if implicit_header != self._current_implicit_header:
             self._current_implicit_header = implicit_header
-            config = self.read_register(_SX127x_REG_MODEM_CONFIG_1)
-            if implicit_header:
-                config |= 0x01
-            else:
-                config &= ~0x01
-            self.write_register(_SX127x_REG_MODEM_CONFIG_1, config)
+            self._update_register(_SX127x_REG_MODEM_CONFIG_1, 0x01, 0x01 if implicit_header else 0x00)
 
     # Enable receive mode
     def enable_receive(self, length=0):
         self.set_implicit_header(length != 0)
 
         if length != 0:
-            self.write_register(_SX127x_REG_PAYLOAD_LENGTH, length)
-
-    # Receive interrupt comes here
-    def _rxhandle_interrupt(self, event):
-        # print("_rxhandle_interrupt fired on %s" % str(event))
-        flags = self.read_register(_SX127x_REG_IRQ_FLAGS)
-        self.write_register(_SX127x_REG_IRQ_FLAGS, flags)
+            self._set_register(_SX127x_REG_PAYLOAD_LENGTH, length)
+
+    # DIO interrupt comes here.  Only records the event and wakes the service
+    # thread: no SPI traffic, no locks, no allocation.
+    def _record_interrupt(self, dio):
+        head = self._irq_head
+        next = (head + 1) & (_IRQ_RING_SIZE - 1)
+        if next == self._irq_tail:
+            self._irq_overflows += 1
+        else:
+            self._irq_dio[head] = dio
+            self._irq_time[head] = ticks_us()
+            self._irq_head = next
+
+        if self._irq_event.locked():
+            try:
+                self._irq_event.release()
+            except:
+                pass
+
+    # Wait for the DIO interrupt to record something, or for timeout milliseconds
+    # (-1 waits forever).  Returns False on timeout.
+    def wait_interrupt(self, timeout=-1):
+        return self._irq_event.acquire(1, timeout)
+
+    # Wake the service thread so it calls onPoll() again
+    def wake(self):
+        if self._irq_event.locked():
+            try:
+                self._irq_event.release()
+            except:
+                pass
+
+    # Default poll: nothing to schedule
+    def onPoll(self):
+        return -1
+
+    # One pass of the service loop for owners running without the service thread.
+    # Returns milliseconds until it needs to run again (-1: at the next event).
+    def service(self):
+        self.service_interrupts()
+        timeout = _earliest(self._service_cad(), self._service_scan())
+        return _earliest(timeout, self.onPoll())
+
+    # Bottom half: drain the event ring, read the IRQ state once and dispatch.
+    # Returns True if there was anything to do.
+    def service_interrupts(self):
+        if self._irq_tail == self._irq_head:
+            return False
+
+        start = ticks_us()
+        hop = False
+        other = False
+        while self._irq_tail != self._irq_head:
+            if self._irq_dio[self._irq_tail] == 1:
+                hop = True
+            else:
+                other = True
+            latency = ticks_diff(start, self._irq_time[self._irq_tail])
+            self._irq_total_latency += latency
+            if latency > self._irq_max_latency:
+                self._irq_max_latency = latency
+            self._irq_events += 1
+            self._irq_tail = (self._irq_tail + 1) & (_IRQ_RING_SIZE - 1)
 
-        self._rx_interrupts += 1
+        with self._lock:
+            # A hop the interrupt handler could not make first: the next hop period is already running
+            if hop and self._hop_table != None:
+                self._fhss_catch_up()
 
-        if flags & _SX127x_IRQ_RX_DONE:
-            with self._lock:
-                self.write_register(_SX127x_REG_FIFO_PTR, self.read_register(_SX127x_REG_RX_FIFO_CURRENT))
-                if self._implicit_header:
-                    length = self.read_register(_SX127x_REG_PAYLOAD_LENGTH)
-                else:
-                    length = self.read_register(_SX127x_REG_RX_NUM_BYTES)
-                packet = self.read_buffer(_SX127x_REG_FIFO, length)
+            # A hop alone needs nothing more
+            if other or self._hop_table == None:
+                self._service_flags()
 
-                crc_ok = (flags & _SX127x_IRQ_PAYLOAD_CRC_ERROR) == 0
+        elapsed = ticks_diff(ticks_us(), start)
+        if elapsed > self._irq_max_service:
+            self._irq_max_service = elapsed
 
-                self.onReceive(packet, crc_ok, self.get_packet_rssi())
-        else:
-            print("_rxhandle_interrupt: not for us %02x" % flags)
-  
-    # FHSS interrupt - change channel
-    # def _fhss_interrupt(self, event):
-    #    self._write_register(_SX127x_FHSS_CHANNEL, next_channel)
-    #    self._fhss_interrupts += 1
+        return True
 
+    # Read the IRQ state once and dispatch
+    def _service_flags(self):
+        # RX_FIFO_CURRENT, IRQ_FLAGS_MASK, IRQ_FLAGS and RX_NUM_BYTES in one transfer
+        status = self.read_registers(_SX127x_REG_RX_FIFO_CURRENT, _RX_STATUS_SIZE, self._rx_status)
+        flags = status[_RX_STATUS_IRQ_FLAGS]
+        if flags:
+            self._set_register(_SX127x_REG_IRQ_FLAGS, flags)
 
-    def _txhandle_interrupt(self, event):
-        flags = self.read_register(_SX127x_REG_IRQ_FLAGS)
-        self.write_register(_SX127x_REG_IRQ_FLAGS, flags)
+        # FhssChangeChannel is left to DIO1: every hop raises it once, so none is counted twice
 
-        self._tx_interrupts += 1
+        if flags & _SX127x_IRQ_RX_DONE:
+            self._rx_interrupts += 1
+            self._receive_done(status, flags)
 
-        # print("_txhandle_interrupt fired on %s %02x" % (str(event), flags))
         if flags & _SX127x_IRQ_TX_DONE:
-            # Say processed
-
-            # Transmit interrupt
-            with self._lock:
-                packet = self.onTransmit()
-                if packet:
-                    self.transmit_packet(packet)
-                else:
-                    self.set_receive_mode()
+            self._tx_interrupts += 1
+            self._transmit_done()
+
+        if flags & _SX127x_IRQ_CAD_COMPLETE:
+            self._cad_done(flags)
+
+        if not flags & (_SX127x_IRQ_RX_DONE | _SX127x_IRQ_TX_DONE | _SX127x_IRQ_CAD_COMPLETE | _SX127x_IRQ_FHSS_CHANGE_CHANNEL):
+            self._log("service_interrupts: not for us %02x" % flags)
+
+    # Service thread body
+    def _service_run(self, t):
+        timeout = -1
+        while t.running:
+            self.wait_interrupt(timeout)
+            timeout = self.service()
+        return 0
+
+    def start_service(self):
+        if self._service_thread == None:
+            self._service_thread = thread(run=self._service_run, name="sx127x_service", stack=8192)
+            self._service_thread.start()
+
+    def stop_service(self):
+        if self._service_thread != None:
+            self._service_thread.stop()
+            # Wake it so it sees the stop
+            self.wake()
+            self._service_thread.wait()
+            self._service_thread = None
+
+    # Latencies in microseconds from DIO interrupt to service thread pickup
+    def interrupt_stats(self):
+        return {
+            'events':          self._irq_events,
+            'overflows':       self._irq_overflows,
+            'max_latency_us':  self._irq_max_latency,
+            'avg_latency_us':  self._irq_total_latency // self._irq_events if self._irq_events else 0,
+            'max_service_us':  self._irq_max_service,
+            'hops':            self._fhss_interrupts,
+        }
+
+    # Packet received
+    def _receive_done(self, status, flags):
+        if self._hop_table != None:
+            self._fhss_reset()
+
+        channel = self._channel[0] if self._scan_channels == None else self._scan_current
+        counters = None
+        if self._scan_channels != None:
+            # Stay a full dwell on a channel that just carried a packet
+            self._scan_locked = 0
+            self._scan_next = ticks_add(ticks_ms(), self._scan_dwell)
+            counters = self._scan_counters(channel)
+            counters[_SCAN_PACKETS] += 1
+            if flags & _SX127x_IRQ_PAYLOAD_CRC_ERROR:
+                counters[_SCAN_CRC_ERRORS] += 1
+
+        if self._implicit_header:
+            length = self._get_register(_SX127x_REG_PAYLOAD_LENGTH)
+        else:
+            length = status[_RX_STATUS_NUM_BYTES]
+
+        if self._filter_network != None and not self._accept_address(status[_RX_STATUS_FIFO_CURRENT], length):
+            return
+
+        packet = self._rx_pool.get()
+        if packet == None:
+            # No free buffer; leave it in the FIFO to be overwritten (counted by the pool)
+            return
+
+        self._set_register(_SX127x_REG_FIFO_PTR, status[_RX_STATUS_FIFO_CURRENT])
+        self.read_buffer(_SX127x_REG_FIFO, length, packet.buffer)
+        packet.length = length
+
+        packet.crc_ok = (flags & _SX127x_IRQ_PAYLOAD_CRC_ERROR) == 0
+
+        # PACKET_SNR, PACKET_RSSI and RSSI_VALUE in one transfer
+        metadata = self.read_registers(_SX127x_REG_PACKET_SNR, _RX_METADATA_SIZE, self._rx_metadata)
+        packet.snr = self._packet_snr = self._decode_snr(metadata[_RX_METADATA_SNR])
+        packet.rssi = self._decode_rssi(metadata[_RX_METADATA_RSSI])
+        packet.channel = channel
+
+        if counters != None:
+            counters[_SCAN_RSSI_TOTAL] += packet.rssi
+            counters[_SCAN_RSSI_LAST] = packet.rssi
+            counters[_SCAN_RSSI_SAMPLES] += 1
+
+        self.onReceive(packet, packet.crc_ok, packet.rssi)
+
+    # True if the frame of length bytes at fifo in the FIFO is for an address the filter passes.
+    # Reads only the destination bytes.
+    def _accept_address(self, fifo, length):
+        if length < _FILTER_HEADER_SIZE:
+            self._filter_short_dropped += 1
+            return False
+
+        self._set_register(_SX127x_REG_FIFO_PTR, fifo)
+        header = self.read_buffer(_SX127x_REG_FIFO, _FILTER_HEADER_SIZE, self._filter_header)
+        address = (header[0] << 8) | header[1]
+        if address >> _FILTER_UNIT_BITS != self._filter_network:
+            self._filter_network_dropped += 1
+            return False
+
+        if not self._filter_units[address & (_FILTER_UNITS - 1)]:
+            self._filter_unit_dropped += 1
+            return False
+
+        self._filter_passed += 1
+        return True
+
+    # Pass on only frames for network and one of units, or its broadcast unit if broadcast.
+    # network None passes every frame (promiscuous).
+    def set_address_filter(self, network=None, units=(), broadcast=True):
+        table = bytearray(_FILTER_UNITS)
+        for unit in units:
+            table[unit & (_FILTER_UNITS - 1)] = 1
+        if broadcast:
+            table[_FILTER_BROADCAST_UNIT] = 1
+
+        # Table first so the receive path never pairs a new network with old units
+        self._filter_units = table
+        self._filter_network = network
+
+    # Frames passed and dropped by the address filter
+    def filter_stats(self):
+        return {
+            'enabled':         self._filter_network != None,
+            'passed':          self._filter_passed,
+            'network_dropped': self._filter_network_dropped,
+            'unit_dropped':    self._filter_unit_dropped,
+            'short_dropped':   self._filter_short_dropped,
+        }
+
+    # Packet transmitted; send the next one or go back to receive
+    def _transmit_done(self):
+        self._tx_active = False
+        if self._hop_table != None:
+            self._fhss_reset()
+
+        packet = self.onTransmit()
+        if packet:
+            self.transmit_packet(packet)
         else:
-            print("_txhandle_interrupt: not for us %02x" % flags)
+            self.set_receive_mode()
 
     def _start_packet(self, implicit_header = False):
         self.set_standby_mode()
         self.set_implicit_header(implicit_header)
-        self.write_register(_SX127x_REG_FIFO_PTR, _TX_FIFO_BASE)
-        self.write_register(_SX127x_REG_PAYLOAD_LENGTH, 0)
+        self._set_register(_SX127x_REG_FIFO_PTR, _TX_FIFO_BASE)
+        self._set_register(_SX127x_REG_PAYLOAD_LENGTH, 0)
 
     def _write_packet(self, buffer):
-        current = self.read_register(_SX127x_REG_PAYLOAD_LENGTH)
+        current = self._get_register(_SX127x_REG_PAYLOAD_LENGTH)
         size = min(len(buffer), (_SX127x_MAX_PACKET_LENGTH - _TX_FIFO_BASE - current))
 
         # print("_write_packet: writing %d: '%s'" % (size, buffer.decode()))
@@ -544,22 +1235,193 @@ class SX127x_driver:
         self.write_buffer(_SX127x_REG_FIFO, buffer, size)
 
         # print("_write_packet: writing current %d + size %d = %d" % (current, size, current+size))
-        self.write_register(_SX127x_REG_PAYLOAD_LENGTH, current + size)
+        self._set_register(_SX127x_REG_PAYLOAD_LENGTH, current + size)
 
         return size
 
+    # Send packet; with listen before talk it goes once CAD finds the channel clear
     def transmit_packet(self, packet, implicit_header = False):
         # print("transmit_packet lock %s" % self._lock.locked())
         with self._lock:
-            # print("Starting packet")
-            self._start_packet(implicit_header)
-            self._write_packet(packet)
-            self.set_transmit_mode()
+            # A scanning receiver always transmits on the configured channel
+            if self._scan_channels != None and self._scan_current != self._channel[0]:
+                self._scan_tune(self._channel[0])
+            if self._lbt:
+                self._cad_packet = packet
+                self._cad_implicit_header = implicit_header
+                self._cad_busy = 0
+                self._start_cad()
+            else:
+                self._transmit_now(packet, implicit_header)
             # print("Unlocked")
 
-    def _garbage_collect(self):
-        gc.collect()
+    def _transmit_now(self, packet, implicit_header):
+        # print("Starting packet")
+        self._tx_active = True
+        self._start_packet(implicit_header)
+        self._write_packet(packet)
+        self.set_transmit_mode()
+
+    def _start_cad(self):
+        self._cad_retry = None
+        self.set_standby_mode()
+        self.set_cad_mode()
+
+    # CAD finished: transmit the waiting packet if the channel is clear, otherwise
+    # listen for a random time within a window that doubles with each busy result
+    def _cad_done(self, flags):
+        packet = self._cad_packet
+        if packet == None:
+            return
+
+        key = (self._channel[1], self._channel[0])
+        if key not in self._cad_channels:
+            self._cad_channels[key] = [ 0, 0 ]
+        counts = self._cad_channels[key]
+        counts[0] += 1
+
+        if flags & _SX127x_IRQ_CAD_DETECTED:
+            counts[1] += 1
+            self._cad_busy += 1
+            if self._cad_busy < self._cad_attempts:
+                window = min(self._cad_backoff[0] << (self._cad_busy - 1), self._cad_backoff[1])
+                self._cad_retry = ticks_add(ticks_ms(), randrange(1, window + 1))
+                self.set_receive_mode()
+                return
+
+            self._cad_forced += 1
+
+        self._cad_packet = None
+        self._transmit_now(packet, self._cad_implicit_header)
+
+    # Run the next CAD when its backoff is over.  Returns ms until then or -1.
+    def _service_cad(self):
+        if self._cad_retry == None:
+            return -1
+
+        wait = ticks_diff(self._cad_retry, ticks_ms())
+        if wait > 0:
+            return wait
+
+        with self._lock:
+            self._start_cad()
+        return -1
+
+    # Receive on each of channels in turn for dwell ms (default: 8 symbols, at least 10 ms)
+    def start_scan(self, channels, dwell=0):
+        if self._hop_period != 0:
+            raise LoraDeviceException("Cannot scan while frequency hopping")
+
+        for channel in channels:
+            if self._find_plan_group(channel, self._channel[1]) == None:
+                raise LoraDeviceException("Invalid scan channel: %s" % channel)
+
+        if dwell <= 0:
+            dwell = max(10, int(8 * 1000 * 2**self._spreading_factor / _bandwidth_hz(_bandwidth_code(self._bandwidth))))
+
+        with self._lock:
+            self._scan_channels = channels
+            self._scan_dwell = dwell
+            self._scan_index = 0
+            self._scan_locked = 0
+            self._scan_limit = int(self.time_on_air(_SX127x_MAX_PACKET_LENGTH)) + 1
+            self._scan_tune(channels[0])
+            self._scan_counters(channels[0])[_SCAN_DWELLS] += 1
+            self._scan_next = ticks_add(ticks_ms(), dwell)
+        self.wake()
+
+    # Back to receiving on the configured channel only
+    def stop_scan(self):
+        with self._lock:
+            if self._scan_channels != None:
+                self._scan_channels = None
+                self._scan_next = None
+                self._scan_tune(self._channel[0])
+                self._scan_current = None
+
+    def _scan_counters(self, channel):
+        if channel not in self._scan_stats:
+            self._scan_stats[channel] = [ 0 ] * _SCAN_SIZE
+        return self._scan_stats[channel]
+
+    # Retune the receiver (frequency only) without changing the configured channel
+    def _scan_tune(self, channel):
+        group = self._find_plan_group(channel, self._channel[1])
+        self._compile_plan_entry(self._plan_scratch, 0,
+                                 group[_GROUP_FREQ] + (channel - group[_GROUP_CHAN_LOW]) * group[_GROUP_STEP], -1)
+        receiving = not self._tx_active and self._cad_packet == None
+        if receiving:
+            self.set_standby_mode()
+        self._apply_plan_entry(self._plan_scratch, 0, False)
+        if receiving:
+            self.set_receive_mode()
+        self._scan_current = channel
+
+    # End of a dwell: stay while the modem is locked onto something (up to one
+    # maximum length packet), otherwise move to the next channel.
+    # Returns ms until the next dwell ends or -1 if not scanning.
+    def _service_scan(self):
+        if self._scan_next == None:
+            return -1
+
+        now = ticks_ms()
+        wait = ticks_diff(self._scan_next, now)
+        if wait > 0:
+            return wait
+
+        with self._lock:
+            if self._tx_active or self._cad_packet != None:
+                # Not receiving; look again after this transmission
+                pass
+
+            elif (self.read_register(_SX127x_REG_MODEM_STATUS) &
+                      (_SX127x_MODEM_SIGNAL_DETECTED | _SX127x_MODEM_SIGNAL_SYNCHRONIZED | _SX127x_MODEM_HEADER_VALID)) and \
+                     self._scan_locked < self._scan_limit:
+                if self._scan_locked == 0:
+                    self._scan_counters(self._scan_current)[_SCAN_DETECTIONS] += 1
+                self._scan_locked += self._scan_dwell
+
+            else:
+                self._scan_locked = 0
+                self._scan_index = (self._scan_index + 1) % len(self._scan_channels)
+                channel = self._scan_channels[self._scan_index]
+                if channel != self._scan_current:
+                    self._scan_tune(channel)
+                self._scan_counters(channel)[_SCAN_DWELLS] += 1
+
+            self._scan_next = ticks_add(now, self._scan_dwell)
+
+        return self._scan_dwell
+
+    # Per channel scanning receiver counters
+    def scan_stats(self):
+        stats = {}
+        for channel in self._scan_stats:
+            counters = self._scan_stats[channel]
+            stats[channel] = {
+                'dwells':     counters[_SCAN_DWELLS],
+                'detections': counters[_SCAN_DETECTIONS],
+                'packets':    counters[_SCAN_PACKETS],
+                'crc_errors': counters[_SCAN_CRC_ERRORS],
+                'rssi_avg':   counters[_SCAN_RSSI_TOTAL] / counters[_SCAN_RSSI_SAMPLES] if counters[_SCAN_RSSI_SAMPLES] else None,
+                'rssi_last':  counters[_SCAN_RSSI_LAST] if counters[_SCAN_RSSI_SAMPLES] else None,
+            }
+        return stats
+
+    # Per (direction, channel) listen before talk results
+    def cad_stats(self):
+        channels = {}
+        for key in self._cad_channels:
+            counts = self._cad_channels[key]
+            channels[key] = {
+                'cad':  counts[0],
+                'busy': counts[1],
+                'busy_ratio': counts[1] / counts[0] if counts[0] else 0,
+            }
+        return { 'channels': channels, 'forced': self._cad_forced }
 
     def close(self):
+        self.stop_service()
+
         # Disbable interrupts 
-        self.write_register(_SX127x_REG_IRQ_FLAGS_MASK, 0xFF)
+        self._set_register(_SX127x_REG_IRQ_FLAGS_MASK, 0xFF)
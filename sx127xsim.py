@@ -0,0 +1,525 @@
+#
+# Register-level SX127x model for running the driver on a host.
+#
+# SX127x_chip emulates the LoRa register file, FIFO and FIFO pointers, op-mode
+# transitions, IRQ flags (with IRQ_FLAGS_MASK and write-one-to-clear) and the
+# DIO0..DIO2 lines as selected by DIO_MAPPING_1.  Time is virtual: a
+# transmission completes (TX_DONE) only when advance() moves the clock past
+# its computed airtime.  Frames are received with inject(), or from another
+# chip joined with connect() when both are tuned alike.  Channel activity
+# detection, and MODEM_STATUS in receive, report activity while such a chip is
+# transmitting, or while 'activity' is set.
+#
+# Every SPI transaction (one chip-select cycle) is counted by starting
+# register and direction so tests can assert on bus traffic per operation.
+#
+# Two ways to use it:
+#
+#    SX127x_simulator(domain, chip=...)     SX127x_driver backend that talks to
+#                                           the chip directly.
+#
+#    install_machine(chip)                  Register a 'machine' module whose
+#    import loracom                         SPI and Pin are wired to the chip,
+#                                           so loracom.LoRaHandler runs as is.
+#
+import sys
+import _thread
+from sx127x import *
+
+
+_REG_COUNT                      = const(0x80)
+_REG_FIFO                       = const(0x00)
+_REG_OP_MODE                    = const(0x01)
+_REG_FREQ_MSB                   = const(0x06)
+_REG_FIFO_PTR                   = const(0x0D)
+_REG_TX_FIFO_BASE               = const(0x0E)
+_REG_RX_FIFO_BASE               = const(0x0F)
+_REG_RX_FIFO_CURRENT            = const(0x10)
+_REG_IRQ_FLAGS_MASK             = const(0x11)
+_REG_IRQ_FLAGS                  = const(0x12)
+_REG_RX_NUM_BYTES               = const(0x13)
+_REG_RX_PACKET_CNT_MSB          = const(0x16)
+_REG_RX_PACKET_CNT_LSB          = const(0x17)
+_REG_MODEM_STATUS               = const(0x18)
+_REG_PACKET_SNR                 = const(0x19)
+_REG_PACKET_RSSI                = const(0x1A)
+_REG_HOP_CHANNEL                = const(0x1C)
+_REG_MODEM_CONFIG_1             = const(0x1D)
+_REG_MODEM_CONFIG_2             = const(0x1E)
+_REG_PREAMBLE_MSB               = const(0x20)
+_REG_PREAMBLE_LSB               = const(0x21)
+_REG_PAYLOAD_LENGTH             = const(0x22)
+_REG_RX_FIFO_BYTE               = const(0x25)
+_REG_MODEM_CONFIG_3             = const(0x26)
+_REG_SYNC_WORD                  = const(0x39)
+_REG_DIO_MAPPING_1              = const(0x40)
+_REG_VERSION                    = const(0x42)
+
+_MODE_LONG_RANGE                = const(0x80)
+_MODE_MASK                      = const(0x07)
+_MODE_SLEEP                     = const(0x00)
+_MODE_STANDBY                   = const(0x01)
+_MODE_TX                        = const(0x03)
+_MODE_RX_CONTINUOUS             = const(0x05)
+_MODE_RX_SINGLE                 = const(0x06)
+_MODE_CAD                       = const(0x07)
+
+_IRQ_CAD_DETECTED               = const(0x01)
+_IRQ_FHSS_CHANGE_CHANNEL        = const(0x02)
+_IRQ_CAD_DONE                   = const(0x04)
+_IRQ_TX_DONE                    = const(0x08)
+_IRQ_VALID_HEADER               = const(0x10)
+_IRQ_PAYLOAD_CRC_ERROR          = const(0x20)
+_IRQ_RX_DONE                    = const(0x40)
+
+# Power-on values of the registers the model cares about (LoRa page)
+_RESET_VALUES = (
+    (0x01, 0x09), (0x06, 0x6C), (0x07, 0x80), (0x08, 0x00), (0x09, 0x4F),
+    (0x0A, 0x09), (0x0B, 0x2B), (0x0C, 0x20), (0x0E, 0x80), (0x0F, 0x00),
+    (0x18, 0x10), (0x1D, 0x72), (0x1E, 0x70), (0x1F, 0x64), (0x20, 0x00),
+    (0x21, 0x08), (0x22, 0x01), (0x23, 0xFF), (0x31, 0xC3), (0x33, 0x27),
+    (0x37, 0x0A), (0x39, 0x12), (0x42, 0x12),
+)
+
+# MODEM_CONFIG_1 bandwidth codes
+_BANDWIDTHS = (7.8e3, 10.4e3, 15.6e3, 20.8e3, 31.25e3, 41.7e3, 62.5e3, 125e3, 250e3, 500e3)
+
+# Which IRQ flag each DIO mapping selects, per DIO line (index is the 2-bit mapping value)
+_DIO_FLAGS = (
+    (0x40, 0x08, 0x04, 0x00),     # DIO0: RxDone, TxDone, CadDone
+    (0x80, 0x02, 0x01, 0x00),     # DIO1: RxTimeout, FhssChangeChannel, CadDetected
+    (0x02, 0x02, 0x02, 0x00),     # DIO2: FhssChangeChannel
+)
+
+class SX127x_chip():
+    def __init__(self, xtal=32e6):
+        self._xtal = xtal
+        self._lock = _thread.allocate_lock()
+        self._dio = [ None, None, None ]
+        self._peers = []
+        self._pending_dio = 0
+        self.now = 0.0
+        self.transmitted = []
+        self.missed = 0
+        self.activity = 0           # Set non-zero to make CAD see a foreign transmitter
+        self.reset_counts()
+        self.reset()
+
+    # Return device to power-on state (DIO callbacks and peers are kept)
+    def reset(self):
+        with self._lock:
+            self.registers = bytearray(_REG_COUNT)
+            for reg, value in _RESET_VALUES:
+                self.registers[reg] = value
+            self.fifo = bytearray(256)
+            self._tx_end = None
+            self._cad_end = None
+            self._selected = False
+
+    #
+    # Bus traffic accounting
+    #
+    def reset_counts(self):
+        self.counts = {}
+        self.total = 0
+
+    # Count of transactions, optionally only those starting at reg and/or in one direction ('r' or 'w')
+    def transactions(self, reg=None, direction=None):
+        total = 0
+        for key in self.counts:
+            if (reg == None or key[0] == reg) and (direction == None or key[1] == direction):
+                total += self.counts[key]
+        return total
+
+    def _count(self, reg, write):
+        key = (reg, 'w' if write else 'r')
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.total += 1
+
+    #
+    # SPI: one chip-select cycle is select(), clock() per byte, deselect()
+    #
+    def select(self):
+        self._selected = True
+        self._first = True
+
+    def clock(self, value):
+        with self._lock:
+            if self._first:
+                self._first = False
+                self._write = (value & 0x80) != 0
+                self._address = value & 0x7F
+                self._count(self._address, self._write)
+                return 0
+
+            reg = self._address
+            if reg != _REG_FIFO:
+                self._address = (self._address + 1) & 0x7F
+
+            if self._write:
+                self._write_register(reg, value)
+                return 0
+            else:
+                return self._read_register(reg)
+
+    def deselect(self):
+        self._selected = False
+        self._fire_dio()
+
+    # Whole transaction in one call (used by SX127x_simulator)
+    def transfer(self, address, data=None, buffer=None, length=0):
+        self.select()
+        self.clock(address)
+        if data != None:
+            for index in range(length):
+                self.clock(data[index])
+        else:
+            for index in range(length):
+                buffer[index] = self.clock(0)
+        self.deselect()
+
+    #
+    # Register file
+    #
+    def _read_register(self, reg):
+        if reg == _REG_MODEM_STATUS:
+            # Signal detected and synchronized while receiving a busy channel, else modem clear
+            receiving = self.mode() == _MODE_RX_CONTINUOUS or self.mode() == _MODE_RX_SINGLE
+            return 0x03 if receiving and self.busy() else 0x10
+
+        if reg == _REG_FIFO:
+            ptr = self.registers[_REG_FIFO_PTR]
+            self.registers[_REG_FIFO_PTR] = (ptr + 1) & 0xFF
+            return self.fifo[ptr]
+        return self.registers[reg]
+
+    def _write_register(self, reg, value):
+        if reg == _REG_FIFO:
+            ptr = self.registers[_REG_FIFO_PTR]
+            self.fifo[ptr] = value
+            self.registers[_REG_FIFO_PTR] = (ptr + 1) & 0xFF
+
+        elif reg == _REG_IRQ_FLAGS:
+            # Write one to clear
+            self.registers[reg] &= ~value & 0xFF
+
+        elif reg == _REG_OP_MODE:
+            self.registers[reg] = value
+            self._mode_changed(value)
+
+        elif reg == _REG_VERSION:
+            pass
+
+        else:
+            self.registers[reg] = value
+
+    def mode(self):
+        return self.registers[_REG_OP_MODE] & _MODE_MASK
+
+    def _mode_changed(self, value):
+        if value & _MODE_MASK == _MODE_TX and value & _MODE_LONG_RANGE:
+            self._tx_end = self.now + self.airtime(self.registers[_REG_PAYLOAD_LENGTH])
+            # Peers hear the packet on the tuning it starts with, whatever it hops to
+            self._tx_tuning = self.tuning()
+            self.registers[_REG_HOP_CHANNEL] &= ~0x3F
+        else:
+            # Leaving TX early aborts the transmission
+            self._tx_end = None
+
+        if value & _MODE_MASK == _MODE_CAD and value & _MODE_LONG_RANGE:
+            self._cad_end = self.now + self.cad_time()
+        else:
+            self._cad_end = None
+
+    # Carrier frequency in Hz
+    def frequency(self):
+        frf = (self.registers[_REG_FREQ_MSB] << 16) | (self.registers[_REG_FREQ_MSB + 1] << 8) | self.registers[_REG_FREQ_MSB + 2]
+        return frf * self._xtal / 2**19
+
+    # (frequency, bandwidth code, spreading factor, sync word) - what must match to hear each other
+    def tuning(self):
+        return (self.frequency(),
+                self.registers[_REG_MODEM_CONFIG_1] >> 4,
+                self.registers[_REG_MODEM_CONFIG_2] >> 4,
+                self.registers[_REG_SYNC_WORD])
+
+    # Seconds on air for a payload of length bytes using the current modem settings
+    def airtime(self, length):
+        config1 = self.registers[_REG_MODEM_CONFIG_1]
+        config2 = self.registers[_REG_MODEM_CONFIG_2]
+        return time_on_air(length, config2 >> 4,
+                           _BANDWIDTHS[min(config1 >> 4, len(_BANDWIDTHS) - 1)],
+                           ((config1 >> 1) & 0x07) + 4,
+                           (self.registers[_REG_PREAMBLE_MSB] << 8) | self.registers[_REG_PREAMBLE_LSB],
+                           (config1 & 0x01) != 0,
+                           (config2 & 0x04) != 0,
+                           (self.registers[_REG_MODEM_CONFIG_3] & 0x08) != 0) / 1000
+
+    # Seconds a channel activity detection takes (about two symbols)
+    def cad_time(self):
+        sf = self.registers[_REG_MODEM_CONFIG_2] >> 4
+        return 2 * 2**sf / _BANDWIDTHS[min(self.registers[_REG_MODEM_CONFIG_1] >> 4, len(_BANDWIDTHS) - 1)]
+
+    # True if CAD would see a preamble: set activity, or a connected chip transmitting on our tuning
+    def busy(self):
+        if self.activity:
+            return True
+        tuning = self.tuning()
+        for peer in self._peers:
+            if peer._tx_end != None and peer.tuning() == tuning:
+                return True
+        return False
+
+    #
+    # Interrupts
+    #
+    def attach(self, dio, callback):
+        self._dio[dio] = callback
+
+    def _set_irq(self, flags):
+        self.registers[_REG_IRQ_FLAGS] |= flags & ~self.registers[_REG_IRQ_FLAGS_MASK]
+
+    # Raise any DIO line whose mapped flag is set.  Called outside the register lock.
+    def _fire_dio(self):
+        if self._selected:
+            return
+        flags = self.registers[_REG_IRQ_FLAGS]
+        mapping = self.registers[_REG_DIO_MAPPING_1]
+        pending = self._pending_dio
+        self._pending_dio = 0
+        for dio in range(len(self._dio)):
+            if pending & (1 << dio) and self._dio[dio]:
+                if flags & _DIO_FLAGS[dio][(mapping >> (6 - 2 * dio)) & 0x03]:
+                    self._dio[dio](dio)
+
+    def _raise(self, flags):
+        before = self.registers[_REG_IRQ_FLAGS]
+        self._set_irq(flags)
+        if self.registers[_REG_IRQ_FLAGS] != before:
+            self._pending_dio = 0x07
+
+    #
+    # Simulated time and air
+    #
+    def connect(self, other):
+        if other not in self._peers:
+            self._peers.append(other)
+            other.connect(self)
+
+    # Move the virtual clock forward by seconds, completing any transmission or CAD that ends
+    def advance(self, seconds):
+        with self._lock:
+            self.now += seconds
+            if self._cad_end != None and self.now >= self._cad_end:
+                self._cad_end = None
+                self.registers[_REG_OP_MODE] = (self.registers[_REG_OP_MODE] & ~_MODE_MASK) | _MODE_STANDBY
+                self._raise(_IRQ_CAD_DONE | (_IRQ_CAD_DETECTED if self.busy() else 0))
+
+            frame = None
+            if self._tx_end != None and self.now >= self._tx_end:
+                self._tx_end = None
+                base = self.registers[_REG_TX_FIFO_BASE]
+                length = self.registers[_REG_PAYLOAD_LENGTH]
+                frame = bytes(self.fifo[(base + index) & 0xFF] for index in range(length))
+                self.transmitted.append(frame)
+                self.registers[_REG_OP_MODE] = (self.registers[_REG_OP_MODE] & ~_MODE_MASK) | _MODE_STANDBY
+                self._raise(_IRQ_TX_DONE)
+
+        self._fire_dio()
+
+        if frame != None:
+            for peer in self._peers:
+                if peer.tuning() == self._tx_tuning:
+                    peer.inject(frame)
+
+    # One FHSS hop period has gone by: count the hop and raise FhssChangeChannel
+    def hop(self):
+        with self._lock:
+            hop = self.registers[_REG_HOP_CHANNEL]
+            self.registers[_REG_HOP_CHANNEL] = (hop & ~0x3F) | ((hop + 1) & 0x3F)
+            self._raise(_IRQ_FHSS_CHANGE_CHANNEL)
+        self._fire_dio()
+
+    # Seconds until the transmission or CAD in progress completes (None if idle)
+    def pending(self):
+        end = self._tx_end if self._tx_end != None else self._cad_end
+        return None if end == None else max(end - self.now, 0)
+
+    # Advance to the end of the transmission or CAD in progress
+    def complete(self):
+        remaining = self.pending()
+        if remaining != None:
+            self.advance(remaining)
+
+    # Deliver a frame as if it had just been received.  Returns False if the
+    # chip was not in a receive mode (the frame is lost).
+    def inject(self, frame, rssi=-60, snr=8.0, crc_ok=True):
+        with self._lock:
+            mode = self.mode()
+            if mode != _MODE_RX_CONTINUOUS and mode != _MODE_RX_SINGLE:
+                self.missed += 1
+                return False
+
+            base = self.registers[_REG_RX_FIFO_BASE]
+            for index in range(len(frame)):
+                self.fifo[(base + index) & 0xFF] = frame[index]
+
+            self.registers[_REG_RX_FIFO_CURRENT] = base
+            self.registers[_REG_RX_NUM_BYTES] = len(frame)
+            self.registers[_REG_RX_FIFO_BYTE] = (base + len(frame)) & 0xFF
+            self.registers[_REG_PACKET_SNR] = int(snr * 4) & 0xFF
+            self.registers[_REG_PACKET_RSSI] = min(max(rssi + (157 if self.frequency() >= 868e6 else 164), 0), 255)
+
+            count = ((self.registers[_REG_RX_PACKET_CNT_MSB] << 8) | self.registers[_REG_RX_PACKET_CNT_LSB]) + 1
+            self.registers[_REG_RX_PACKET_CNT_MSB] = (count >> 8) & 0xFF
+            self.registers[_REG_RX_PACKET_CNT_LSB] = count & 0xFF
+
+            if mode == _MODE_RX_SINGLE:
+                self.registers[_REG_OP_MODE] = (self.registers[_REG_OP_MODE] & ~_MODE_MASK) | _MODE_STANDBY
+
+            self._raise(_IRQ_VALID_HEADER | _IRQ_RX_DONE | (0 if crc_ok else _IRQ_PAYLOAD_CRC_ERROR))
+
+        self._fire_dio()
+        return True
+
+
+# SX127x_driver backend talking straight to an SX127x_chip
+class SX127x_simulator(SX127x_driver):
+    def __init__(self, domain, chip=None, **kwargs):
+        self.chip = chip if chip != None else SX127x_chip()
+        self._one = bytearray(1)
+        self.received = []
+        self._transmit_queue = []
+        SX127x_driver.__init__(self, domain, **kwargs)
+
+    def reset(self):
+        self.chip.reset()
+
+    def read_register(self, reg):
+        self._one[0] = 0
+        self.chip.transfer(reg & 0x7F, buffer=self._one, length=1)
+        return self._one[0]
+
+    def write_register(self, reg, value):
+        self._one[0] = value
+        self.chip.transfer(reg | 0x80, data=self._one, length=1)
+
+    def read_registers(self, start, length, buffer=None):
+        return self.read_buffer(start, length, buffer)
+
+    def write_registers(self, start, data):
+        self.write_buffer(start, data, len(data))
+
+    def read_buffer(self, address, length, buffer=None):
+        if buffer == None:
+            buffer = bytearray(length)
+        self.chip.transfer(address & 0x7F, buffer=buffer, length=length)
+        return buffer
+
+    def write_buffer(self, address, buffer, size):
+        self.chip.transfer(address | 0x80, data=buffer, length=size)
+
+    def attach_interrupt(self, dio, callback):
+        self.chip.attach(dio, callback)
+
+    # Received packets are kept as (data, crc_ok, rssi, snr)
+    def onReceive(self, packet, crc_ok, rssi):
+        self.received.append((bytes(packet.data()), crc_ok, rssi, packet.snr))
+        packet.release()
+
+    def onTransmit(self):
+        self._transmit_queue.pop(0)
+        return self._transmit_queue[0] if len(self._transmit_queue) != 0 else None
+
+    def send_packet(self, packet):
+        with self._lock:
+            self._transmit_queue.append(packet)
+            if len(self._transmit_queue) == 1:
+                self.transmit_packet(packet)
+
+
+#
+# 'machine' stand-in for loracom.LoRaHandler
+#
+
+# Pin numbers as wired in loracom
+_PIN_SS    = const(18)
+_PIN_RESET = const(14)
+_PIN_DIO   = (26, 35, 34)
+
+_board = None
+
+class Pin():
+    IN = 1
+    OUT = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    def __init__(self, id, mode=-1, pull=-1):
+        self._id = id
+        self._value = 1
+        self._handler = None
+
+    def value(self, value=None):
+        if value == None:
+            return self._value
+
+        chip = _board
+        if chip != None:
+            if self._id == _PIN_SS:
+                if value == 0 and self._value != 0:
+                    chip.select()
+                elif value != 0 and self._value == 0:
+                    chip.deselect()
+            elif self._id == _PIN_RESET and value != 0 and self._value == 0:
+                chip.reset()
+        self._value = value
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def irq(self, handler=None, trigger=0):
+        self._handler = handler
+        if _board != None and self._id in _PIN_DIO:
+            dio = _PIN_DIO.index(self._id)
+            _board.attach(dio, (lambda d : handler(self)) if handler else None)
+
+class SPI():
+    MSB = 0
+    LSB = 1
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def write(self, buffer):
+        for value in buffer:
+            _board.clock(value)
+
+    def readinto(self, buffer, write=0):
+        for index in range(len(buffer)):
+            buffer[index] = _board.clock(write)
+
+    def write_readinto(self, out_buffer, in_buffer):
+        for index in range(len(out_buffer)):
+            in_buffer[index] = _board.clock(out_buffer[index])
+
+    def deinit(self):
+        pass
+
+# Make 'import machine' (and so loracom) use the simulated chip
+def install_machine(chip):
+    global _board
+    _board = chip
+
+    class machine():
+        pass
+
+    machine.SPI = SPI
+    machine.Pin = Pin
+    sys.modules['machine'] = machine
+    return machine
@@ -0,0 +1,66 @@
+#
+# Host tests: the modules live at the top of the tree, and the radio ones run
+# against the sx127xsim simulator in place of the MicroPython 'machine' module.
+#
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import time
+
+import pytest
+
+from loradomains import US902_928
+from sx127xsim import SX127x_chip, SX127x_simulator, install_machine
+
+
+# Wait up to timeout seconds for condition() to hold
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+# Let the transmissions in progress on chip finish, for up to timeout seconds
+# of real time while the service thread starts the next one.  peer (an
+# SX127x_simulator without a service thread) takes in what it hears.
+def drain(chip, peer=None, timeout=0.3):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if chip.pending() != None:
+            chip.complete()
+            if peer != None:
+                peer.service_interrupts()
+        time.sleep(0.005)
+
+
+# radio(**kwargs) builds a loracom.LoRaHandler on a simulated chip joined to a
+# second chip driven by an SX127x_simulator (without a service thread) as the
+# far end.  Returns (handler, chip, peer); handlers are closed afterwards.
+@pytest.fixture
+def radio():
+    handlers = []
+
+    def build(**kwargs):
+        chip, peer_chip = SX127x_chip(), SX127x_chip()
+        chip.connect(peer_chip)
+        install_machine(chip)
+        import loracom
+
+        kwargs.setdefault('channel', (64, 'up', 4))
+        handler = loracom.LoRaHandler(US902_928, **kwargs)
+        handler.init()
+        handlers.append(handler)
+
+        peer = SX127x_simulator(US902_928, chip=peer_chip, channel=kwargs['channel'], service_thread=False)
+        peer.init()
+        return handler, chip, peer
+
+    yield build
+
+    for handler in handlers:
+        handler.close()
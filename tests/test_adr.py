@@ -0,0 +1,36 @@
+from conftest import drain, wait_for
+
+
+def _frame(destination, source, text):
+    return bytearray((destination >> 8, destination & 0xFF, 5, source >> 8, source & 0xFF)) + text
+
+
+def test_strong_link_sent_faster_and_quieter(radio):
+    lora, chip, peer = radio(adr=True, adr_data_rate=True, aggregate_hold=-1, channel=(0, 'up', 0))
+    full_power = lora.get_tx_power()[0]
+
+    # Heard well from 0x0041
+    assert chip.inject(_frame(0x0042, 0x0041, b'hello'), rssi=-40, snr=10.0)
+    assert wait_for(lambda: 0x0041 in lora.link_stats())
+
+    # Sent at the fastest data rate the margin allows, with power to spare taken off
+    lora.send_packet(_frame(0x0041, 0x0042, b'reply'))
+    assert wait_for(lambda: chip.pending() != None)
+    assert lora.get_channel() == (0, 'up', 3)
+    assert lora.get_tx_power()[0] < full_power
+
+    # ... and back to listening at the configured rate afterwards
+    drain(chip)
+    assert wait_for(lambda: lora.get_channel() == (0, 'up', 0))
+    assert len(chip.transmitted) == 1
+
+
+def test_unknown_link_sent_as_configured(radio):
+    lora, chip, peer = radio(adr=True, adr_data_rate=True, aggregate_hold=-1, channel=(0, 'up', 0))
+
+    lora.send_packet(_frame(0x0041, 0x0042, b'hello'))
+    assert wait_for(lambda: chip.pending() != None)
+    assert lora.get_channel() == (0, 'up', 0)
+
+    drain(chip, peer)
+    assert len(peer.received) == 1
@@ -0,0 +1,113 @@
+from conftest import drain, wait_for
+
+
+def _frame(destination, text):
+    return bytearray((destination >> 8, destination & 0xFF, 5, 0, 1)) + text
+
+
+def test_credits_come_back_when_sent(radio):
+    returned = []
+    lora, chip, peer = radio(credits=3, aggregate_hold=-1, credit=returned.append)
+
+    sent = 0
+    while lora.take_credit():
+        lora.send_packet(_frame(0x0041, b'm%d' % sent), credit=True)
+        sent += 1
+    assert sent == 3 and lora.credits() == 0
+
+    drain(chip, peer)
+    assert wait_for(lambda: lora.credits() == 3)
+    assert len(peer.received) == 3
+    assert returned[-1] == 3
+
+
+def test_aggregate_holds_a_credit_per_message(radio):
+    lora, chip, peer = radio(credits=4, aggregate_hold=300, frame_types=True)
+
+    for index in range(3):
+        assert lora.take_credit()
+        lora.send_packet(_frame(0x0041, b'part %d' % index), credit=True)
+
+    # One frame on the way carrying all three credits
+    assert len(lora._transmit_queue) == 1
+    assert [ credits for frame, credits in lora._transmit_queue.items() ] == [ 3 ]
+    assert lora.credits() == 1
+
+    assert wait_for(lambda: chip.pending() != None)
+    drain(chip, peer)
+    assert wait_for(lambda: lora.credits() == 4)
+    assert len(peer.received) == 1
+
+
+def test_credit_returned_when_queue_is_full(radio):
+    lora, chip, peer = radio(credits=4, tx_queue=1, aggregate_hold=-1)
+
+    assert lora.take_credit()
+    lora.send_packet(_frame(0x0041, b'first'), credit=True)
+    assert lora.take_credit()
+    lora.send_packet(_frame(0x0041, b'dropped'), credit=True)
+
+    assert lora.transmit_stats()['queue']['dropped'] == 1
+    assert lora.credits() == 3
+
+
+def test_credit_returned_when_rejected(radio):
+    returned = []
+    logged = []
+    # Data rate 0 on a narrow-band channel: 400 ms dwell cannot carry 255 bytes
+    lora, chip, peer = radio(credits=2, aggregate_hold=-1, channel=(0, 'up', 0), credit=returned.append, log=logged.append)
+
+    assert lora.take_credit()
+    lora.send_packet(_frame(0x0041, b'x' * 250), credit=True)
+
+    assert wait_for(lambda: lora.credits() == 2)
+    assert lora.transmit_stats()['rejected'] == 1
+    assert returned == [ 2 ]
+    assert logged == [ "LoRaHandler: 255 byte packet exceeds channel dwell time; dropped" ]
+
+
+def test_reliable_cancelled_on_full_queue(radio):
+    reports = []
+    lora, chip, peer = radio(credits=4, tx_queue=1, address=0x0001, reliable=True, frame_types=True,
+                             delivery=lambda destination, sequence, delivered: reports.append(delivered))
+
+    assert lora.take_credit()
+    assert lora.send_packet(_frame(0x0041, b'first'), credit=True) != None
+    assert lora.take_credit()
+    assert lora.send_packet(_frame(0x0042, b'no room'), credit=True) == None
+
+    assert lora.credits() == 3
+    reliable = lora.transmit_stats()['reliable']
+    assert reliable['failed'] == 1 and reliable['in_flight'] == 1
+
+
+def test_same_frame_queued_twice_holds_two_credits(radio):
+    lora, chip, peer = radio(credits=4, aggregate_hold=-1)
+
+    frame = bytes(_frame(0x0041, b'again'))
+    for index in range(2):
+        assert lora.take_credit()
+        lora.send_packet(frame, credit=True)
+    assert lora.credits() == 2
+
+    # The first send gives back its own credit only
+    assert wait_for(lambda: chip.pending() != None)
+    chip.complete()
+    peer.service_interrupts()
+    assert wait_for(lambda: lora.credits() == 3)
+    assert len(lora._transmit_queue) <= 1
+
+    drain(chip, peer)
+    assert wait_for(lambda: lora.credits() == 4)
+    assert len(peer.received) == 2
+
+
+def test_mesh_short_frame_returns_credit(radio):
+    from loramesh import MeshRouter
+
+    lora, chip, peer = radio(credits=2, frame_types=True)
+    mesh = MeshRouter(lora, 0x0042)
+
+    assert lora.take_credit()
+    mesh.send_packet(b'\x00\x41', credit=True)
+    assert lora.credits() == 2
@@ -0,0 +1,52 @@
+from loradedup import DuplicateFilter
+from loraframe import FRAME_NONCE_MASK
+
+
+def _frame(nonce, text):
+    return bytearray((0x00, 0x42, nonce, 0x00, 0x41)) + text
+
+
+def test_repeat_is_dropped():
+    dedup = DuplicateFilter(size=16, lifetime=2000)
+
+    frame = _frame(7, b'hello')
+    assert not dedup.seen(frame, len(frame), now=0)
+    assert dedup.seen(frame, len(frame), now=100)
+    # ... until its lifetime is over
+    assert not dedup.seen(frame, len(frame), now=2200)
+
+
+def test_counted_nonces_never_collide():
+    dedup = DuplicateFilter(size=16, lifetime=2000)
+
+    # The same message sent again and again within the lifetime, with the nonce counting up
+    nonce = 30
+    for index in range(FRAME_NONCE_MASK + 1):
+        nonce = (nonce + 1) & FRAME_NONCE_MASK
+        frame = _frame(nonce, b'button')
+        assert not dedup.seen(frame, len(frame), now=index * 10)
+
+    assert dedup.stats()['hits'] == 0
+
+
+def test_destination_is_part_of_the_key():
+    dedup = DuplicateFilter(size=16, lifetime=2000)
+
+    # The same payload and nonce from the same source to two destinations
+    first = _frame(7, b'hello')
+    second = bytearray(first)
+    second[1] = 0x43
+    assert not dedup.seen(first, len(first), now=0)
+    assert not dedup.seen(second, len(second), now=10)
+    assert dedup.seen(second, len(second), now=20)
+
+
+def test_wide_tick_values():
+    dedup = DuplicateFilter(size=16, lifetime=2000)
+
+    # Host ticks are not limited to 32 bits
+    start = 1 << 40
+    frame = _frame(7, b'hello')
+    assert not dedup.seen(frame, len(frame), now=start)
+    assert dedup.seen(frame, len(frame), now=start + 100)
+    assert not dedup.seen(frame, len(frame), now=start + 2100)
@@ -0,0 +1,89 @@
+import os
+
+import loraserial
+from loraserial import SerialReader, ASCII_DELIMITER, BINARY_DELIMITER
+
+
+def _reader(size=64):
+    read, write = os.pipe()
+    stream = os.fdopen(read, 'rb', buffering=0)
+    return SerialReader(stream, size=size, chunk=size), write
+
+
+def test_find_byte():
+    data = bytearray(b'abc\ndef\n')
+    assert loraserial._find_byte(data, 0x0A, 0, len(data)) == 3
+    assert loraserial._find_byte(data, 0x0A, 4, len(data)) == 7
+    assert loraserial._find_byte(data, 0x0A, 4, 7) == -1
+    assert loraserial._find_byte(data, 0x00, 0, len(data)) == -1
+
+
+def test_frames_split_across_reads():
+    reader, write = _reader()
+    os.write(write, b'first\nsec')
+    reader.fill(100)
+    assert bytes(reader.frame(ASCII_DELIMITER)) == b'first'
+    assert reader.frame(ASCII_DELIMITER) is None
+
+    os.write(write, b'ond\n')
+    reader.fill(100)
+    assert bytes(reader.frame(ASCII_DELIMITER)) == b'second'
+    assert reader.frame(ASCII_DELIMITER) is None
+
+
+def test_frame_wrapping_the_ring():
+    reader, write = _reader(16)
+    os.write(write, b'0123456789\n')
+    reader.fill(100)
+    assert bytes(reader.frame(ASCII_DELIMITER)) == b'0123456789'
+
+    os.write(write, b'abcdefghij\x00')
+    reader.fill(100)
+    assert bytes(reader.frame(BINARY_DELIMITER)) == b'abcdefghij'
+
+
+def test_overrun_discards_to_next_delimiter():
+    reader, write = _reader(16)
+    os.write(write, b'x' * 16)
+    reader.fill(100)
+    assert reader.frame(ASCII_DELIMITER) is None
+
+    os.write(write, b'yy\nok\n')
+    reader.fill(100)
+    assert bytes(reader.frame(ASCII_DELIMITER)) == b'ok'
+    assert reader.stats()['overruns'] == 1
+
+
+def test_unescape():
+    # Escapes anywhere, in place or into another buffer
+    for line in (b'plain text', b'%24start', b'mid%3Adle', b'end%0a', b'%25%00%ff'):
+        expected = line.replace(b'%24', b'$').replace(b'%3A', b':').replace(b'%0a', b'\n') \
+                       .replace(b'%25', b'%').replace(b'%00', b'\x00').replace(b'%ff', b'\xff')
+        # The sum is of the escaped bytes less the hex digits of each escape
+        total = sum(line) - sum(line[index + 1] + line[index + 2] for index in range(len(line)) if line[index] == 0x25)
+
+        out = bytearray(len(line))
+        assert loraserial.unescape(line, len(line), out) == (len(expected), total)
+        assert bytes(out[0:len(expected)]) == expected
+
+        buffer = bytearray(line)
+        assert loraserial.unescape(buffer, len(buffer), buffer) == (len(expected), total)
+        assert bytes(buffer[0:len(expected)]) == expected
+
+    # Malformed escapes
+    assert loraserial.unescape(b'ab%4', 4, bytearray(4))[0] == -1
+    assert loraserial.unescape(b'ab%zz', 5, bytearray(5))[0] == -1
+
+
+def test_byte_at_a_time():
+    read, write = os.pipe()
+    reader = SerialReader(os.fdopen(read, 'rb', buffering=0), size=16)
+    os.write(write, b'abc\nde')
+    assert reader.fill(100) == 6
+    assert bytes(reader.frame(ASCII_DELIMITER)) == b'abc'
+
+    # ... including across the end of the ring
+    os.write(write, b'fghijklmn\n')
+    reader.fill(100)
+    assert bytes(reader.frame(ASCII_DELIMITER)) == b'defghijklmn'
+    assert reader.stats()['bytes'] == 16
@@ -0,0 +1,251 @@
+import pytest
+
+from conftest import drain, wait_for
+from loradomains import US902_928
+from loraframe import FRAME_ACK, FRAME_AGGREGATE, FRAME_FLAGS, FRAME_RELIABLE, aggregate
+from sx127x import hop_sequence
+from sx127xsim import SX127x_chip, SX127x_simulator, install_machine
+
+_FIFO                   = 0x00
+_OP_MODE                = 0x01
+_FREQ_MSB               = 0x06
+_FIFO_PTR               = 0x0D
+_RX_FIFO_CURRENT        = 0x10
+_IRQ_FLAGS              = 0x12
+_PACKET_SNR             = 0x19
+_MODEM_CONFIG_1         = 0x1D
+
+
+# A driver on its own chip, serviced by hand
+@pytest.fixture
+def radio_chip():
+    chip = SX127x_chip()
+    install_machine(chip)
+    driver = SX127x_simulator(US902_928, chip=chip, channel=(64, 'up', 4), service_thread=False)
+    driver.init()
+    driver.service_interrupts()
+    chip.reset_counts()
+    return driver, chip
+
+
+def _frame(destination, flags, source, text):
+    return bytearray((destination >> 8, destination & 0xFF, flags, source >> 8, source & 0xFF)) + text
+
+
+def test_update_register_uses_shadow(radio_chip):
+    driver, chip = radio_chip
+
+    # Read-modify-write of a shadowed register: one write, no read
+    driver.set_bandwidth(250e3)
+    driver.set_coding_rate(6)
+    assert chip.counts == { (_MODEM_CONFIG_1, 'w'): 2 }
+
+    # Once invalidated the first update reads the register again
+    chip.reset_counts()
+    driver.invalidate_registers()
+    driver.set_coding_rate(7)
+    driver.set_coding_rate(8)
+    assert chip.transactions(_MODEM_CONFIG_1, 'r') == 1
+    assert chip.transactions(_MODEM_CONFIG_1, 'w') == 2
+
+
+def test_sync_registers_is_one_transfer(radio_chip):
+    driver, chip = radio_chip
+
+    driver.sync_registers()
+    assert chip.counts == { (_OP_MODE, 'r'): 1 }
+
+    # ... after which updates need no reads
+    chip.reset_counts()
+    driver.set_coding_rate(5)
+    assert chip.transactions(direction='r') == 0
+
+
+def test_set_channel_is_one_burst(radio_chip):
+    driver, chip = radio_chip
+
+    # Frequency (and PA config) in one transfer, plus the modem settings that changed
+    driver.set_channel(10, 'up', 2)
+    assert chip.transactions(_FREQ_MSB, 'w') == 1
+    assert chip.transactions(direction='r') == 0
+    assert driver.get_channel() == (10, 'up', 2)
+
+    # Retuning to the same settings only rewrites the frequency
+    chip.reset_counts()
+    driver.set_channel(10, 'up', 2)
+    assert chip.counts == { (_FREQ_MSB, 'w'): 1 }
+
+
+def test_rejected_frame_reads_only_header(radio_chip):
+    driver, chip = radio_chip
+    driver.set_address_filter(network=1, units=(2,))
+
+    # To unit 3 of network 1: status, clear, FIFO pointer and header only
+    assert chip.inject(_frame(0x0043, 0, 0x0041, b'x' * 100))
+    driver.service_interrupts()
+    assert chip.total == 4
+    assert chip.counts == { (_RX_FIFO_CURRENT, 'r'): 1, (_IRQ_FLAGS, 'w'): 1,
+                            (_FIFO_PTR, 'w'): 1, (_FIFO, 'r'): 1 }
+    assert driver.received == []
+    assert driver.filter_stats()['unit_dropped'] == 1
+
+    # To unit 2: the payload and metadata are read too
+    chip.reset_counts()
+    assert chip.inject(_frame(0x0042, 0, 0x0041, b'hello'))
+    driver.service_interrupts()
+    assert chip.transactions(_FIFO, 'r') == 2
+    assert chip.transactions(_PACKET_SNR, 'r') == 1
+    assert len(driver.received) == 1
+    assert driver.filter_stats()['passed'] == 1
+
+
+def test_aggregate_split_on_receive(radio):
+    lora, chip, peer = radio(frame_types=True)
+
+    frame = _frame(0x0042, 0, 0x0041, b'one')
+    for text in (b'two', b'three'):
+        assert aggregate(frame, _frame(0x0042, 0, 0x0041, text), 255)
+    assert frame[FRAME_FLAGS] & FRAME_AGGREGATE
+
+    assert chip.inject(frame)
+    received = []
+    for index in range(3):
+        packet = lora.receive_packet(timeout=1000)
+        assert packet != None
+        received.append(bytes(packet.data()))
+        packet.release()
+
+    assert received == [ bytes(_frame(0x0042, 0, 0x0041, text)) for text in (b'one', b'two', b'three') ]
+    assert lora.receive_stats()['aggregates'] == 1
+
+
+def test_reliable_frame_is_acknowledged(radio):
+    lora, chip, peer = radio(address=0x0042, frame_types=True)
+
+    assert chip.inject(_frame(0x0042, FRAME_RELIABLE | 5, 0x0041, b'important'))
+    packet = lora.receive_packet(timeout=1000)
+    assert bytes(packet.data()) == bytes(_frame(0x0042, FRAME_RELIABLE | 5, 0x0041, b'important'))
+    packet.release()
+
+    # ACK back to the source: newest sequence 5, nothing older
+    assert wait_for(lambda: chip.pending() != None)
+    drain(chip, peer)
+    assert [ data for data, crc_ok, rssi, snr in peer.received ] == [ bytes((0x00, 0x41, FRAME_ACK | 5, 0x00, 0x42, 0)) ]
+
+    # A repeat is acknowledged again but not delivered twice
+    assert chip.inject(_frame(0x0042, FRAME_RELIABLE | 5, 0x0041, b'important'))
+    assert wait_for(lambda: chip.pending() != None)
+    drain(chip, peer)
+    assert len(peer.received) == 2
+    assert lora.receive_packet(timeout=100) == None
+
+
+def test_legacy_frames_without_frame_types(radio):
+    lora, chip, peer = radio(address=0x0042)
+
+    # Byte 2 is a random byte from units without frame types: every frame is delivered as is
+    frames = [ _frame(0x0042, flags, 0x0041, b'legacy %d' % flags) for flags in (0x85, 0x45, 0xC5) ]
+    for frame in frames:
+        assert chip.inject(frame)
+        packet = lora.receive_packet(timeout=1000)
+        assert bytes(packet.data()) == bytes(frame)
+        packet.release()
+
+    # Nothing acknowledged, and sends go out unchanged
+    lora.send_packet(_frame(0x0041, 0x12, 0x0042, b'first'), reliable=True)
+    lora.send_packet(_frame(0x0041, 0x13, 0x0042, b'second'))
+    assert wait_for(lambda: chip.pending() != None)
+    drain(chip, peer)
+    assert [ data for data, crc_ok, rssi, snr in peer.received ] == [ bytes(_frame(0x0041, 0x12, 0x0042, b'first')),
+                                                                      bytes(_frame(0x0041, 0x13, 0x0042, b'second')) ]
+
+
+_HOP_CHANNEL            = 0x1C
+
+
+# A hopping driver on its own chip, serviced by hand
+@pytest.fixture
+def hopping_chip():
+    chip = SX127x_chip()
+    install_machine(chip)
+    driver = SX127x_simulator(US902_928, chip=chip, channel=(64, 'up', 4), hop_period=8, service_thread=False)
+    driver.init()
+    driver.service_interrupts()
+    chip.reset_counts()
+    return driver, chip
+
+
+# Frequency of narrow-band uplink channel in Hz
+def _uplink(channel):
+    return 902300000 + channel * 200000
+
+
+def _tuned_to(chip, channel):
+    return abs(chip.frequency() - _uplink(channel)) < 100
+
+
+def test_hops_follow_sequence(hopping_chip):
+    driver, chip = hopping_chip
+    sequence = hop_sequence(64)
+
+    assert _tuned_to(chip, sequence[0])
+    for hop in range(1, 10):
+        chip.reset_counts()
+        chip.hop()
+        assert _tuned_to(chip, sequence[hop])
+        # Written from the interrupt: the frequency and the flag, no read back
+        assert chip.counts == { (_FREQ_MSB, 'w'): 1, (_IRQ_FLAGS, 'w'): 1 }
+
+    assert driver.interrupt_stats()['hops'] == 9
+    assert driver.interrupt_stats()['events'] == 0
+
+
+def test_hops_deferred_while_driver_busy(hopping_chip):
+    driver, chip = hopping_chip
+    sequence = hop_sequence(64)
+
+    with driver._lock:
+        chip.hop()
+        chip.hop()
+    assert _tuned_to(chip, sequence[0])
+
+    # The second hop raised no edge; the service thread catches up with the chip's count
+    chip.reset_counts()
+    driver.service_interrupts()
+    assert _tuned_to(chip, sequence[2])
+    assert chip.transactions(_HOP_CHANNEL, 'r') == 1
+    assert driver.interrupt_stats()['events'] == 1
+
+    # ... after which the interrupt handler carries on from there
+    chip.hop()
+    assert _tuned_to(chip, sequence[3])
+
+
+def test_hops_restart_with_each_packet(hopping_chip):
+    driver, chip = hopping_chip
+    sequence = hop_sequence(64)
+
+    for hop in range(3):
+        chip.hop()
+    assert _tuned_to(chip, sequence[3])
+
+    # A packet received: the chip starts counting from 0 again, and so do we
+    assert chip.inject(_frame(0x0042, 0, 0x0041, b'hello'))
+    driver.service_interrupts()
+    assert len(driver.received) == 1
+    assert _tuned_to(chip, sequence[0])
+
+    chip.hop()
+    assert _tuned_to(chip, sequence[1])
+
+
+def test_default_hop_channels(hopping_chip):
+    driver, chip = hopping_chip
+
+    # Configured on a wide-band channel, but hops over all 64 narrow-band uplinks
+    tuned = set()
+    for hop in range(64):
+        tuned.add(round((chip.frequency() - 902300000) / 200000))
+        chip.hop()
+
+    assert tuned == set(range(64))
@@ -0,0 +1,41 @@
+import threading
+import time
+
+from ulock import lock, ticks_us, ticks_diff
+
+
+# Microseconds from release() to a thread in a timed acquire() holding the lock
+def _wakeup_latency(event):
+    woken = []
+
+    def waiter():
+        if event.acquire(1, 1000):
+            woken.append(ticks_us())
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    time.sleep(0.02)
+    released = ticks_us()
+    event.release()
+    thread.join()
+    return ticks_diff(woken[0], released)
+
+
+def test_timed_acquire_wakes_at_release():
+    latencies = sorted(_wakeup_latency(lock(True)) for index in range(20))
+
+    # A polled wait would average half the poll interval; a native one is a thread switch
+    assert latencies[len(latencies) // 2] < 500
+
+
+def test_timed_acquire_times_out():
+    event = lock(True)
+    start = time.monotonic()
+    assert not event.acquire(1, 50)
+    assert 0.04 < time.monotonic() - start < 0.5
+
+
+def test_timed_acquire_of_free_lock():
+    event = lock()
+    assert event.acquire(1, 0)
+    assert not event.acquire(1, 0)
@@ -0,0 +1,32 @@
+import pytest
+
+from sx127x import SX127x_packet
+from upool import PoolException, pool
+
+
+def test_double_release_is_ignored():
+    buffers = pool(2, SX127x_packet)
+
+    first = buffers.get()
+    second = buffers.get()
+    assert buffers.get() == None
+
+    first.release()
+    first.release()
+    assert len(buffers) == 1
+    assert buffers.stats()['double_puts'] == 1
+
+    # The free list holds first once and second is still out
+    assert buffers.get() is first
+    assert buffers.get() == None
+    second.release()
+    assert buffers.get() is second
+
+
+def test_put_of_foreign_item_overflows():
+    buffers = pool(1, SX127x_packet)
+    stranger = SX127x_packet()
+    stranger.in_use = True
+
+    with pytest.raises(PoolException):
+        buffers.put(stranger)
@@ -0,0 +1,61 @@
+import threading
+import time
+
+import pytest
+
+from usemaphore import semaphore, SemaphoreException
+
+
+def test_acquire_and_test():
+    s = semaphore(2)
+    assert s.acquire()
+    assert s.acquire()
+    assert not s.acquire(wait=0)
+    assert s.available() == 0
+
+
+def test_acquire_times_out():
+    s = semaphore(1, available=0)
+    start = time.monotonic()
+    assert not s.acquire(1, 1, 50)
+    assert 0.04 <= time.monotonic() - start < 0.5
+    assert s.available() == 0
+
+
+def test_acquire_count_waits_for_enough():
+    s = semaphore(3, available=1)
+    timer = threading.Timer(0.05, s.release, (2,))
+    timer.start()
+    assert s.acquire(3, 1, 1000)
+    assert s.available() == 0
+
+
+def test_wakeup_passed_to_second_waiter():
+    s = semaphore(2, available=0)
+    got = []
+
+    def waiter(name):
+        if s.acquire(1, 1, 1000):
+            got.append(name)
+
+    threads = [ threading.Thread(target=waiter, args=(name,)) for name in ('a', 'b') ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+
+    # One release of two counts must wake both waiters
+    s.release(2)
+    for thread in threads:
+        thread.join(2)
+    assert sorted(got) == [ 'a', 'b' ]
+
+
+def test_release_past_maxcount():
+    s = semaphore(2)
+    with pytest.raises(SemaphoreException):
+        s.release()
+    s.acquire(2)
+    with pytest.raises(SemaphoreException):
+        s.release(3)
+    s.release(2)
+    assert s.available() == 2
@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from uthread import executor, ExecutorException
+
+
+@pytest.fixture
+def pool():
+    jobs = executor(workers=2, jobs=4)
+    jobs.start()
+    yield jobs
+    jobs.shutdown()
+
+
+def test_submit_returns_result(pool):
+    assert pool.submit(lambda a, b: a + b, 2, 3).result(1000) == 5
+
+
+def test_submit_raises_job_exception(pool):
+    with pytest.raises(ZeroDivisionError):
+        pool.submit(lambda: 1 // 0).result(1000)
+
+
+def test_job_exception_goes_to_log(capsys):
+    logged = []
+    jobs = executor(workers=1, log=logged.append)
+    jobs.start()
+    try:
+        with pytest.raises(ZeroDivisionError):
+            jobs.submit(lambda: 1 // 0).result(1000)
+    finally:
+        jobs.shutdown()
+
+    assert len(logged) == 1 and 'raised' in logged[0]
+    assert capsys.readouterr().out == ''
+
+
+def test_result_timeout(pool):
+    slow = pool.submit(time.sleep, 0.2)
+    with pytest.raises(ExecutorException):
+        slow.result(20)
+    assert slow.result(1000) is None
+
+
+def test_schedule_runs_after_delay(pool):
+    start = time.monotonic()
+    assert pool.schedule(100, lambda: 'later').result(1000) == 'later'
+    assert time.monotonic() - start >= 0.09
+
+
+def test_timer_fires_while_job_queue_is_busy(pool):
+    # Holding the queue lock used to swallow the worker's wakeup
+    with pool._jobs._lock:
+        timer = pool.schedule(50, lambda: 'fired')
+    assert timer.result(1000) == 'fired'
+
+
+def test_timer_fires_while_job_queue_is_full():
+    jobs = executor(workers=1, jobs=1)
+    jobs.start()
+    release = threading.Event()
+    jobs.submit(release.wait)
+    time.sleep(0.05)
+    jobs.submit(lambda: None)
+    timer = jobs.schedule(20, lambda: 'fired')
+    release.set()
+    assert timer.result(1000) == 'fired'
+    jobs.shutdown()
+
+
+def test_periodic_until_cancelled(pool):
+    count = [0]
+    job = pool.periodic(20, lambda: count.__setitem__(0, count[0] + 1))
+    time.sleep(0.15)
+    assert job.cancel()
+    runs = count[0]
+    time.sleep(0.1)
+    assert runs >= 3 and count[0] <= runs + 1
+    assert job.cancelled()
+
+
+def test_submit_isr_runs_preallocated_job(pool):
+    done = threading.Event()
+    job = pool.job(done.set)
+    assert pool.submit_isr(job)
+    assert done.wait(1)
+
+
+def test_submit_isr_never_waits_on_busy_queue(pool):
+    job = pool.job(lambda: None)
+    with pool._jobs._lock:
+        assert not pool.submit_isr(job)
+
+
+def test_shutdown_runs_waiting_jobs():
+    jobs = executor(workers=1, jobs=4)
+    results = []
+    for index in range(3):
+        jobs.submit(results.append, index)
+    jobs.start()
+    jobs.shutdown()
+    assert results == [0, 1, 2]
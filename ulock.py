@@ -1,15 +1,60 @@
 import _thread
 
+try:
+    from time import ticks_us, ticks_ms, ticks_add, ticks_diff, sleep_ms
+except ImportError:
+    # Host (CPython) fallback
+    from time import monotonic, sleep
+    ticks_us = lambda : int(monotonic() * 1000000)
+    ticks_ms = lambda : int(monotonic() * 1000)
+    ticks_add = lambda ticks, delta : ticks + delta
+    ticks_diff = lambda new, old : new - old
+    sleep_ms = lambda ms : sleep(ms / 1000)
+
+try:
+    _UNUSED_=const(1)
+except:
+    const = lambda x: x
+
+_POLL_MS = const(1)
+
+# Whether the port's _thread lock honours a timeout (in seconds, as CPython's does).
+# MicroPython's ignores it, so there a timed acquire has to poll.
+try:
+    from sys import implementation
+    _NATIVE_TIMEOUT = implementation.name != 'micropython'
+except ImportError:
+    _NATIVE_TIMEOUT = False
+
+# Acquire a _thread lock within timeout milliseconds; False if it could not be had.
+# A native timed acquire wakes as soon as the lock is released; the polling one
+# up to _POLL_MS later.
+def _acquire_timeout(lock, timeout):
+    if _NATIVE_TIMEOUT:
+        return lock.acquire(1, timeout / 1000)
+
+    if lock.acquire(0):
+        return True
+
+    deadline = ticks_add(ticks_ms(), timeout)
+    while ticks_diff(deadline, ticks_ms()) > 0:
+        sleep_ms(min(_POLL_MS, max(ticks_diff(deadline, ticks_ms()), 1)))
+        if lock.acquire(0):
+            return True
+    return False
+
 # Non-recursive lock
 
 # Stub for class of lock().  Change semantics to allow a creation of locked item.
+# acquire(1, timeout) gives up after timeout ms (-1 waits forever) and returns False.
 class lock():
     def __init__(self, locked=False):
         self._lock = _thread.allocate_lock()
         if locked:
             self._lock.acquire()
 
-        self.acquire = lambda waitflag=1, timeout=-1 : self._lock.acquire(waitflag, timeout)
+        self.acquire = lambda waitflag=1, timeout=-1 : self._lock.acquire(waitflag) if timeout < 0 or not waitflag \
+                                                           else _acquire_timeout(self._lock, timeout)
         self.release = lambda : self._lock.release()
         self.locked  = lambda : self._lock.locked()
 
@@ -24,58 +69,99 @@ class RLockException(Exception):
     pass
 
 # Recursive lock - allow recursive locking within same thread.
+#
+# The owner is whoever holds the underlying _thread lock, so taking a free lock
+# or taking it again in the owning thread is a single test, and a waiting thread
+# blocks on the lock itself and is woken only by the final release.
+#
+# acquire(test) with test set returns False rather than wait if another thread
+# holds the lock; with timeout (ms) it waits that long at most.  A lock created
+# locked is owned by the creating thread.
+#
+# stats() counts acquisitions (outermost only), those that had to wait, waits
+# that timed out and the longest wait and hold in microseconds.
 class rlock():
     def __init__(self, locked=False):
         self._lock = _thread.allocate_lock()
-        if locked:
-            self._lock.acquire()
-        self._release = _thread.allocate_lock()
-        self._release.acquire()
         self._ident = None
         self._count = 0
+        self._held = 0
 
-    def acquire(self, test=0):
-        locked = True # Assume success
-        with self._lock:
-
-            if self._ident == _thread.get_ident():
-                # We are the owner, so increase the count
-                self._count += 1
-
-            elif test:
-                # Failed lock test
-                locked = False
+        self._acquisitions = 0
+        self._contended = 0
+        self._timeouts = 0
+        self._max_wait = 0
+        self._max_hold = 0
 
-            else:
-                # Wait for it to be released
-                while self._ident != None:
-                    # Unlock the access
-                    self._lock.release()
-                    # Wait for a release
-                    self._release.acquire()
-                    # Relock and try test again
-                    self._lock.acquire()
+        if locked:
+            self.acquire()
 
-                # Claim it as ours
-                self._ident = _thread.get_ident()
-                self._count = 1
+    def acquire(self, test=0, timeout=-1):
+        ident = _thread.get_ident()
+        if self._ident == ident:
+            # We are the owner, so increase the count
+            self._count += 1
+            return True
 
-        return locked
+        if not self._lock.acquire(0):
+            if test:
+                # Failed lock test
+                return False
+
+            # Wait for the final release
+            self._contended += 1
+            start = ticks_us()
+            if timeout < 0:
+                self._lock.acquire()
+            elif not _acquire_timeout(self._lock, timeout):
+                self._timeouts += 1
+                return False
+            wait = ticks_diff(ticks_us(), start)
+            if wait > self._max_wait:
+                self._max_wait = wait
+
+        # Claim it as ours
+        self._ident = ident
+        self._count = 1
+        self._acquisitions += 1
+        self._held = ticks_us()
+        return True
+
+    # Take the lock only if no thread holds it, not even the caller's.  For interrupt
+    # handlers, which may run on the owner's thread part way through its work.
+    def acquire_free(self):
+        if not self._lock.acquire(0):
+            return False
+
+        self._ident = _thread.get_ident()
+        self._count = 1
+        self._acquisitions += 1
+        self._held = ticks_us()
+        return True
 
     def release(self):
-        with self._lock:
-            if self._ident == _thread.get_ident():
-                self._count -= 1
-                if self._release.locked():
-                    self._release.release()
-                if self._count == 0:
-                    self._ident = None
-            else:
-                raise RLockException("Not held by caller")
+        if self._ident != _thread.get_ident():
+            raise RLockException("Not held by caller")
+
+        self._count -= 1
+        if self._count == 0:
+            hold = ticks_diff(ticks_us(), self._held)
+            if hold > self._max_hold:
+                self._max_hold = hold
+            self._ident = None
+            self._lock.release()
 
     def locked(self):
-        with self._lock:
-            return self._ident == _thread.get_ident()
+        return self._ident == _thread.get_ident()
+
+    def stats(self):
+        return {
+            'acquisitions': self._acquisitions,
+            'contended':    self._contended,
+            'timeouts':     self._timeouts,
+            'max_wait_us':  self._max_wait,
+            'max_hold_us':  self._max_hold,
+        }
 
     def __enter__(self):
         self.acquire()
@@ -83,4 +169,3 @@ class rlock():
 
     def __exit__(self, type, value, traceback):
         self.release()
-
@@ -0,0 +1,66 @@
+from ulock import *
+
+class PoolException(Exception):
+    pass
+
+# Fixed pool of preallocated items.  get() and put() never allocate.
+#
+# factory is called with the pool as its argument to build each item, so an
+# item can hand itself back to its pool.  Items have an in_use attribute, which
+# the pool keeps set while the item is out; putting back an item that is not
+# out is counted and ignored, so a double release cannot put it on the free
+# list twice.
+class pool():
+    def __init__(self, size, factory):
+        self._lock = lock()
+        self._items = [ factory(self) for i in range(size) ]
+        self._free = list(self._items)
+        self._available = size
+        self._min_available = size
+        self._exhausted = 0
+        self._double_puts = 0
+
+    # Number of free items
+    def __len__(self):
+        with self._lock:
+            return self._available
+
+    # Return a free item or None if the pool is exhausted
+    def get(self):
+        with self._lock:
+            if self._available == 0:
+                self._exhausted += 1
+                return None
+
+            self._available -= 1
+            if self._available < self._min_available:
+                self._min_available = self._available
+
+            item = self._free[self._available]
+            item.in_use = True
+            return item
+
+    # Return item to the pool.  Returns False if it was not out (already put back).
+    def put(self, item):
+        with self._lock:
+            if not item.in_use:
+                self._double_puts += 1
+                return False
+
+            if self._available >= len(self._free):
+                raise PoolException("overflow")
+
+            item.in_use = False
+            self._free[self._available] = item
+            self._available += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size':          len(self._items),
+                'available':     self._available,
+                'min_available': self._min_available,
+                'exhausted':     self._exhausted,
+                'double_puts':   self._double_puts,
+            }
@@ -1,51 +1,164 @@
 from ulock import *
+from _thread import get_ident
+
+try:
+    _UNUSED_=const(1)
+except:
+    const = lambda x: x
 
 class QueueException(Exception):
     pass
 
+# What put() does when the queue is full
+OVERFLOW_BLOCK          = const(0)  # Wait for get() to make room
+OVERFLOW_DROP_OLDEST    = const(1)  # Discard the head to make room
+OVERFLOW_DROP_NEWEST    = const(2)  # Discard the item being put
+OVERFLOW_RAISE          = const(3)  # Raise QueueException("full")
+
+_DEFAULT_SIZE           = const(16)
+
+# Fixed-capacity FIFO in a preallocated ring: put() and get() are O(1) and
+# never allocate.
+#
+# Parameters
+#     maxlen         - capacity (0 takes the default of 16; the queue never grows)
+#     overflow       - OVERFLOW_* policy when full
+#     dropped        - called with each item discarded by a DROP policy (outside the lock),
+#                      e.g. to return a buffer to its pool
+#
 class queue():
-    def __init__(self, maxlen=0):
-        self._maxlen = maxlen
+    def __init__(self, maxlen=0, overflow=OVERFLOW_RAISE, dropped=None):
+        self._size = maxlen if maxlen > 0 else _DEFAULT_SIZE
+        self._overflow = overflow
+        self._dropped = dropped
         self._lock = lock()
         self._fill = lock(True)
-        self._queue = []
+        self._space = lock(True)
+        self._items = [ None ] * self._size
+        self._head = 0
+        self._count = 0
+        self._watchers = []         # Wakeup locks of threads in select()
+
+        self._high_water = 0
+        self._drops = 0
+        self._isr_drops = 0
 
     def __len__(self):
         with self._lock:
-            return len(self._queue)
+            return self._count
+
+    # Append item; caller holds _lock and there is room
+    def _append(self, item):
+        self._items[(self._head + self._count) % self._size] = item
+        self._count += 1
+        if self._count > self._high_water:
+            self._high_water = self._count
+        if self._fill.locked():
+            self._fill.release()
+        for wakeup in self._watchers:
+            _wake(wakeup)
 
+    # Remove and return the head; caller holds _lock and the queue is not empty
+    def _remove(self):
+        item = self._items[self._head]
+        self._items[self._head] = None
+        self._head = (self._head + 1) % self._size
+        self._count -= 1
+        if self._space.locked():
+            self._space.release()
+        return item
+
+    # Add item at the tail.  Returns False if the queue was full and item was dropped.
     def put(self, item):
-        with self._lock:
-            if self._maxlen != 0 and len(self._queue) >= self._maxlen:
+        discard = None
+        added = True
+        self._lock.acquire()
+
+        if self._count >= self._size:
+            if self._overflow == OVERFLOW_BLOCK:
+                while self._count >= self._size:
+                    # Wait for room
+                    self._lock.release()
+                    self._space.acquire()
+                    self._lock.acquire()
+
+            elif self._overflow == OVERFLOW_DROP_OLDEST:
+                discard = self._remove()
+                self._drops += 1
+
+            elif self._overflow == OVERFLOW_DROP_NEWEST:
+                discard = item
+                added = False
+                self._drops += 1
+
+            else:
+                self._lock.release()
                 raise QueueException("full")
 
-            self._queue.append(item)
-            if self._fill.locked():
-                self._fill.release()
+        if added:
+            self._append(item)
+
+        self._lock.release()
+
+        if discard != None and self._dropped != None:
+            self._dropped(discard)
+
+        return added
+
+    # put() for interrupt handlers: never waits, never allocates and never raises.
+    # If the queue is full or busy the item is dropped (and not passed to 'dropped').
+    # Returns False if dropped.
+    def put_isr(self, item):
+        if not self._lock.acquire(0):
+            self._isr_drops += 1
+            return False
+
+        added = self._count < self._size
+        if added:
+            self._append(item)
+        else:
+            self._isr_drops += 1
+
+        self._lock.release()
+        return added
 
     # Return head of queue or None if empty
     def head(self):
         with self._lock:
-            return self._queue[0] if len(self._queue) != 0 else None
+            return self._items[self._head] if self._count != 0 else None
 
     # Return tail of queue or None if empty
     def tail(self):
         with self._lock:
-            return self._queue[-1] if len(self._queue) != 0 else None
+            return self._items[(self._head + self._count - 1) % self._size] if self._count != 0 else None
 
-    def get(self, wait=1):
+    # Snapshot of the queued items, head first
+    def items(self):
+        with self._lock:
+            return [ self._items[(self._head + index) % self._size] for index in range(self._count) ]
+
+    # Remove and return the head.  With wait, waits for an item: forever, or for
+    # up to timeout ms after which None is returned.  Without, returns None if empty.
+    def get(self, wait=1, timeout=-1):
         self._lock.acquire()
 
         if wait:
-            while len(self._queue) == 0:
+            deadline = ticks_add(ticks_ms(), timeout) if timeout >= 0 else None
+            while self._count == 0:
                 # Wait for something
                 self._lock.release()
-                self._fill.acquire()
+                if deadline == None:
+                    self._fill.acquire()
+                elif not self._fill.acquire(1, max(ticks_diff(deadline, ticks_ms()), 0)):
+                    return None
                 self._lock.acquire()
 
-        if len(self._queue) != 0:
-            item = self._queue.pop(0)
+        if self._count != 0:
+            item = self._remove()
             found = True
+            # Pass the wakeup on to another waiting getter while items remain
+            if self._count != 0 and self._fill.locked():
+                self._fill.release()
         else:
             item = None
             found = False
@@ -57,4 +170,60 @@ class queue():
 
         return item
 
+    # Have wakeup released whenever an item is added
+    def _watch(self, wakeup):
+        with self._lock:
+            self._watchers.append(wakeup)
+
+    def _unwatch(self, wakeup):
+        with self._lock:
+            self._watchers.remove(wakeup)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size':       self._size,
+                'queued':     self._count,
+                'high_water': self._high_water,
+                'dropped':    self._drops + self._isr_drops,
+            }
+
+# Release a wakeup lock if it is held; a second release racing the first is harmless
+def _wake(wakeup):
+    if wakeup.locked():
+        try:
+            wakeup.release()
+        except:
+            pass
+
+# One wakeup lock per thread that calls select(), made on its first call
+_wakeups = {}
+
+# Wait until at least one of queues has an item, for up to timeout ms (-1 waits
+# forever).  Returns the queues holding items, in the order given; empty on timeout.
+# The items are not removed: get(wait=0) each ready queue.
+def select(queues, timeout=-1):
+    ident = get_ident()
+    if ident not in _wakeups:
+        _wakeups[ident] = lock(True)
+    wakeup = _wakeups[ident]
+
+    # Clear a wakeup left over from last time before watching, so none is missed
+    wakeup.acquire(0)
+    for q in queues:
+        q._watch(wakeup)
+
+    try:
+        deadline = ticks_add(ticks_ms(), timeout) if timeout >= 0 else None
+        while True:
+            ready = [ q for q in queues if len(q) != 0 ]
+            if len(ready) != 0:
+                return ready
 
+            if deadline == None:
+                wakeup.acquire()
+            elif not wakeup.acquire(1, max(ticks_diff(deadline, ticks_ms()), 0)):
+                return []
+    finally:
+        for q in queues:
+            q._unwatch(wakeup)
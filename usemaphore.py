@@ -1,30 +1,41 @@
-include _thread
+from ulock import *
 
 class SemaphoreException(Exception):
     pass
 
+# Counting semaphore of up to maxcount counts, 'available' of them free at the start.
 class semaphore():
     def __init__(self, maxcount=1, available=None):
-        self._lock = _thread.allocate_lock()
-        self._changed = _thread.allocate_lock()
-        self._changed.acquire()
+        self._lock = lock()
+        self._changed = lock(True)
         self._maxcount = maxcount
         self._available = maxcount if available == None else available
 
-    # Acquire N counts. if wait, then wait for available items;if false,just test
-    def acquire(self,  count=1, wait=1):
+    # Acquire N counts. if wait, then wait for available items;if false,just test.
+    # With a timeout (ms) wait no longer than that.  Returns True if acquired.
+    def acquire(self, count=1, wait=1, timeout=-1):
         ok = False
-        with self._lock:
-            if wait:
-                while self._available < count:
-                    self._lock.release()
+        self._lock.acquire()
+
+        if wait:
+            deadline = ticks_add(ticks_ms(), timeout) if timeout >= 0 else None
+            while self._available < count:
+                self._lock.release()
+                if deadline == None:
                     self._changed.acquire()
-                    self._lock.acquire()
+                elif not self._changed.acquire(1, max(ticks_diff(deadline, ticks_ms()), 0)):
+                    return False
+                self._lock.acquire()
+
+        if self._available >= count:
+            self._available = self._available - count
+            ok = True
 
-            if self._available >= count:
-                self._available = self._available - count
-                ok = True
+        # Pass the wakeup on to another waiter while counts remain
+        if self._available > 0 and self._changed.locked():
+            self._changed.release()
 
+        self._lock.release()
         return ok
 
     def release(self, count=1):
@@ -37,4 +48,8 @@ class semaphore():
 
             if self._changed.locked():
                 self._changed.release()
-            
+
+    # Counts free now
+    def available(self):
+        with self._lock:
+            return self._available
@@ -1,6 +1,12 @@
 # Simple thread class
 import _thread
-from ulock import lock
+from ulock import *
+from uqueue import queue, QueueException, OVERFLOW_RAISE
+
+try:
+    _UNUSED_=const(1)
+except:
+    const = lambda x: x
 
 class thread():
     def __init__(self, name="sx127x", stack=None, run=None):
@@ -27,7 +33,11 @@ class thread():
         if self._runninglock.acquire(0):
             self.running = True
             if self._stack != None:
-                _thread.stack_size(self._stack)
+                try:
+                    _thread.stack_size(self._stack)
+                except ValueError:
+                    # Host Python enforces a larger minimum stack
+                    pass
             _thread.start_new_thread(self._run, ())
 
     # Calls user 'run' method and saves return code
@@ -53,3 +63,260 @@ class thread():
     def wait(self, wait=1):
         return self._rc if self._runninglock.acquire(wait) else None
 
+
+
+class ExecutorException(Exception):
+    pass
+
+# Result of a job given to an executor
+class future():
+    def __init__(self):
+        self._done = lock(True)
+        self._finished = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._finished
+
+    def cancelled(self):
+        return self._cancelled
+
+    # Stop the job if it has not started (or a periodic one from running again).
+    # Returns True if it will not run (again).
+    def cancel(self):
+        if self._finished:
+            return False
+        self._cancelled = True
+        self._finish(None, None)
+        return True
+
+    def _finish(self, result, exception):
+        if not self._finished:
+            self._result = result
+            self._exception = exception
+            self._finished = True
+            self._done.release()
+
+    # Wait for the job (forever, or up to timeout ms) and return what it returned,
+    # raising what it raised.  ExecutorException("timeout") if it is not done in time.
+    def result(self, timeout=-1):
+        if not self._finished:
+            if not self._done.acquire(1, timeout):
+                raise ExecutorException("timeout")
+            # Let any other waiter through
+            self._done.release()
+
+        if self._cancelled:
+            raise ExecutorException("cancelled")
+        if self._exception != None:
+            raise self._exception
+        return self._result
+
+# Release a wakeup lock if it is held; a second release racing the first is harmless
+def _wake(wakeup):
+    if wakeup.locked():
+        try:
+            wakeup.release()
+        except:
+            pass
+
+# Job entry
+_JOB_FUNCTION   = const(0)
+_JOB_ARGS       = const(1)
+_JOB_FUTURE     = const(2)      # None for jobs from job()
+_JOB_SUBMITTED  = const(3)      # ticks_ms() when submitted; None for jobs from job()
+
+# Timer entry
+_TIMER_DEADLINE = const(0)
+_TIMER_PERIOD   = const(1)
+_TIMER_JOB      = const(2)
+
+# A few pooled threads running short jobs and timers, so each job does not cost a
+# native thread and its stack.
+#
+# Parameters
+#     workers        - threads in the pool
+#     jobs           - jobs waiting before submit() raises ExecutorException("full")
+#     stack          - stack bytes per thread
+#     log            - called with the text of diagnostics (a job that raised)
+#
+# Jobs run in the order submitted on whichever worker is free.  Timers are kept in
+# deadline order and run by a worker when due; a periodic timer is due again
+# 'period' ms after it was last due.  A job must not wait for another job's result
+# unless there are workers to spare.
+#
+# Idle workers wait on one wakeup lock, released by every submit and by a timer
+# that becomes the soonest, so a wakeup is never lost to a busy or full queue.
+#
+# Interrupt handlers use submit_isr() with a job made beforehand by job(): it
+# neither allocates nor waits.
+class executor():
+    def __init__(self, workers=2, jobs=16, stack=4096, name="executor", log=print):
+        self._name = name
+        self._log = log
+        self._stack = stack
+        self._workers = [ thread(name="%s_%d" % (name, index), stack=stack, run=self._run) for index in range(workers) ]
+        self._jobs = queue(jobs, OVERFLOW_RAISE)
+        self._timers = []           # [ <deadline>, <period>, <job> ] soonest first
+        self._lock = lock()
+        self._wakeup = lock(True)
+
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._timers_run = 0
+        self._started = 0
+        self._total_latency = 0
+        self._max_latency = 0
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+
+    # Stop the workers once the jobs already waiting are done; with wait, wait for them
+    def shutdown(self, wait=True):
+        for worker in self._workers:
+            worker.stop()
+        # Wake an idle worker; each passes it on as it stops
+        _wake(self._wakeup)
+        if wait:
+            for worker in self._workers:
+                worker.wait()
+
+    # Run function(*args) on a worker.  Returns its future.
+    def submit(self, function, *args):
+        job = (function, args, future(), ticks_ms())
+        try:
+            self._jobs.put(job)
+        except QueueException:
+            raise ExecutorException("full")
+        self._submitted += 1
+        _wake(self._wakeup)
+        return job[_JOB_FUTURE]
+
+    # A job for submit_isr(): function(*args) with no future.  Make it outside the
+    # interrupt handler; it can be submitted any number of times.
+    def job(self, function, *args):
+        return (function, args, None, None)
+
+    # submit() for interrupt handlers: never allocates, waits or raises.  Returns
+    # False if the job was dropped because the queue was full or busy.
+    def submit_isr(self, job):
+        if not self._jobs.put_isr(job):
+            return False
+        self._submitted += 1
+        _wake(self._wakeup)
+        return True
+
+    # Run function(*args) on a worker after delay ms.  Returns its future.
+    def schedule(self, delay, function, *args):
+        return self._add_timer(delay, 0, function, args)
+
+    # Run function(*args) on a worker every period ms, the first time after delay ms
+    # (period if not given), until its future is cancelled.  Returns the future; if the
+    # function raises, it is not run again and the future holds the exception.
+    def periodic(self, period, function, *args, delay=None):
+        return self._add_timer(period if delay == None else delay, period, function, args)
+
+    def _add_timer(self, delay, period, function, args):
+        job = (function, args, future(), 0)
+        timer = [ ticks_add(ticks_ms(), delay), period, job ]
+        with self._lock:
+            self._insert_timer(timer)
+            first = self._timers[0] is timer
+        if first:
+            # A worker may be waiting on a later timer
+            _wake(self._wakeup)
+        return job[_JOB_FUTURE]
+
+    # Keep timers soonest first (caller holds _lock)
+    def _insert_timer(self, timer):
+        index = 0
+        while index < len(self._timers) and ticks_diff(self._timers[index][_TIMER_DEADLINE], timer[_TIMER_DEADLINE]) <= 0:
+            index += 1
+        self._timers.insert(index, timer)
+
+    # Take the next due timer, or return None and the ms until one is due (-1 none)
+    def _due_timer(self):
+        with self._lock:
+            # Drop cancelled timers and periodic ones that have failed
+            while len(self._timers) != 0 and self._timers[0][_TIMER_JOB][_JOB_FUTURE].done():
+                self._timers.pop(0)
+            if len(self._timers) == 0:
+                return None, -1
+
+            wait = ticks_diff(self._timers[0][_TIMER_DEADLINE], ticks_ms())
+            if wait > 0:
+                return None, wait
+
+            timer = self._timers.pop(0)
+            if timer[_TIMER_PERIOD] != 0:
+                timer[_TIMER_DEADLINE] = ticks_add(timer[_TIMER_DEADLINE], timer[_TIMER_PERIOD])
+                self._insert_timer(timer)
+            return timer, 0
+
+    def _execute(self, job, periodic=False):
+        function, args, result = job[_JOB_FUNCTION], job[_JOB_ARGS], job[_JOB_FUTURE]
+        if result != None and result.done():
+            # Cancelled before it started
+            return
+        try:
+            value = function(*args)
+            if result != None and not periodic:
+                result._finish(value, None)
+            self._completed += 1
+        except Exception as e:
+            self._log("%s: job %s raised %s" % (self._name, function, e))
+            self._failed += 1
+            if result != None:
+                result._finish(None, e)
+
+    def _run(self, t):
+        while True:
+            job = self._jobs.get(wait=0)
+            if job != None:
+                if len(self._jobs) != 0:
+                    # More for another idle worker
+                    _wake(self._wakeup)
+                if job[_JOB_SUBMITTED] != None:
+                    latency = ticks_diff(ticks_ms(), job[_JOB_SUBMITTED])
+                    self._started += 1
+                    self._total_latency += latency
+                    if latency > self._max_latency:
+                        self._max_latency = latency
+                self._execute(job)
+                continue
+
+            if not t.running:
+                break
+
+            timer, wait = self._due_timer()
+            if timer != None:
+                self._timers_run += 1
+                self._execute(timer[_TIMER_JOB], timer[_TIMER_PERIOD] != 0)
+                continue
+
+            # Until something is submitted or the next timer is due
+            self._wakeup.acquire(1, wait)
+
+        # Let the next idle worker see it is stopped too
+        _wake(self._wakeup)
+        return 0
+
+    def stats(self):
+        with self._lock:
+            timers = len(self._timers)
+        return {
+            'workers':        len(self._workers),
+            'stack_bytes':    len(self._workers) * self._stack,
+            'queued':         len(self._jobs),
+            'timers':         timers,
+            'submitted':      self._submitted,
+            'completed':      self._completed,
+            'failed':         self._failed,
+            'timers_run':     self._timers_run,
+            'max_latency_ms': self._max_latency,
+            'avg_latency_ms': self._total_latency // self._started if self._started > 0 else 0,
+        }